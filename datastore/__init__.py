@@ -27,6 +27,7 @@ from basic import NamespaceDatastore
 
 from basic import DatastoreCollection
 from basic import ShardedDatastore
+from basic import ConsistentShardedDatastore
 from basic import TieredDatastore
 
 import query
@@ -35,3 +36,9 @@ from query import Cursor
 
 import serialize
 from serialize import SerializerShimDatastore
+
+import querycache
+from querycache import QueryCacheDatastore
+
+import migrate
+from migrate import MigratingShardedDatastore
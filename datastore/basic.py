@@ -1,6 +1,13 @@
 
+import functools
+import itertools
+import operator
+
 from key import Key
-from query import Cursor
+from query import Cursor, Order, Query, QueryPlan
+from index import HashIndex, SortedIndex
+from util.hashring import HashRing
+from util.threaded import parallel_gen
 
 class Datastore(object):
   '''A Datastore represents storage for any key-value pair.
@@ -86,14 +93,98 @@ class Datastore(object):
     '''
     return self.get(key) is not None
 
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run.
+
+    The default implementation describes the worst case: scanning the entire
+    collection, and applying the whole query naively. Datastores that push
+    (parts of) queries down to their backend should describe how.
+
+    Args:
+      query: Query object to explain.
+
+    Returns:
+      :py:class:`QueryPlan <datastore.query.QueryPlan>` for `query`
+    '''
+    return QueryPlan(query)
+
+  # Batch API. Datastores MAY provide optimized implementations.
+
+  def get_many(self, keys):
+    '''Returns a list with the objects named by `keys`, in the same order.
+
+    Missing objects are returned as None, just as with `get`. The default
+    implementation pays the cost of one get per key. Datastores able to
+    retrieve several objects in one round trip should override this.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve.
+
+    Returns:
+      list of objects (or None)
+    '''
+    return [self.get(key) for key in keys]
+
+  def put_many(self, items):
+    '''Stores all the `(key, value)` pairs in `items`.
+
+    The default implementation pays the cost of one put per item.
+
+    Args:
+      items: iterable of (key, value) pairs, or a dict of key -> value.
+    '''
+    for key, value in _item_pairs(items):
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes all the objects named by `keys`.
+
+    The default implementation pays the cost of one delete per key.
+
+    Args:
+      keys: iterable of Keys naming the objects to remove.
+    '''
+    for key in keys:
+      self.delete(key)
+
+  def contains_many(self, keys):
+    '''Returns a list of booleans: whether each object in `keys` exists.
+
+    The default implementation pays the cost of one contains per key.
+
+    Args:
+      keys: iterable of Keys naming the objects to check.
+
+    Returns:
+      list of booleans, in the same order as `keys`
+    '''
+    return [self.contains(key) for key in keys]
+
+
+
+def _item_pairs(items):
+  '''Returns `items` (a dict or iterable of pairs) as a list of pairs.'''
+  if isinstance(items, dict):
+    return items.items()
+  return list(items)
+
 
 
 
 class DictDatastore(Datastore):
-  '''Simple straw-man in-memory datastore backed by nested dicts.'''
+  '''Simple straw-man in-memory datastore backed by nested dicts.
+
+  Queries scan the whole collection, unless secondary indices are declared
+  (see :py:meth:`addIndex`). Then, queries are planned to read only the
+  objects the most selective index points to, already in order if possible.
+  '''
+
+  index_kinds = {'hash': HashIndex, 'sorted': SortedIndex}
+  '''Kinds of secondary indices, by name.'''
 
   def __init__(self):
     self._items = dict()
+    self._indices = dict()
 
   def _collection(self, key):
     '''Returns the namespace collection for `key`.'''
@@ -131,6 +222,8 @@ class DictDatastore(Datastore):
       self.delete(key)
     else:
       self._collection(key)[key] = value
+      for index in self._indices.get(str(key.path), {}).values():
+        index.put(key, value)
 
   def delete(self, key):
     '''Removes the object named by `key`.
@@ -140,6 +233,9 @@ class DictDatastore(Datastore):
     Args:
       key: Key naming the object to remove.
     '''
+    for index in self._indices.get(str(key.path), {}).values():
+      index.delete(key)
+
     try:
       del self._collection(key)[key]
 
@@ -165,8 +261,9 @@ class DictDatastore(Datastore):
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
 
-    Naively applies the query operations on the objects within the namespaced
-    collection corresponding to ``query.key.path``.
+    Applies the query operations on the objects within the namespaced
+    collection corresponding to ``query.key.path``. Without usable indices,
+    the query is applied naively on the entire collection.
 
     Args:
       query: Query object describing the objects to return.
@@ -174,12 +271,89 @@ class DictDatastore(Datastore):
     Raturns:
       iterable cursor with all objects matching criteria
     '''
-
-    # entire dataset already in memory, so ok to apply query naively
-    if str(query.key) in self._items:
-      return query(self._items[str(query.key)].values())
+    collection = str(query.key)
+    objects = self._items.get(collection, {})
+
+    plan = self.explain(query)
+    if plan.index is None:
+      # entire dataset already in memory, so ok to apply query naively
+      return query(objects.values())
+
+    index = self._indices[collection][plan.index]
+    filters = plan.pushdown.filters
+    if plan.pushdown.orders:
+      descending = query.orders[0].isDescending()
+      entries = index.entries(filters, descending)
+      iterable = _index_ordered(objects, entries, query.orders[1:])
     else:
-      return query([])
+      iterable = _index_objects(objects, index.lookup(filters))
+
+    # the remaining filters, orders, offset and limit are applied naively.
+    return plan(iterable)
+
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run: using the index
+    that serves the query's filters with the fewest estimated rows (preferring
+    indices that also serve the first order), or scanning the collection.
+    '''
+    collection = str(query.key)
+    best = (len(self._items.get(collection, {})), True, None, [], False)
+
+    for field, index in sorted(self._indices.get(collection, {}).items()):
+      filters = [f for f in query.filters if index.supports(f)]
+      ordered = bool(query.orders) and index.orders(query.orders[0])
+      if not filters and not ordered:
+        continue
+
+      # prefer fewer rows, then yielding rows in order.
+      plan = (index.estimate(filters), not ordered, index, filters, ordered)
+      if plan[:2] < best[:2]:
+        best = plan
+
+    rows, unordered, index, filters, ordered = best
+    if index is None:
+      return QueryPlan(query, rows=rows)
+
+    pushdown = Query(query.key, object_getattr=query.object_getattr)
+    pushdown.filters = filters
+    pushdown.orders = list(query.orders) if ordered else []
+    return QueryPlan(query, pushdown, 'index', index.field, rows)
+
+  def addIndex(self, collection, field, kind='sorted', object_getattr=None):
+    '''Declares a secondary index on `field` of the objects in `collection`,
+    indexing any objects already there. Indices are maintained as objects are
+    put and deleted.
+
+    Args:
+      collection: Key of the collection (as used in Queries).
+      field: name of the field to index.
+      kind: 'hash' (serves = and != filters) or 'sorted' (serves = and range
+            filters, and orders on `field`).
+      object_getattr: the attribute getter queries use on these objects.
+            Indices only serve filters and orders using the same getter.
+    '''
+    if kind not in self.index_kinds:
+      raise ValueError('index kind must be one of %s. Got %s.' % (
+        sorted(self.index_kinds.keys()), kind))
+
+    collection = str(Key(collection))
+    indices = self._indices.setdefault(collection, {})
+    if field in indices:
+      raise ValueError('field %s of %s already indexed.' % (field, collection))
+
+    index = self.index_kinds[kind](field, object_getattr)
+    for key, value in self._items.get(collection, {}).items():
+      index.put(key, value)
+
+    indices[field] = index
+
+  def removeIndex(self, collection, field):
+    '''Removes the secondary index on `field` of the objects in `collection`.
+    '''
+    collection = str(Key(collection))
+    del self._indices[collection][field]
+    if not self._indices[collection]:
+      del self._indices[collection]
 
   def __len__(self):
     return sum(map(len, self._items.values()))
@@ -187,6 +361,34 @@ class DictDatastore(Datastore):
 
 
 
+def _index_objects(objects, keys):
+  '''Generator yielding the objects named by `keys`, skipping those deleted
+  since `keys` were looked up.
+  '''
+  for key in keys:
+    obj = objects.get(key)
+    if obj is not None:
+      yield obj
+
+
+def _index_ordered(objects, entries, orders):
+  '''Generator yielding the objects named by index `entries` (value, key pairs
+  in the order of the first query order). Objects with the same indexed value
+  are sorted by the remaining `orders`.
+  '''
+  entries = ((value, objects.get(key)) for value, key in entries)
+  entries = (entry for entry in entries if entry[1] is not None)
+
+  for value, group in itertools.groupby(entries, operator.itemgetter(0)):
+    group = [obj for value, obj in group]
+    if orders and len(group) > 1:
+      group = Order.sorted(group, orders)
+    for obj in group:
+      yield obj
+
+
+
+
 class InterfaceMappingDatastore(Datastore):
   '''Represents simple wrapper datastore around an object that, though not a
   Datastore, implements data storage through a similar interface. For example,
@@ -335,6 +537,45 @@ class ShimDatastore(Datastore):
     '''
     return self.child_datastore.query(query)
 
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run.
+    Default shim implementation simply returns the child datastore's plan.
+    '''
+    return self.child_datastore.explain(query)
+
+  def get_many(self, keys):
+    '''Returns a list with the objects named by `keys`.
+
+    Default shim implementation forwards the whole batch to
+    ``child_datastore.get_many(keys)``. Shims that override `get` should
+    override `get_many` accordingly.
+    '''
+    return self.child_datastore.get_many(keys)
+
+  def put_many(self, items):
+    '''Stores all the `(key, value)` pairs in `items`.
+
+    Default shim implementation forwards the whole batch to
+    ``child_datastore.put_many(items)``.
+    '''
+    self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes all the objects named by `keys`.
+
+    Default shim implementation forwards the whole batch to
+    ``child_datastore.delete_many(keys)``.
+    '''
+    self.child_datastore.delete_many(keys)
+
+  def contains_many(self, keys):
+    '''Returns a list of booleans: whether each object in `keys` exists.
+
+    Default shim implementation forwards the whole batch to
+    ``child_datastore.contains_many(keys)``.
+    '''
+    return self.child_datastore.contains_many(keys)
+
 
 
 class KeyTransformDatastore(ShimDatastore):
@@ -387,6 +628,30 @@ class KeyTransformDatastore(ShimDatastore):
     query.key = self._transform(query.key)
     return self.child_datastore.query(query)
 
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run.'''
+    query = query.copy()
+    query.key = self._transform(query.key)
+    return self.child_datastore.explain(query)
+
+  def get_many(self, keys):
+    '''Return the objects named by keytransform(key) for each key in `keys`.'''
+    return self.child_datastore.get_many(map(self._transform, keys))
+
+  def put_many(self, items):
+    '''Stores the objects named by keytransform(key) for each item.'''
+    items = _item_pairs(items)
+    items = [(self._transform(key), value) for key, value in items]
+    return self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by keytransform(key) for each key.'''
+    return self.child_datastore.delete_many(map(self._transform, keys))
+
+  def contains_many(self, keys):
+    '''Returns whether the objects named by each key are in this datastore.'''
+    return self.child_datastore.contains_many(map(self._transform, keys))
+
   def _transform(self, key):
     '''Returns a `key` transformed by `self.keytransform`.'''
     return self.keytransform(key) if self.keytransform else key
@@ -560,6 +825,12 @@ class TieredDatastore(DatastoreCollection):
     # queries hit the last (most complete) datastore
     return self._stores[-1].query(query)
 
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run (on the last
+    datastore).
+    '''
+    return self._stores[-1].explain(query)
+
   def contains(self, key):
     '''Returns whether the object is in this datastore.'''
     for store in self._stores:
@@ -567,6 +838,68 @@ class TieredDatastore(DatastoreCollection):
         return True
     return False
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`. Checks each datastore in order,
+    asking each one only for the keys not yet found.
+    '''
+    keys = list(keys)
+    values = [None] * len(keys)
+    missing = range(0, len(keys))
+
+    for index, store in enumerate(self._stores):
+      if not missing:
+        break
+
+      found = []
+      still_missing = []
+      results = store.get_many([keys[i] for i in missing])
+      for i, value in zip(missing, results):
+        if value is None:
+          still_missing.append(i)
+        else:
+          values[i] = value
+          found.append((keys[i], value))
+
+      # add models to lower stores only
+      if found:
+        for store2 in self._stores[:index]:
+          store2.put_many(found)
+
+      missing = still_missing
+
+    return values
+
+  def put_many(self, items):
+    '''Stores the objects in all underlying datastores.'''
+    items = _item_pairs(items)
+    for store in self._stores:
+      store.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects from all underlying datastores.'''
+    keys = list(keys)
+    for store in self._stores:
+      store.delete_many(keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object is in this datastore. Checks each
+    datastore in order, asking each one only for the keys not yet found.
+    '''
+    keys = list(keys)
+    contained = [False] * len(keys)
+    missing = range(0, len(keys))
+
+    for store in self._stores:
+      if not missing:
+        break
+
+      results = store.contains_many([keys[i] for i in missing])
+      for i, exists in zip(missing, results):
+        contained[i] = exists
+      missing = [i for i, exists in zip(missing, results) if not exists]
+
+    return contained
+
 
 
 
@@ -580,10 +913,19 @@ class ShardedDatastore(DatastoreCollection):
   WARNING: adding or removing datastores while mid-use may severely affect
            consistency. Also ensure the order is correct upon initialization.
            While this is not as important for caches, it is crucial for
-           persistent datastores.
+           persistent datastores. See ConsistentShardedDatastore for a
+           sharding scheme that tolerates adding and removing shards.
 
   '''
 
+  parallel_query = True
+  '''Whether to query all shards concurrently. Override on the class or an
+  instance to query shards in sequence, e.g. if shards are not thread-safe.
+  '''
+
+  query_buffer_size = 100
+  '''Number of results to read ahead from each shard, when parallel.'''
+
   def __init__(self, stores=[], shardingfn=hash):
     '''Initialize the datastore with any provided datastore.'''
     if not callable(shardingfn):
@@ -618,12 +960,99 @@ class ShardedDatastore(DatastoreCollection):
     '''Returns whether the object is in this datastore.'''
     return self.shardDatastore(key).contains(key)
 
+  def _shardIndices(self, keys):
+    '''Returns a dict mapping shard index -> positions of its keys in `keys`.'''
+    indices = {}
+    for i, key in enumerate(keys):
+      indices.setdefault(self.shard(key), []).append(i)
+    return indices
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, one batch per shard.'''
+    keys = list(keys)
+    values = [None] * len(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      results = self.datastore(shard).get_many([keys[i] for i in indices])
+      for i, value in zip(indices, results):
+        values[i] = value
+    return values
+
+  def put_many(self, items):
+    '''Stores the objects to the corresponding datastores, one batch each.'''
+    items = _item_pairs(items)
+    keys = [key for key, value in items]
+    for shard, indices in self._shardIndices(keys).items():
+      self.datastore(shard).put_many([items[i] for i in indices])
+
+  def delete_many(self, keys):
+    '''Removes the objects from the corresponding datastores, one batch each.'''
+    keys = list(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      self.datastore(shard).delete_many([keys[i] for i in indices])
+
+  def contains_many(self, keys):
+    '''Returns whether each object is in this datastore, one batch per shard.'''
+    keys = list(keys)
+    contained = [False] * len(keys)
+    for shard, indices in self._shardIndices(keys).items():
+      results = self.datastore(shard).contains_many([keys[i] for i in indices])
+      for i, exists in zip(indices, results):
+        contained[i] = exists
+    return contained
+
   def query(self, query):
-    '''Returns a sequence of objects matching criteria expressed in `query`'''
-    cursor = Cursor(query, self.shard_query_generator(query))
-    cursor.apply_order()  # ordering sharded queries is expensive (no generator)
+    '''Returns a sequence of objects matching criteria expressed in `query`.
+
+    Shards are queried concurrently, each in its own thread, unless
+    `parallel_query` is False. Unordered results are returned shard by shard.
+    Ordered results are streamed through a k-way merge of each shard's
+    (already ordered) results, so they are never all in memory at once.
+    Offset and limit are applied to the combined results.
+    '''
+    if not query.orders and not self.parallel_query:
+      return Cursor(query, self.shard_query_generator(query))
+
+    shard_query = self._shard_query(query)
+    queries = [functools.partial(s.query, shard_query) for s in self._stores]
+    merge = functools.partial(Order.merged, orders=query.orders)
+
+    if not self.parallel_query:
+      iterable = merge([q() for q in queries])
+    elif query.orders:
+      iterable = parallel_gen(queries, merge, self.query_buffer_size)
+    else:
+      iterable = parallel_gen(queries, buffer_size=self.query_buffer_size)
+
+    cursor = Cursor(query, iterable)
+    cursor.apply_offset()
+    cursor.apply_limit()
     return cursor
 
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run: each shard runs
+    the filters and orders (see the `children` plans), and offset and limit
+    are applied to the merged results.
+    '''
+    if not query.orders and not self.parallel_query:
+      shard_query = query  # offset and limit carry over shard by shard.
+    else:
+      shard_query = self._shard_query(query)
+
+    children = [s.explain(shard_query) for s in self._stores]
+    rows = [c.rows for c in children]
+    rows = sum(rows) if None not in rows else None
+    return QueryPlan(query, shard_query, 'merge', rows=rows, children=children)
+
+  @staticmethod
+  def _shard_query(query):
+    '''Returns the query to run on each shard.'''
+    # each shard may hold all results before the offset, or all within limit.
+    shard_query = query.copy()
+    shard_query.offset = 0
+    if query.limit is not None:
+      shard_query.limit = query.offset + query.limit
+    return shard_query
+
   def shard_query_generator(self, query):
     '''A generator that queries each shard in sequence.'''
     shard_query = query.copy()
@@ -643,6 +1072,104 @@ class ShardedDatastore(DatastoreCollection):
           break  # we're already done!
 
 
+
+class ConsistentShardedDatastore(ShardedDatastore):
+  '''Represents a collection of datastore shards, placed on a consistent hash
+  ring (see :py:class:`datastore.util.hashring.HashRing`).
+
+  Each shard has a unique `name` and a `weight`, and owns `replicas * weight`
+  virtual nodes on the ring. Keys are assigned to the shard owning the next
+  virtual node on the ring. Adding or removing a shard only remaps the keys in
+  the ring ranges that shard gains or loses (about 1/N of all keys), rather
+  than nearly all of them, as ``hash(key) % N`` does.
+
+  Placement depends only on shard names and weights (not on shard order), so
+  persistent datastores must always be given the same names.
+
+  '''
+
+  def __init__(self, stores=[], names=None, weights=None, replicas=100):
+    '''Initialize the datastore with any provided datastores.
+
+    Args:
+      stores: the shard datastores.
+      names: unique string names for `stores`. Defaults to their indices.
+      weights: relative weights for `stores`. Defaults to 1 each.
+      replicas: number of virtual nodes per unit of weight.
+    '''
+    super(ConsistentShardedDatastore, self).__init__(stores)
+
+    if names is None:
+      names = map(str, range(0, len(self._stores)))
+    if weights is None:
+      weights = [1] * len(self._stores)
+
+    names = list(names)
+    weights = list(weights)
+    if len(names) != len(self._stores) or len(weights) != len(self._stores):
+      raise ValueError('names and weights must match stores in length.')
+
+    self._names = []
+    self._ring = HashRing(replicas=replicas)
+    for name, weight in zip(names, weights):
+      self._ring.add(name, weight)
+      self._names.append(name)
+    self._index_names()
+
+  def _index_names(self):
+    '''Rebuilds the name -> shard index lookup table.'''
+    self._name_indices = dict((n, i) for i, n in enumerate(self._names))
+
+  @property
+  def ring(self):
+    '''Returns the hash ring used for placement.'''
+    return self._ring
+
+  def name(self, index):
+    '''Returns the name of the shard at `index`.'''
+    return self._names[index]
+
+  def shard(self, key):
+    '''Returns the shard index to handle `key`, according to the ring.'''
+    return self._name_indices[self._ring.node(key)]
+
+  def appendDatastore(self, store, name=None, weight=1):
+    '''Appends datastore `store` to this collection, as shard `name`.
+    Only keys falling in the ring ranges `store` takes over are remapped.
+    '''
+    self.insertDatastore(len(self._stores), store, name=name, weight=weight)
+
+  def insertDatastore(self, index, store, name=None, weight=1):
+    '''Inserts datastore `store` into this collection at `index`, as shard
+    `name`. Only keys falling in the ring ranges `store` takes over are
+    remapped.
+    '''
+    if name is None:
+      # the next free number; after removals, numbers may be taken.
+      number = len(self._stores)
+      while str(number) in self._ring:
+        number += 1
+      name = str(number)
+
+    if name in self._ring:
+      raise ValueError('shard name %s already in use.' % name)
+
+    super(ConsistentShardedDatastore, self).insertDatastore(index, store)
+    self._ring.add(name, weight)
+    self._names.insert(index, name)
+    self._index_names()
+
+  def removeDatastore(self, store):
+    '''Removes datastore `store` from this collection.
+    Only keys that `store` handled are remapped.
+    '''
+    index = self._stores.index(store)
+    super(ConsistentShardedDatastore, self).removeDatastore(store)
+    self._ring.remove(self._names.pop(index))
+    self._index_names()
+
+
+
 '''
 
 Hello Tiered Access
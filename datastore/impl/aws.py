@@ -13,25 +13,43 @@ Tested with:
 #TODO: Implement TTL (and key configurations)
 
 
-from boto.s3.key import Key as S3Key
+import itertools
+
 from boto.exception import S3ResponseError
 
 import datastore
+from datastore.util.threaded import map_gen, parallel_gen
 
 
 class S3BucketDatastore(datastore.Datastore):
-  '''Simple aws s3 datastore. Does not support queries.
+  '''Simple aws s3 datastore.
 
   The s3 interface is very similar to datastore's. The only differences are:
   - values must be strings (SerializerShimDatastore)
   - keys must be converted into strings
+
+  Queries list the keys under the query key, and download their objects
+  `concurrency` at a time, in listing order. Listing continues in the
+  background, a page ahead of the downloads, and stops along with them once
+  the cursor is done.
+
+  Queries without filters or orders skip and limit keys as they are listed,
+  so only the objects returned are downloaded. Filters on `metadata_fields`
+  (attributes of listed boto Keys, such as 'size', 'last_modified' or
+  'etag') are evaluated on the listing too, rather than on the objects.
   '''
 
-  def __init__(self, s3bucket):
+  concurrency = 10
+  list_buffer_size = 1000  # keys listed ahead of downloads; one s3 page.
+  metadata_fields = ()
+
+  def __init__(self, s3bucket, concurrency=None, metadata_fields=None):
     '''Initialize the datastore with given s3 bucket `s3bucket`.
 
     Args:
       s3bucket: An s3 bucket to use.
+      concurrency: the number of objects queries download at once.
+      metadata_fields: query fields to evaluate on the listed s3 keys.
 
     Example::
 
@@ -41,18 +59,55 @@ class S3BucketDatastore(datastore.Datastore):
       s3ds = S3BucketDatastore(s3bucket)
     '''
     self._s3bucket = s3bucket
+    if concurrency is not None:
+      self.concurrency = int(concurrency)
+    if metadata_fields is not None:
+      self.metadata_fields = tuple(metadata_fields)
+
+    self.planner = datastore.query.QueryPlanner(offset=True, limit=True,
+      fields=self.metadata_fields)
 
   def _s3key(self, key):
     '''Return an s3 key for given datastore key.'''
-    k = S3Key(self._s3bucket)
-    k.key = str(key)
-    return k
-
-  @classmethod
-  def _s3keys_get_contents_as_string_gen(cls, s3keys):
-    '''s3 content retriever generator.'''
+    return self._s3bucket.new_key(str(key))
+
+  def _s3keys_list_gen(self, query):
+    '''s3 key lister generator: the s3 keys of objects under `query.key`.'''
+    prefix = str(query.key)
+    listing = lambda: self._s3bucket.list(prefix=prefix)
+    if self.concurrency > 1:
+      s3keys = parallel_gen([listing], buffer_size=self.list_buffer_size)
+    else:
+      s3keys = listing()
+
+    # prefixes also match other collections, e.g. /Users for /User.
     for s3key in s3keys:
-      yield s3key.get_contents_as_string()
+      if datastore.Key(s3key.name).path == query.key:
+        yield s3key
+
+  @staticmethod
+  def _s3key_get_contents_as_string(s3key):
+    '''Returns the contents of `s3key`, or None if it no longer exists.'''
+    try:
+      return s3key.get_contents_as_string()
+    except S3ResponseError, e:
+      if e.status == 404:
+        return None
+      raise
+
+  def _s3keys_get_contents_as_string_gen(self, s3keys):
+    '''s3 content retriever generator. Downloads up to `concurrency` objects
+    at once, skipping those deleted since listed.
+    '''
+    fetch = self._s3key_get_contents_as_string
+    if self.concurrency > 1:
+      contents = map_gen(fetch, s3keys, self.concurrency)
+    else:
+      contents = itertools.imap(fetch, s3keys)
+
+    for value in contents:
+      if value is not None:
+        yield value
 
 
   def get(self, key):
@@ -99,9 +154,24 @@ class S3BucketDatastore(datastore.Datastore):
     Raturns:
       iterable cursor with all objects matching criteria
     '''
-    allkeys = self._s3bucket.list(prefix=str(query.key).strip('/'))
-    iterable = self._s3keys_get_contents_as_string_gen(allkeys)
-    return query(iterable) # must apply filters, order, etc naively.
+    plan = self.explain(query)
+
+    # the pushdown runs on the listing: only the keys it returns are fetched.
+    s3keys = plan.pushdown(self._s3keys_list_gen(query))
+    iterable = self._s3keys_get_contents_as_string_gen(s3keys)
+    if plan.pushdown is query:
+      return S3Cursor(query, iterable, s3keys)
+    return plan(iterable) # must apply filters, order, etc naively.
+
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run. Offset and limit
+    are applied on the listing, as are filters on `metadata_fields`, unless
+    other filters or orders must run on the objects first.
+    '''
+    plan = self.planner.plan(query)
+    if not plan.residual.filters and not plan.residual.orders:
+      plan = datastore.query.QueryPlan(query, query, scan='native')
+    return plan
 
 
   def contains(self, key):
@@ -116,6 +186,29 @@ class S3BucketDatastore(datastore.Datastore):
     return self._s3key(key).exists()
 
 
+
+class S3Cursor(datastore.Cursor):
+  '''A datastore Cursor over the objects of the s3 keys in `s3keys`, a Cursor
+  over the listing, which skips results for it.
+  '''
+
+  __slots__ = ('_s3keys', '_skipped', )
+
+  def __init__(self, query, iterable, s3keys):
+    super(S3Cursor, self).__init__(query, iterable)
+    self._s3keys = s3keys
+
+  @property
+  def skipped(self):
+    '''The number of results skipped by the query offset.'''
+    return self._skipped + self._s3keys.skipped
+
+  @skipped.setter
+  def skipped(self, value):
+    self._skipped = value
+
+
+
 '''
 Hello World:
 
@@ -0,0 +1,477 @@
+
+__version__ = '1.0'
+__author__ = 'Juan Batiz-Benet <juan@benet.ai>'
+__doc__ = '''
+bitcask-style (log-structured) datastore implementation.
+
+'''
+
+import os
+import mmap
+import zlib
+import struct
+import threading
+import datastore
+
+from datastore.impl.filesystem import ensure_directory_exists, fsync_path
+
+
+# records are: crc32, key size, value size, tombstone flag, key, value.
+# the crc32 covers all that follows it.
+_crc = struct.Struct('>I')
+_record = struct.Struct('>IIB')
+
+# hints are: key size, value offset, value size, tombstone flag, key.
+_hint = struct.Struct('>IIIB')
+
+
+def _record_size(key, value_size):
+  '''Returns the size of the record of `key` with a `value_size` value.'''
+  return _crc.size + _record.size + len(key) + value_size
+
+
+class _Segment(object):
+  '''A segment file of records, named by its (number, part) `id`. Records are
+  appended to it while it is active. Once sealed, a hint file lists them, and
+  the segment is memory-mapped for reads.
+  '''
+
+  extension = '.data'
+  hint_extension = '.hint'
+
+  def __init__(self, root, id):
+    self.id = id
+    name = '%010d.%04d' % id
+    self.path = os.path.join(root, name + self.extension)
+    self.hint_path = os.path.join(root, name + self.hint_extension)
+
+    self.size = 0     # bytes of records
+    self.dead = 0     # bytes of superseded records
+    self.hints = []   # (key, value offset, value size, tombstone) of records
+
+    self._fd = None   # while active
+    self._map = None  # once sealed
+
+  @classmethod
+  def parse_id(cls, filename):
+    '''Returns the id of the segment file `filename`, or None.'''
+    if not filename.endswith(cls.extension):
+      return None
+    try:
+      number, part = filename[:-len(cls.extension)].split('.')
+      return int(number), int(part)
+    except ValueError:
+      return None
+
+  def open(self):
+    '''Opens this segment for appending.'''
+    flags = os.O_RDWR | os.O_CREAT | os.O_APPEND
+    self._fd = os.open(self.path, flags, 0644)
+
+  def append(self, key, value, tombstone=False, sync=False):
+    '''Appends a record of `key` and `value` (or a deletion of `key`, if
+    `tombstone`). Returns the offset and size of the value.
+    '''
+    value = '' if tombstone else value
+    body = _record.pack(len(key), len(value), tombstone) + key + value
+    os.write(self._fd, _crc.pack(zlib.crc32(body) & 0xffffffff) + body)
+    if sync:
+      os.fsync(self._fd)
+
+    offset = self.size + _crc.size + _record.size + len(key)
+    self.size += _crc.size + len(body)
+    self.hints.append((key, offset, len(value), tombstone))
+    return offset, len(value)
+
+  def read(self, offset, size):
+    '''Returns the `size` bytes at `offset`.'''
+    if self._map is not None:
+      return self._map[offset:offset + size]
+
+    # python 2 has no os.pread; the datastore lock serializes these.
+    os.lseek(self._fd, offset, os.SEEK_SET)
+    return os.read(self._fd, size)
+
+  def load(self):
+    '''Reads the records of this segment, from its hint file if it has one,
+    and otherwise from the segment itself, truncating any torn record at its
+    end (e.g. from a crash mid-write).
+    '''
+    if os.path.exists(self.hint_path):
+      with open(self.hint_path, 'rb') as f:
+        data = f.read()
+      self.hints = list(self._parse_hints(data))
+      self.size = os.path.getsize(self.path)
+      return
+
+    with open(self.path, 'rb') as f:
+      data = f.read()
+
+    self.hints = []
+    offset = 0
+    header = _crc.size + _record.size
+    while offset + header <= len(data):
+      crc, = _crc.unpack_from(data, offset)
+      key_size, value_size, tombstone = \
+        _record.unpack_from(data, offset + _crc.size)
+
+      end = offset + header + key_size + value_size
+      if end > len(data):
+        break
+      if zlib.crc32(data[offset + _crc.size:end]) & 0xffffffff != crc:
+        break
+
+      key = data[offset + header:offset + header + key_size]
+      value_offset = offset + header + key_size
+      self.hints.append((key, value_offset, value_size, bool(tombstone)))
+      offset = end
+
+    if offset < len(data):
+      with open(self.path, 'r+b') as f:
+        f.truncate(offset)
+    self.size = offset
+
+  @staticmethod
+  def _parse_hints(data):
+    '''Generator of the hints in hint file contents `data`.'''
+    offset = 0
+    while offset < len(data):
+      key_size, value_offset, value_size, tombstone = \
+        _hint.unpack_from(data, offset)
+      offset += _hint.size
+      key = data[offset:offset + key_size]
+      offset += key_size
+      yield key, value_offset, value_size, bool(tombstone)
+
+  def seal(self):
+    '''Stops appending to this segment: writes its hint file (if missing)
+    and memory-maps it for reads. Both files are synced to disk, so the hint
+    file never lists records the segment lost in a crash.
+    '''
+    if self._fd is not None:
+      os.fsync(self._fd)
+      os.close(self._fd)
+      self._fd = None
+
+    if not os.path.exists(self.hint_path):
+      temporary = self.hint_path + '.tmp'
+      with open(temporary, 'wb') as f:
+        for key, offset, size, tombstone in self.hints:
+          f.write(_hint.pack(len(key), offset, size, tombstone) + key)
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(temporary, self.hint_path)
+    self.hints = []
+
+    if self.size > 0:
+      with open(self.path, 'rb') as f:
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def close(self):
+    '''Closes this segment's file.'''
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+
+  def remove(self):
+    '''Closes and removes this segment's files.'''
+    self.close()
+    for path in [self.path, self.hint_path]:
+      if os.path.exists(path):
+        os.remove(path)
+
+
+
+class BitcaskDatastore(datastore.Datastore):
+  '''Log-structured datastore, in the style of Bitcask.
+
+  BitcaskDatastore appends every write, a key and its value (or a deletion
+  marker), as a record to the active segment file under `root`. An in-memory
+  index maps each key to where its latest value lives, so every get is one
+  read and every put is one append, however small the objects are.
+
+  Once the active segment holds `segment_size` bytes, it is sealed: a hint
+  file listing its records is written next to it, and it is memory-mapped
+  for reads. At startup, the index is rebuilt from the hint files, scanning
+  the segments that have none (e.g. the one active during a crash).
+
+  Overwritten and deleted records are dead weight. Once they make up
+  `compaction_ratio` of the sealed segments, these are compacted in a
+  background thread: their live records are copied into new segments, and
+  the old ones removed. `compact` does so on demand.
+
+  Values must be strings (e.g. through a serializing shim). Queries return
+  the objects directly under the query key, as with DictDatastore.
+
+  Args:
+    root: the directory to store segment files in.
+    segment_size: the size in bytes at which segments are sealed.
+    compaction_ratio: the fraction of dead bytes triggering compaction.
+    auto_compact: whether to compact in the background, or only on demand.
+    sync: whether every write is synced to disk before returning.
+  '''
+
+  segment_size = 64 * 1024 * 1024
+  compaction_ratio = 0.5
+  auto_compact = True
+  sync = False
+
+  def __init__(self, root, segment_size=None, compaction_ratio=None,
+               auto_compact=None, sync=None):
+    root = os.path.normpath(root)
+    ensure_directory_exists(root)
+    self.root_path = root
+
+    if segment_size is not None:
+      self.segment_size = int(segment_size)
+    if compaction_ratio is not None:
+      self.compaction_ratio = float(compaction_ratio)
+    if auto_compact is not None:
+      self.auto_compact = bool(auto_compact)
+    if sync is not None:
+      self.sync = bool(sync)
+
+    self._index = {}     # str(key.path) -> {str(key): (segment, off, size)}
+    self._segments = {}  # id -> segment
+    self._lock = threading.RLock()
+    self._compaction_lock = threading.Lock()
+    self._compaction = None
+
+    self._load()
+
+  def _load(self):
+    '''Rebuilds the index from the segment files, and opens a new active
+    segment.
+    '''
+    ids = []
+    for filename in os.listdir(self.root_path):
+      if filename.endswith('.tmp'):
+        os.remove(os.path.join(self.root_path, filename))
+      elif _Segment.parse_id(filename):
+        ids.append(_Segment.parse_id(filename))
+
+    for id in sorted(ids):
+      segment = _Segment(self.root_path, id)
+      segment.load()
+      for key, offset, size, tombstone in segment.hints:
+        self._apply(segment, key, offset, size, tombstone)
+
+      if segment.size == 0:
+        segment.remove()
+        continue
+      segment.seal()
+      self._segments[id] = segment
+
+    number = max(ids)[0] + 1 if ids else 0
+    self._activate(_Segment(self.root_path, (number, 0)))
+
+  def _activate(self, segment):
+    '''Makes `segment` the one appended to.'''
+    segment.open()
+    self._segments[segment.id] = segment
+    self._active = segment
+
+  def _apply(self, segment, key, offset, size, tombstone):
+    '''Points the index at a record of `key` in `segment`.'''
+    collection = str(datastore.Key(key).path)
+    entries = self._index.setdefault(collection, {})
+
+    previous = entries.pop(key, None)
+    if previous is not None:
+      previous[0].dead += _record_size(key, previous[2])
+
+    if tombstone:
+      segment.dead += _record_size(key, 0)
+      if not entries:
+        del self._index[collection]
+    else:
+      entries[key] = (segment, offset, size)
+
+  def _location(self, key):
+    '''Returns the (segment, offset, size) of the value of `key`, or None.'''
+    entries = self._index.get(str(key.path))
+    return entries and entries.get(str(key))
+
+  def _write(self, key, value, tombstone=False):
+    '''Appends a record to the active segment, sealing it once full.'''
+    key = str(key)
+    segment = self._active
+    offset, size = segment.append(key, value, tombstone, self.sync)
+    self._apply(segment, key, offset, size, tombstone)
+
+    if segment.size >= self.segment_size:
+      segment.seal()
+      self._activate(_Segment(self.root_path, (segment.id[0] + 1, 0)))
+      if self._should_compact():
+        self._compaction = threading.Thread(target=self.compact)
+        self._compaction.daemon = True
+        self._compaction.start()
+
+  def _sealed(self):
+    '''Returns the sealed segments, oldest first.'''
+    return [self._segments[id] for id in sorted(self._segments)
+            if self._segments[id] is not self._active]
+
+  def _should_compact(self):
+    '''Returns whether the sealed segments are dead enough to compact.'''
+    if not self.auto_compact:
+      return False
+    if self._compaction and self._compaction.is_alive():
+      return False
+
+    sealed = self._sealed()
+    size = sum(segment.size for segment in sealed)
+    dead = sum(segment.dead for segment in sealed)
+    return size > 0 and dead >= self.compaction_ratio * size
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    with self._lock:
+      location = self._location(key)
+      if location is None:
+        return None
+      segment, offset, size = location
+      return segment.read(offset, size)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+    '''
+    with self._lock:
+      self._write(key, value)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    with self._lock:
+      if self._location(key) is not None:
+        self._write(key, None, tombstone=True)
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    Naively applies the query operations on the objects under query.key.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Returns:
+      Cursor with all objects matching criteria
+    '''
+    with self._lock:
+      keys = list(self._index.get(str(query.key), {}))
+
+    # objects deleted since listed are skipped.
+    values = (self.get(datastore.Key(key)) for key in keys)
+    return query(value for value in values if value is not None)
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists.
+    Optimized to only check the index.
+
+    Args:
+      key: Key naming the object to check.
+
+    Returns:
+      boolean whether the object exists
+    '''
+    with self._lock:
+      return self._location(key) is not None
+
+  def __len__(self):
+    with self._lock:
+      return sum(map(len, self._index.values()))
+
+
+  # Compaction
+
+  def compact(self):
+    '''Copies the live records of all sealed segments into new segments, and
+    removes the old ones. Writes continue meanwhile. Returns the number of
+    bytes reclaimed.
+    '''
+    with self._compaction_lock:
+      with self._lock:
+        sealed = self._sealed()
+        old = set(sealed)
+        live = [(key, location)
+                for entries in self._index.values()
+                for key, location in entries.items() if location[0] in old]
+
+      if not sealed:
+        return 0
+
+      # new segments sort after the old ones, and before the active one.
+      number, part = sealed[-1].id
+      outputs = []
+      copies = []
+      for key, (segment, offset, size) in live:
+        if not outputs or outputs[-1].size >= self.segment_size:
+          part += 1
+          outputs.append(_Segment(self.root_path, (number, part)))
+          outputs[-1].open()
+
+        value = segment.read(offset, size)
+        new_offset, new_size = outputs[-1].append(key, value, sync=self.sync)
+        copies.append((key, (segment, offset, size),
+                       (outputs[-1], new_offset, new_size)))
+
+      # the old segments are removed once their records are on disk again,
+      # whatever `sync` is.
+      for output in outputs:
+        output.seal()
+      fsync_path(self.root_path)
+
+      with self._lock:
+        for key, location, copy in copies:
+          entries = self._index.get(str(datastore.Key(key).path), {})
+          if entries.get(key) == location:
+            entries[key] = copy
+          else:
+            copy[0].dead += _record_size(key, copy[2])  # written meanwhile.
+
+        for segment in sealed:
+          del self._segments[segment.id]
+        for output in outputs:
+          self._segments[output.id] = output
+
+      for segment in sealed:
+        segment.remove()
+
+      before = sum(segment.size for segment in sealed)
+      return before - sum(output.size for output in outputs)
+
+  def close(self):
+    '''Waits for compaction to finish, and closes all segment files. The
+    datastore cannot be used afterwards.
+    '''
+    if self._compaction:
+      self._compaction.join()
+
+    with self._lock:
+      if self._active.size == 0:
+        del self._segments[self._active.id]
+        self._active.remove()
+      else:
+        self._active.seal()
+
+      for segment in self._segments.values():
+        segment.close()
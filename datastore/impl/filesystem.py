@@ -10,8 +10,26 @@ Tested with:
 '''
 
 import os
+import mmap
+import errno
+import time
+import binascii
+import itertools
+import threading
+import collections
 import datastore
 
+from datastore.util import fasthash
+from datastore.util.threaded import WorkerPool
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
 
 def ensure_directory_exists(directory):
   '''Ensures `directory` exists. May make `directory` and intermediate dirs.
@@ -23,6 +41,90 @@ def ensure_directory_exists(directory):
     raise RuntimeError('Path %s is a file, not a directory.' % directory)
 
 
+def _scan(directory, extension, directories=False):
+  '''Generator of the paths of the entries in `directory` named with
+  `extension` (or one of a tuple of extensions), that are directories if
+  `directories` (or else are not).
+  Yields nothing if `directory` does not exist.
+
+  Uses the entry types `scandir` reads along with the names, so entries are
+  never stat'ed. Without `scandir`, entries are told apart by name only.
+  '''
+  try:
+    entries = scandir(directory) if scandir else os.listdir(directory)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+
+  for entry in entries:
+    name = entry.name if scandir else entry
+    if not name.endswith(extension):
+      continue
+    if scandir and entry.is_dir() != directories:
+      continue
+    yield os.path.join(directory, name)
+
+
+def fsync_path(path):
+  '''Flushes the file or directory at `path` to disk. Does nothing if `path`
+  does not exist (e.g. was removed since written).
+  '''
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def migrate_layout(source, destination):
+  '''Moves all objects stored by FileSystemDatastore `source` to where
+  FileSystemDatastore `destination` stores them. For example, to switch the
+  layout of the datastore at '/data'::
+
+    >>> flat = FileSystemDatastore('/data')
+    >>> hashed = FileSystemDatastore('/data', layout='hashed')
+    >>> migrate_layout(flat, hashed)
+
+  Objects are renamed, so both roots must be on the same filesystem. Writes
+  must not happen during the migration. Returns the number of objects moved.
+  '''
+  # plan all moves first, to not walk into objects already moved.
+  moves = []
+  for directory, dirnames, filenames in os.walk(source.root_path):
+    for filename in filenames:
+      path = os.path.join(directory, filename)
+      flat = source._flat_path(os.path.relpath(path, source.root_path))
+      if flat is not None:
+        moves.append((path, destination._layout_object_path(flat)))
+
+  moved = 0
+  for path, target in moves:
+    if path == target:
+      continue
+
+    ensure_directory_exists(os.path.dirname(target))
+    os.rename(path, target)
+    moved += 1
+
+    # remove fan-out directories left empty.
+    directory = os.path.dirname(path)
+    while directory.endswith(source.fanout_extension):
+      try:
+        os.rmdir(directory)
+      except OSError:
+        break
+      directory = os.path.dirname(directory)
+
+  return moved
+
+
 
 class FileSystemDatastore(datastore.Datastore):
   '''Simple flat-file datastore.
@@ -65,16 +167,93 @@ class FileSystemDatastore(datastore.Datastore):
       /data/Comedy/MontyPython/Sketch/CheeseShop.obj
       /data/Comedy/MontyPython/Sketch/CheeseShop/
 
+    Objects are written atomically: to a temporary file next to the object
+    path, renamed over it once complete. Readers never see partial objects,
+    and a crash leaves either the old object or the new one. Temporary files
+    left behind by crashes are removed by queries scanning their directory,
+    once older than `stale_temporary_age` seconds.
+
+  Layouts:
+    With the default 'flat' `layout`, each collection is one directory, which
+    slows down filesystems once it holds millions of objects. The 'hashed'
+    `layout` fans objects out into `fanout_levels` levels of subdirectories,
+    named after `fanout_width` hex digits of the hash of the object path::
+
+      /data/Comedy/MontyPython/Sketch/3f.fan/a2.fan/CheeseShop.obj
+
+    Queries still enumerate whole collections. `migrate_layout` moves the
+    objects of an existing datastore from one layout to another.
+
+  Durability:
+    How much of that survives a power loss depends on `durability`:
+
+    * 'none': nothing is synced; the OS flushes writes when it chooses.
+    * 'fsync': every write syncs its file and directory before returning.
+    * 'group': writes return before syncing; the files and directories they
+      touch are synced together, once `group_size` writes are pending or
+      `group_interval` seconds after the first one, whichever comes first.
+      `sync` commits the pending writes immediately.
+
+  Zero-copy reads:
+    With an `mmap_threshold`, objects of at least that many bytes are read
+    as read-only buffers over memory maps of their files, rather than copied
+    into strings; ``str(value)`` copies them when needed. `get_stream` reads
+    objects of any size incrementally, from a file object.
+
+  Caching:
+    Directories known to exist are cached, so puts do not check for them.
+    With a `negative_cache_size`, up to that many paths of objects found
+    missing are cached too, so repeated misses do not touch the disk. Puts
+    through this datastore invalidate them; objects written by others may
+    not be seen until evicted.
+
+  Read-ahead:
+    With a `read_ahead` of K, queries and `get_many` read the next K files
+    concurrently, in a pool of K threads, while the caller consumes the
+    objects before them. This helps most on network filesystems. The pool
+    belongs to the datastore, and its threads are reused across calls until
+    idle for `read_ahead_idle` seconds.
+
   '''
 
   object_extension = '.obj'
+  temporary_extension = '.tmp'
+  stale_temporary_age = 3600
   ignore_list = list()
 
-  def __init__(self, root, case_sensitive=True):
+  layouts = ('flat', 'hashed')
+  layout = 'flat'
+  fanout_levels = 2
+  fanout_width = 2
+  fanout_extension = '.fan'
+
+  durability_modes = ('none', 'fsync', 'group')
+  durability = 'none'
+  group_size = 100
+  group_interval = 1.0
+
+  read_ahead = 0
+  read_ahead_idle = 10
+  mmap_threshold = None
+  negative_cache_size = 0
+
+  def __init__(self, root, case_sensitive=True, durability=None,
+               group_size=None, group_interval=None, layout=None,
+               fanout_levels=None, fanout_width=None, read_ahead=None,
+               mmap_threshold=None, negative_cache_size=None):
     '''Initialize the datastore with given root directory `root`.
 
     Args:
       root: A path at which to mount this filesystem datastore.
+      layout: one of `layouts` (see the class documentation).
+      fanout_levels: the number of fan-out directory levels ('hashed' only).
+      fanout_width: the hex digits naming fan-out directories ('hashed' only).
+      read_ahead: the number of files to read concurrently, or 0 for none.
+      mmap_threshold: the size of objects to read as memory-mapped buffers.
+      negative_cache_size: the number of missing object paths to cache.
+      durability: one of `durability_modes` (see the class documentation).
+      group_size: the number of pending writes that triggers a group commit.
+      group_interval: the seconds a write may wait for its group commit.
     '''
     root = os.path.normpath(root)
 
@@ -82,11 +261,57 @@ class FileSystemDatastore(datastore.Datastore):
       errstr = 'root path must not be empty (\'.\' for current directory)'
       raise ValueError(errstr)
 
+    if durability is not None:
+      self.durability = durability
+    if self.durability not in self.durability_modes:
+      raise ValueError('durability must be one of %s, not %r' %
+                       (self.durability_modes, self.durability))
+
+    if layout is not None:
+      self.layout = layout
+    if self.layout not in self.layouts:
+      raise ValueError('layout must be one of %s, not %r' %
+                       (self.layouts, self.layout))
+
+    if fanout_levels is not None:
+      self.fanout_levels = int(fanout_levels)
+    if fanout_width is not None:
+      self.fanout_width = int(fanout_width)
+    if not 0 < self.fanout_levels * self.fanout_width <= 16:
+      raise ValueError('fan-out must use between 1 and 16 hex digits.')
+
+    if read_ahead is not None:
+      self.read_ahead = int(read_ahead)
+    self._pool = None
+    if self.read_ahead:
+      self._pool = WorkerPool(self.read_ahead, self.read_ahead_idle)
+    if mmap_threshold is not None:
+      self.mmap_threshold = int(mmap_threshold)
+    if negative_cache_size is not None:
+      self.negative_cache_size = int(negative_cache_size)
+
+    if group_size is not None:
+      self.group_size = int(group_size)
+    if group_interval is not None:
+      self.group_interval = float(group_interval)
+
     ensure_directory_exists(root)
 
     self.root_path = root
     self.case_sensitive = bool(case_sensitive)
 
+    # files and directories written since the last group commit.
+    self._unsynced_files = set()
+    self._unsynced_directories = set()
+    self._unsynced_writes = 0
+    self._sync_lock = threading.Lock()
+    self._sync_timer = None
+
+    self._directories = set()  # directories known to exist.
+    self._missing = collections.OrderedDict()  # object paths known missing.
+    self._missing_lock = threading.Lock()
+    self._puts = 0
+
 
   # object pathing
 
@@ -105,39 +330,268 @@ class FileSystemDatastore(datastore.Datastore):
 
   def relative_object_path(self, key):
     '''Returns the relative path for object pointed by `key`.'''
-    return self.relative_path(key) + self.object_extension
+    return self._layout_path(self.relative_path(key)) + self.object_extension
 
   def object_path(self, key):
     '''return the object path for `key`.'''
     return os.path.join(self.root_path, self.relative_object_path(key))
 
+  def fanout(self, relative):
+    '''Returns the fan-out directories of the object at (flat) path
+    `relative`, in the 'hashed' layout.
+    '''
+    digest = '%016x' % fasthash.hash(relative)
+    width = self.fanout_width
+    return [digest[i * width:(i + 1) * width] + self.fanout_extension
+            for i in range(0, self.fanout_levels)]
+
+  def _layout_path(self, relative):
+    '''Returns the relative path of the object at (flat) path `relative`, in
+    this datastore's layout.
+    '''
+    if self.layout == 'flat':
+      return relative
+
+    directory, name = os.path.split(relative)
+    return os.path.join(directory, *(self.fanout(relative) + [name]))
+
+  def _layout_object_path(self, relative):
+    '''Returns the object path of the object at (flat) path `relative`.'''
+    relative = self._layout_path(relative) + self.object_extension
+    return os.path.join(self.root_path, relative)
+
+  def _flat_path(self, relative):
+    '''Returns the (flat) path of the object file at path `relative` in this
+    datastore's layout, or None if it is not an object file.
+    '''
+    if not relative.endswith(self.object_extension):
+      return None
+
+    relative = relative[:-len(self.object_extension)]
+    if self.layout == 'flat':
+      return relative
+
+    parts = relative.split(os.sep)
+    levels = self.fanout_levels
+    if len(parts) <= levels:
+      return None
+
+    flat = os.path.join(*(parts[:-levels - 1] + parts[-1:]))
+    if parts[-levels - 1:-1] != self.fanout(flat):
+      return None
+    return flat
+
+  def _object_paths(self, directory):
+    '''Generator of the paths of the object files in the collection at
+    `directory`.
+    '''
+    directories = [directory]
+    if self.layout == 'hashed':
+      for level in range(0, self.fanout_levels):
+        directories = self._subdirectories(directories)
+
+    ignore = set(self.ignore_list)
+    extensions = (self.object_extension, self.temporary_extension)
+    for directory in directories:
+      for path in _scan(directory, extensions):
+        if path.endswith(self.temporary_extension):
+          self._remove_stale_temporary(path)
+        elif os.path.basename(path) not in ignore:
+          yield path
+
+  def _remove_stale_temporary(self, path):
+    '''Removes the temporary file at `path` if it is old enough to have been
+    left behind by a crashed write, rather than being written still.
+    '''
+    try:
+      if time.time() - os.path.getmtime(path) > self.stale_temporary_age:
+        os.remove(path)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def _subdirectories(self, directories):
+    '''Generator of the fan-out subdirectories of `directories`.'''
+    for directory in directories:
+      for path in _scan(directory, self.fanout_extension, directories=True):
+        yield path
+
 
   # object IO
 
   def _write_object(self, path, value):
-    '''write out `object` to file at `path`'''
-    ensure_directory_exists(os.path.dirname(path))
+    '''write out `object` to file at `path`, atomically'''
+    directory = os.path.dirname(path)
+    created = self._ensure_directory(directory)
+
+    suffix = binascii.hexlify(os.urandom(4)) + self.temporary_extension
+    temporary = '%s.%s' % (path, suffix)
+    try:
+      try:
+        f = open(temporary, 'w')
+      except IOError, e:
+        # known directories may have been removed by others; make them again.
+        if e.errno != errno.ENOENT or created is not None:
+          raise
+        self._directories.discard(directory)
+        created = self._ensure_directory(directory)
+        f = open(temporary, 'w')
+
+      with f:
+        f.write(value)
+        if self.durability == 'fsync':
+          f.flush()
+          os.fsync(f.fileno())
+      os.rename(temporary, path)
+    except:
+      if os.path.exists(temporary):
+        os.remove(temporary)
+      raise
+
+    # the file itself was synced before the rename, in 'fsync' mode.
+    files = [path] if self.durability == 'group' else []
+    self._commit(files, [directory] + (created or []))
+
+  def _ensure_directory(self, directory):
+    '''Ensures `directory` exists, returning the parents of the directories
+    made (whose entries must be synced too), or None if it was known to.
+    '''
+    if directory in self._directories:
+      return None
+
+    parents = []
+    missing = directory if self.durability != 'none' else None
+    while missing and not os.path.exists(missing):
+      missing = os.path.dirname(missing)
+      parents.append(missing)
 
-    with open(path, 'w') as f:
-      f.write(value)
+    ensure_directory_exists(directory)
+    self._directories.add(directory)
+    return parents
+
+  def _commit(self, files, directories):
+    '''Makes a write of `files`, and entries of `directories`, durable as
+    configured by `durability`.
+    '''
+    if self.durability == 'fsync':
+      for path in list(files) + list(directories):
+        fsync_path(path)
+
+    elif self.durability == 'group':
+      with self._sync_lock:
+        self._unsynced_files.update(files)
+        self._unsynced_directories.update(directories)
+        self._unsynced_writes += 1
+
+        full = self._unsynced_writes >= self.group_size
+        if not full and self._sync_timer is None:
+          self._sync_timer = threading.Timer(self.group_interval, self.sync)
+          self._sync_timer.daemon = True
+          self._sync_timer.start()
+
+      if full:
+        self.sync()
+
+  def sync(self):
+    '''Syncs the files and directories of all pending writes to disk (a
+    group commit). Writes are only pending with 'group' `durability`.
+    '''
+    with self._sync_lock:
+      files, self._unsynced_files = self._unsynced_files, set()
+      directories, self._unsynced_directories = \
+        self._unsynced_directories, set()
+      self._unsynced_writes = 0
+
+      if self._sync_timer is not None:
+        self._sync_timer.cancel()
+        self._sync_timer = None
+
+    # files first, so directory entries never point at unsynced contents.
+    for path in files:
+      fsync_path(path)
+    for directory in directories:
+      fsync_path(directory)
+
+  def _open_object(self, path):
+    '''open the object file at `path`, or return None if there is none'''
+    try:
+      return open(path, 'rb')
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return None
+      if e.errno == errno.EISDIR:
+        raise RuntimeError('%s is a directory, not a file.' % path)
+      raise
 
   def _read_object(self, path):
-    '''read in object from file at `path`'''
-    if not os.path.exists(path):
+    '''read in object from file at `path`, or None if there is none'''
+    f = self._open_object(path)
+    if f is None:
+      return None
+
+    with f:
+      if self.mmap_threshold is None:
+        return f.read()
+
+      size = os.fstat(f.fileno()).st_size
+      if size == 0 or size < self.mmap_threshold:
+        return f.read()
+
+      # the buffer keeps the map alive, and the map the file contents: writes
+      # rename new files into place, never changing mapped ones.
+      return buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+  def _get_object(self, path):
+    '''read in object from file at `path`, or None if there is none, using
+    the negative cache'''
+    puts = self._known_missing(path)
+    if puts is None:
       return None
 
-    if os.path.isdir(path):
-      raise RuntimeError('%s is a directory, not a file.' % path)
+    value = self._read_object(path)
+    if value is None:
+      self._remember_missing(path, puts)
+    return value
 
-    with open(path) as f:
-      file_contents = f.read()
+  def _known_missing(self, path):
+    '''Returns None if `path` is known to be missing, or else the number of
+    puts so far (see `_remember_missing`).
+    '''
+    if not self.negative_cache_size:
+      return 0
+
+    with self._missing_lock:
+      if path in self._missing:
+        self._missing[path] = self._missing.pop(path)  # most recently used.
+        return None
+      return self._puts
+
+  def _remember_missing(self, path, puts):
+    '''Caches that `path` is missing, as found when `puts` puts were done.
+    Puts done since may have written it.
+    '''
+    if not self.negative_cache_size:
+      return
 
-    return file_contents
+    with self._missing_lock:
+      if puts == self._puts:
+        self._missing[path] = True
+        while len(self._missing) > self.negative_cache_size:
+          self._missing.popitem(last=False)
 
   def _read_object_gen(self, iterable):
-    '''Generator that reads objects in from filenames in `iterable`.'''
-    for filename in iterable:
-      yield self._read_object(filename)
+    '''Generator that reads objects in from filenames in `iterable`,
+    skipping files removed since listed. Reads up to `read_ahead` files
+    ahead, concurrently.
+    '''
+    if self._pool:
+      values = self._pool.map_gen(self._read_object, iterable)
+    else:
+      values = itertools.imap(self._read_object, iterable)
+
+    for value in values:
+      if value is not None:
+        yield value
 
 
   # Datastore implementation
@@ -152,7 +606,29 @@ class FileSystemDatastore(datastore.Datastore):
       object or None
     '''
     path = self.object_path(key)
-    return self._read_object(path)
+    return self._get_object(path)
+
+  def get_stream(self, key):
+    '''Return a file object reading the object named by key, or None if it
+    does not exist. The caller must close it.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      file or None
+    '''
+    return self._open_object(self.object_path(key))
+
+
+  def get_many(self, keys):
+    '''Returns a list with the objects named by `keys`, in the same order.
+    Reads up to `read_ahead` objects concurrently.
+    '''
+    paths = [self.object_path(key) for key in keys]
+    if self._pool and len(paths) > 1:
+      return list(self._pool.map_gen(self._get_object, paths))
+    return map(self._get_object, paths)
 
 
   def put(self, key, value):
@@ -165,6 +641,11 @@ class FileSystemDatastore(datastore.Datastore):
     path = self.object_path(key)
     self._write_object(path, value)
 
+    if self.negative_cache_size:
+      with self._missing_lock:
+        self._puts += 1
+        self._missing.pop(path, None)
+
   def delete(self, key):
     '''Removes the object named by `key`.
 
@@ -172,8 +653,14 @@ class FileSystemDatastore(datastore.Datastore):
       key: Key naming the object to remove.
     '''
     path = self.object_path(key)
-    if os.path.exists(path):
+    try:
       os.remove(path)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return
+      raise
+
+    self._commit([], [os.path.dirname(path)])
 
     #TODO: delete dirs if empty?
 
@@ -188,16 +675,8 @@ class FileSystemDatastore(datastore.Datastore):
     Raturns:
       Cursor with all objects matching criteria
     '''
-    path = self.path(query.key)
-
-    if os.path.exists(path):
-      filenames = os.listdir(path)
-      filenames = list(set(filenames) - set(self.ignore_list))
-      filenames = map(lambda f: os.path.join(path, f), filenames)
-      iterable = self._read_object_gen(filenames)
-    else:
-      iterable = list()
-
+    paths = self._object_paths(self.path(query.key))
+    iterable = self._read_object_gen(paths)
     return query(iterable) # must apply filters, etc naively.
 
   def contains(self, key):
@@ -211,7 +690,14 @@ class FileSystemDatastore(datastore.Datastore):
       boalean whether the object exists
     '''
     path = self.object_path(key)
-    return os.path.exists(path) and os.path.isfile(path)
+    puts = self._known_missing(path)
+    if puts is None:
+      return False
+
+    exists = os.path.isfile(path)
+    if not exists:
+      self._remember_missing(path, puts)
+    return exists
 
 
 
@@ -1,5 +1,5 @@
 
-__version__ = '1.0'
+__version__ = '1.1'
 __author__ = 'Juan Batiz-Benet <juan@benet.ai>'
 __doc__ = '''
 memcached datastore implementation.
@@ -26,8 +26,15 @@ class MemcachedDatastore(datastore.InterfaceMappingDatastore):
   The only differences (which InterfaceMappingDatastore takes care of) are:
   - keys should be converted into strings
   - `put` calls should be mapped to `set`
+
+  Batch operations (`get_many`, `put_many`, `delete_many`, `contains_many`)
+  are routed to the client's `get_multi`, `set_multi` and `delete_multi`, if
+  it supports them (see `batched`), costing one round trip per batch.
   '''
 
+  batch_methods = ['get_multi', 'set_multi', 'delete_multi']
+  '''Client methods required to send batch operations in one round trip.'''
+
   def __init__(self, memcached):
     '''Initialize the datastore with given memcached client `memcached`.
 
@@ -35,8 +42,53 @@ class MemcachedDatastore(datastore.InterfaceMappingDatastore):
       memcached: A memcached client to use. Must implement the basic memcached
           interface: set, get, delete. This datastore keeps the interface so
           basic in order to work with any memcached client (or pool of clients).
+          Clients that also implement get_multi, set_multi and delete_multi
+          (e.g. pylibmc) get batched operations.
     '''
     super(MemcachedDatastore, self).__init__(memcached, put='set', key=str)
+    self.batched = all(hasattr(memcached, m) for m in self.batch_methods)
+
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, using a single `get_multi`.'''
+    if not self.batched:
+      return super(MemcachedDatastore, self).get_many(keys)
+
+    keys = map(self._service_key, keys)
+    if not keys:
+      return []
+
+    found = self._service.get_multi(keys)
+    return [found.get(key) for key in keys]
+
+  def put_many(self, items):
+    '''Stores all the `(key, value)` pairs in `items`, using a single
+    `set_multi`.
+    '''
+    if not self.batched:
+      return super(MemcachedDatastore, self).put_many(items)
+
+    if isinstance(items, dict):
+      items = items.items()
+
+    mapping = dict((self._service_key(key), value) for key, value in items)
+    if mapping:
+      self._service.set_multi(mapping)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`, using a single `delete_multi`.'''
+    if not self.batched:
+      return super(MemcachedDatastore, self).delete_many(keys)
+
+    keys = map(self._service_key, keys)
+    if keys:
+      self._service.delete_multi(keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object in `keys` exists, using a single
+    `get_multi`.
+    '''
+    return [value is not None for value in self.get_many(keys)]
 
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
@@ -1,5 +1,5 @@
 
-__version__ = '1.2'
+__version__ = '1.3'
 __author__ = 'Juan Batiz-Benet <juan@benet.ai>'
 __doc__ = '''
 MongoDB (pymongo) datastore implementation.
@@ -14,6 +14,8 @@ Tested with:
 import pymongo
 import datastore
 
+from collections import OrderedDict
+
 
 class Doc(object):
   '''Document key constants for datastore documents.'''
@@ -23,12 +25,137 @@ class Doc(object):
   wrapped = '_wrapped'
 
 
-class MongoDatastore(datastore.Datastore):
-  '''Represents a Mongo database as a datastore.'''
+class MongoBulkWriteError(Exception):
+  '''Raised when some of the writes of a batch (`put_many`, `delete_many`)
+  fail. The other writes are still performed.
+
+  Attributes:
+    errors: list of (key, error message) pairs, one per failed write. The key
+        is None for errors not specific to one write (e.g. write concern).
+  '''
+
+  def __init__(self, errors):
+    self.errors = errors
+    super(MongoBulkWriteError, self).__init__(
+      '%d write(s) failed: %s' % (len(errors), errors[:10]))
+
+
+class MongoIndexAdvisor(object):
+  '''Recommends mongodb indexes for the queries observed.
+
+  Each query observed is reduced to the compound index serving it best:
+  its equality fields first, then its sort fields (with their directions),
+  then its range fields (equality, sort, range). Patterns seen at least
+  `threshold` times are recommended.
+
+      >>> advisor = MongoIndexAdvisor(threshold=1)
+      >>> query = Query(Key('/users')).filter('age', '>', 18)
+      >>> advisor.observe('users', query.filter('city', '=', 'NYC'))
+      1
+      >>> advisor.recommendations()
+      [('users', (('city', 1), ('age', 1)), 1)]
+
+  '''
+
+  def __init__(self, threshold=100):
+    self.threshold = int(threshold)
+    self.patterns = {}  # (collection name, index pattern) -> count
+
+  @staticmethod
+  def pattern(query):
+    '''Returns the index pattern, a tuple of (field, direction) pairs, best
+    serving `query`. Returns None if no index would serve it.
+    '''
+    equality = sorted(set(f.field for f in query.filters if f.op == '='))
+    ranges = sorted(set(f.field for f in query.filters if f.op != '='))
+    orders = [(o.field, 1 if o.isAscending() else -1) for o in query.orders]
+
+    pattern = []
+    for field, direction in [(f, 1) for f in equality] + orders + \
+                            [(f, 1) for f in ranges]:
+      field = MongoQuery.field(field)
+      if field not in [f for f, d in pattern]:
+        pattern.append((field, direction))
+
+    # documents are already indexed by key.
+    if not pattern or pattern == [(Doc.key, 1)]:
+      return None
+    return tuple(pattern)
+
+  def observe(self, collection, query):
+    '''Records `query`, run on the collection named `collection`. Returns
+    how many times its pattern was observed, or 0 if it has none.
+    '''
+    pattern = self.pattern(query)
+    if pattern is None:
+      return 0
+
+    count = self.patterns.get((collection, pattern), 0) + 1
+    self.patterns[(collection, pattern)] = count
+    return count
+
+  def recommendations(self, threshold=None):
+    '''Returns the recommended indexes, as (collection name, index pattern,
+    count) tuples, most observed first. Patterns that are prefixes of other
+    recommended patterns are omitted, as those indexes serve both.
+    '''
+    threshold = self.threshold if threshold is None else threshold
+    hot = [(c, p, n) for (c, p), n in self.patterns.items() if n >= threshold]
+
+    def covered(collection, pattern):
+      return any(c == collection and len(p) > len(pattern) and
+                 p[:len(pattern)] == pattern for c, p, n in hot)
 
-  def __init__(self, mongoDatabase):
+    hot = [(c, p, n) for c, p, n in hot if not covered(c, p)]
+    return sorted(hot, key=lambda r: (-r[2], r[0], r[1]))
+
+  def report(self, threshold=None):
+    '''Returns a human-readable report of the recommended indexes.'''
+    lines = []
+    for collection, pattern, count in self.recommendations(threshold):
+      fields = ', '.join('%s: %d' % field for field in pattern)
+      lines.append('%s: {%s} (%d queries)' % (collection, fields, count))
+    return '\n'.join(lines)
+
+
+class MongoDatastore(datastore.Datastore):
+  '''Represents a Mongo database as a datastore.
+
+  Args:
+    mongoDatabase: the pymongo Database to store objects in.
+    count_skipped: whether query cursors count the results their offset
+        skipped (see :py:class:`MongoCursor`).
+    bulk_size: the maximum number of writes per bulk operation sent by
+        `put_many` and `delete_many`.
+    batch_size: the number of documents query cursors fetch per round trip,
+        bounding their memory use. None uses the server's default.
+    auto_index: whether to create the indexes `advisor` recommends, as soon
+        as their patterns reach the advisor's threshold.
+
+  Queries are observed by `advisor` (a :py:class:`MongoIndexAdvisor`), whose
+  `report` lists the indexes that would serve them.
+  '''
+
+  count_skipped = True
+  bulk_size = 1000
+  batch_size = None
+  auto_index = False
+
+  def __init__(self, mongoDatabase, count_skipped=None, bulk_size=None,
+               batch_size=None, auto_index=None, advisor=None):
     self.database = mongoDatabase
     self._indexed = {}
+    self.advisor = advisor or MongoIndexAdvisor()
+
+    if auto_index is not None:
+      self.auto_index = auto_index
+
+    if count_skipped is not None:
+      self.count_skipped = count_skipped
+    if bulk_size is not None:
+      self.bulk_size = int(bulk_size)
+    if batch_size is not None:
+      self.batch_size = int(batch_size)
 
   def _collectionNamed(self, name):
     '''Returns the `collection` named `name`.'''
@@ -54,6 +181,14 @@ class MongoDatastore(datastore.Datastore):
     return name
 
 
+  def _ensureIndex(self, collection, name, pattern):
+    '''Creates the compound index `pattern` on `collection` (named `name`),
+    at most once per run. Does nothing if `pattern` is None.
+    '''
+    if pattern is not None and (name, pattern) not in self._indexed:
+      collection.create_index(list(pattern), background=True)
+      self._indexed[(name, pattern)] = True
+
   def _collection(self, key):
     '''Returns the `collection` corresponding to `key`.'''
     return self._collectionNamed(self._collectionNameForKey(key))
@@ -105,10 +240,103 @@ class MongoDatastore(datastore.Datastore):
     '''Returns whether the object is in this datastore.'''
     return self._collection(key).find( { Doc.key:str(key) } ).count() > 0
 
+  def put_many(self, items):
+    '''Stores the objects, with unordered bulk upserts per collection, of up
+    to `bulk_size` objects each. If a key appears more than once, its last
+    value is stored. Raises MongoBulkWriteError if any writes fail.
+    '''
+    if isinstance(items, dict):
+      items = items.items()
+
+    def upsert(bulk, key, value):
+      strkey = str(key)
+      spec = bulk.find({Doc.key:strkey}).upsert()
+      spec.replace_one(self._wrap(strkey, value))
+
+    self._bulk(OrderedDict(items).items(), upsert)
+
+  def delete_many(self, keys):
+    '''Removes the objects, with unordered bulk removes per collection, of up
+    to `bulk_size` objects each. Raises MongoBulkWriteError if any fail.
+    '''
+    def remove(bulk, key, value):
+      bulk.find({Doc.key:str(key)}).remove()
+
+    keys = OrderedDict.fromkeys(keys)
+    self._bulk(keys.items(), remove)
+
+  def _bulk(self, items, operation):
+    '''Applies `operation(bulk, key, value)` to all `items`, in unordered
+    bulk operations, grouped by collection and chunked by `bulk_size`.
+    '''
+    collections = OrderedDict()
+    for key, value in items:
+      name = self._collectionNameForKey(key)
+      collections.setdefault(name, []).append((key, value))
+
+    errors = []
+    for name, items in collections.items():
+      collection = self._collectionNamed(name)
+      for i in range(0, len(items), self.bulk_size):
+        chunk = items[i:i + self.bulk_size]
+        bulk = collection.initialize_unordered_bulk_op()
+        for key, value in chunk:
+          operation(bulk, key, value)
+        errors.extend(self._execute(bulk, [key for key, value in chunk]))
+
+    if errors:
+      raise MongoBulkWriteError(errors)
+
+  @staticmethod
+  def _execute(bulk, keys):
+    '''Executes `bulk`, returning (key, error message) pairs for the writes
+    that failed. `keys` are those of the writes, in order.
+    '''
+    try:
+      bulk.execute()
+      return []
+    except pymongo.errors.BulkWriteError, e:
+      errors = [(keys[error['index']], error.get('errmsg'))
+                for error in e.details.get('writeErrors', [])]
+      errors.extend((None, error.get('errmsg'))
+                    for error in e.details.get('writeConcernErrors', []))
+      return errors
+
   def query(self, query):
-    '''Returns a sequence of objects matching criteria expressed in `query`'''
-    coll = self._collection(query.key.child('_'))
-    return MongoQuery.translate(coll, query)
+    '''Returns a sequence of objects matching criteria expressed in `query`.
+    Runs as much of it as possible in mongodb (see `explain`).
+    '''
+    name = self._collectionNameForKey(query.key.child('_'))
+    coll = self._collectionNamed(name)
+    plan = self.explain(query)
+
+    # queries without a pattern (count 0) have nothing to index.
+    count = self.advisor.observe(name, plan.pushdown)
+    if self.auto_index and count and count >= self.advisor.threshold:
+      self._ensureIndex(coll, name, self.advisor.pattern(plan.pushdown))
+
+    cursor = MongoQuery.translate(coll, plan.pushdown, self.count_skipped,
+      self.batch_size)
+    if plan.pushdown is query:
+      return cursor
+    return plan(cursor)
+
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run. Filters, orders,
+    offset and limit are translated to mongodb, except for those depending on
+    a custom `object_getattr` (and what must run after them).
+    '''
+    plan = MongoQuery.planner.plan(query)
+    if not plan.residual.filters and not plan.residual.orders:
+      plan = datastore.query.QueryPlan(query, query, scan='native')
+
+    elif query.fields is not None:
+      # the residual filters and orders need their fields too.
+      residual = plan.residual.filters + plan.residual.orders
+      fields = query.fields + [r.field for r in residual]
+      plan.pushdown.project(*OrderedDict.fromkeys(fields))
+
+    return plan
 
 
 
@@ -121,16 +349,64 @@ def unwrapper_gen(iterable):
 
 
 
+class MongoCursor(datastore.Cursor):
+  '''A datastore Cursor over the results of a mongodb cursor.
+
+  Counting the results skipped by the query offset takes a count on the
+  server, so it is only done if, and when, `skipped` is first read (e.g. by
+  :py:meth:`datastore.ShardedDatastore.shard_query_generator`). With
+  `count_skipped` False, it is never done, and `skipped` remains 0.
+  '''
+
+  __slots__ = ('_mongo_cursor', '_skipped', )
+
+  def __init__(self, query, mongo_cursor, count_skipped=True):
+    # make sure to unwrap all retrieved values
+    super(MongoCursor, self).__init__(query, unwrapper_gen(mongo_cursor))
+    self._mongo_cursor = mongo_cursor
+
+    if count_skipped and query.offset > 0:
+      self._skipped = None  # not counted yet.
+
+  @property
+  def skipped(self):
+    '''The number of results skipped by the query offset.'''
+    if self._skipped is None:
+      # the count disregards skip and limit: all the results matching.
+      self._skipped = min(self.query.offset, self._mongo_cursor.count())
+    return self._skipped
+
+  @skipped.setter
+  def skipped(self, value):
+    self._skipped = value
+
+
+
+
 class MongoQuery(object):
   '''Translates queries from dronestore queries to mongodb queries.'''
   operators = { '>':'$gt', '>=':'$gte', '!=':'$ne', '<=':'$lte', '<':'$lt' }
 
+  planner = datastore.query.QueryPlanner(orders=True, offset=True, limit=True)
+  '''Describes which parts of queries mongodb runs.'''
+
   @classmethod
-  def translate(self, collection, query):
-    '''Translate given datastore `query` to a mongodb query on `collection`.'''
+  def translate(self, collection, query, count_skipped=True, batch_size=None):
+    '''Translate given datastore `query` to a mongodb query on `collection`.
+    Returns a :py:class:`MongoCursor`; no request is sent to the server until
+    it is iterated. See MongoCursor for `count_skipped`. The mongodb cursor
+    fetches `batch_size` documents per round trip, if given.
+    '''
 
     # must call find
-    mongo_cursor = collection.find(self.filters(query.filters))
+    spec = self.filters(query.filters)
+    if query.fields is None:
+      mongo_cursor = collection.find(spec)
+    else:
+      mongo_cursor = collection.find(spec, fields=self.fields(query.fields))
+
+    if batch_size:
+      mongo_cursor.batch_size(batch_size)
 
     if len(query.orders) > 0:
       mongo_cursor.sort(self.orders(query.orders))
@@ -138,31 +414,70 @@ class MongoQuery(object):
     if query.offset > 0:
       mongo_cursor.skip(query.offset)
 
-    # must execute before the limit to make sure the counts yield only skipped.
-    skip = mongo_cursor.count() - mongo_cursor.count(with_limit_and_skip=True)
-
     if query.limit:
       mongo_cursor.limit(query.limit)
 
-    # make sure to unwrap all retrieved values
-    iterable = unwrapper_gen(mongo_cursor)
+    # create datastore Cursor with query and mongodb cursor of results
+    return MongoCursor(query, mongo_cursor, count_skipped)
 
-    # create datastore Cursor with query and iterable of results
-    datastore_cursor = datastore.Cursor(query, iterable)
-    datastore_cursor.skipped = skip
-    return datastore_cursor
+  @classmethod
+  def field(cls, field):
+    '''Transform given `field` name into a mongodb document field name.'''
+    return field
 
   @classmethod
   def filter(cls, filter):
     '''Transform given `filter` into a mongodb filter tuple.'''
     if filter.op == '=':
-      return filter.field, filter.value
-    return filter.filter, { cls.operators[filter.op] : filter.value }
+      return cls.field(filter.field), filter.value
+    return cls.field(filter.field), { cls.operators[filter.op] : filter.value }
 
   @classmethod
   def filters(cls, filters):
-    '''Transform given `filters` into a mongodb filter dictionary.'''
-    return dict([cls.filter(f) for f in filters])
+    '''Transform given `filters` into a mongodb filter dictionary.
+
+    Conditions on the same field are combined, e.g. ``age >= 18`` and
+    ``age < 65`` into ``{'age': {'$gte': 18, '$lt': 65}}``. Equality is
+    expressed with ``$in`` when combined. Conditions that cannot be combined
+    (e.g. two ``!=`` on one field) are joined with ``$and``.
+    '''
+    spec = {}
+    clauses = []
+    for f in filters:
+      field, condition = cls.filter(f)
+      if field not in spec:
+        spec[field] = condition
+        continue
+
+      # combine conditions on the same field into one operator dictionary.
+      existing = spec[field]
+      if not cls._isOperators(existing):
+        existing = spec[field] = {'$in': [existing]}
+      if f.op == '=':
+        condition = {'$in': [condition]}
+
+      if set(condition) & set(existing):
+        clauses.append({field: condition})
+      else:
+        existing.update(condition)
+
+    if clauses:
+      spec['$and'] = clauses
+    return spec
+
+  @staticmethod
+  def _isOperators(condition):
+    '''Returns whether `condition` is a dictionary of mongodb operators.'''
+    return isinstance(condition, dict) and len(condition) > 0 and \
+      all(str(key).startswith('$') for key in condition)
+
+  @classmethod
+  def fields(cls, fields):
+    '''Transform given `fields` into a mongodb projection (field list).
+    Includes the fields needed to identify and unwrap documents.
+    '''
+    fields = map(cls.field, fields) + [Doc.key, Doc.value, Doc.wrapped]
+    return sorted(set(fields))
 
   @classmethod
   def orders(cls, orders):
@@ -1,5 +1,5 @@
 
-__version__ = '1.0'
+__version__ = '1.1'
 __author__ = 'Juan Batiz-Benet <juan@benet.ai>'
 __doc__ = '''
 redis datastore implementation.
@@ -14,6 +14,8 @@ Tested with:
 #TODO: Implement TTL (and key configurations)
 
 
+import contextlib
+
 import datastore
 
 
@@ -24,20 +26,45 @@ class RedisDatastore(datastore.ShimDatastore):
   - values must be strings (SerializerShimDatastore)
   - keys should be converted into strings (InterfaceMappingDatastore)
   - `put` calls should be mapped to `set` (InterfaceMappingDatastore)
+
+  Batch operations (`get_many`, `put_many`, `delete_many`, `contains_many`)
+  are sent in a single round trip using `MGET`, `MSET`, a multi-key `DEL` and
+  a pipeline of `EXISTS`, if the client supports them (see `batched`).
+
+  Writes may also be buffered and flushed in a single pipeline::
+
+    with ds.pipelined():
+      for key, value in items:
+        ds.put(key, value)
+
   '''
 
-  def __init__(self, redis, serializer=None):
+  batch_methods = ['mget', 'mset', 'pipeline']
+  '''Client methods required to send batch operations in one round trip.'''
+
+  def __init__(self, redis, serializer=None, pipeline_size=1000):
     '''Initialize the datastore with given redis client `redis`.
 
     Args:
       redis: A redis client to use. Must implement the basic redis
           interface: set, get, delete. This datastore keeps the interface so
           basic in order to work with any redis client (or pool of clients).
+          Clients that also implement mget, mset and pipeline get batched
+          operations.
 
       serializer: An optional value serializer to use instead of the default.
         Serializer must respond to `loads` and `dumps`.
+
+      pipeline_size: The maximum number of buffered writes in `pipelined`
+        mode. Reaching it flushes the buffer early.
     '''
     self._redis = redis
+    self.batched = all(hasattr(redis, m) for m in self.batch_methods)
+    self.pipeline_size = int(pipeline_size)
+
+    # writes buffered while pipelined, as (method name, key, value) tuples.
+    self._pipeline_depth = 0
+    self._pipeline_buffer = []
 
     # use an InterfaceMappingDatastore to access the native redis interface
     mapper = datastore.InterfaceMappingDatastore(redis, put='set', key=str)
@@ -48,6 +75,130 @@ class RedisDatastore(datastore.ShimDatastore):
     # initialize ShimDatastore with serial as our child_datastore
     super(RedisDatastore, self).__init__(serial)
 
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+    Flushes any buffered writes first.
+    '''
+    self.flush()
+    return super(RedisDatastore, self).get(key)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+    While `pipelined`, the write is buffered instead.
+    '''
+    if self._pipeline_depth > 0:
+      value = self.child_datastore.serializedValue(value)
+      self._buffer('set', str(key), value)
+    else:
+      super(RedisDatastore, self).put(key, value)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+    While `pipelined`, the delete is buffered instead.
+    '''
+    if self._pipeline_depth > 0:
+      self._buffer('delete', str(key))
+    else:
+      super(RedisDatastore, self).delete(key)
+
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, using a single `MGET`.'''
+    if not self.batched:
+      return super(RedisDatastore, self).get_many(keys)
+
+    self.flush()
+    keys = map(str, keys)
+    if not keys:
+      return []
+
+    values = self._redis.mget(keys)
+    return map(self.child_datastore.deserializedValue, values)
+
+  def put_many(self, items):
+    '''Stores all the `(key, value)` pairs in `items`, using a single `MSET`.
+    While `pipelined`, the writes are buffered instead.
+    '''
+    if isinstance(items, dict):
+      items = items.items()
+
+    if self._pipeline_depth > 0 or not self.batched:
+      for key, value in items:
+        self.put(key, value)
+      return
+
+    serialized = self.child_datastore.serializedValue
+    mapping = dict((str(key), serialized(value)) for key, value in items)
+    if mapping:
+      self._redis.mset(mapping)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`, using a single multi-key `DEL`.
+    While `pipelined`, the deletes are buffered instead.
+    '''
+    if self._pipeline_depth > 0 or not self.batched:
+      for key in keys:
+        self.delete(key)
+      return
+
+    keys = map(str, keys)
+    if keys:
+      self._redis.delete(*keys)
+
+  def contains_many(self, keys):
+    '''Returns whether each object in `keys` exists, using one pipeline of
+    `EXISTS` commands.
+    '''
+    if not self.batched:
+      return super(RedisDatastore, self).contains_many(keys)
+
+    self.flush()
+    pipe = self._redis.pipeline(transaction=False)
+    for key in keys:
+      pipe.exists(str(key))
+    return map(bool, pipe.execute())
+
+
+  @contextlib.contextmanager
+  def pipelined(self):
+    '''Context manager that buffers `put` and `delete` calls, sending them in
+    a single pipeline round trip on exit (or every `pipeline_size` writes).
+    Reads flush the buffer first, so they always observe buffered writes.
+    May be nested; the outermost context flushes.
+
+    Note that the buffer is per datastore instance, not per thread.
+    '''
+    self._pipeline_depth += 1
+    try:
+      yield self
+    finally:
+      self._pipeline_depth -= 1
+      if self._pipeline_depth == 0:
+        self.flush()
+
+  def flush(self):
+    '''Sends all buffered writes to redis in a single pipeline.'''
+    if not self._pipeline_buffer:
+      return
+
+    ops, self._pipeline_buffer = self._pipeline_buffer, []
+    if not self.batched:
+      for op in ops:
+        getattr(self._redis, op[0])(*op[1:])
+      return
+
+    pipe = self._redis.pipeline(transaction=False)
+    for op in ops:
+      getattr(pipe, op[0])(*op[1:])
+    pipe.execute()
+
+  def _buffer(self, *op):
+    '''Buffers write `op`, flushing if the buffer is full.'''
+    self._pipeline_buffer.append(op)
+    if len(self._pipeline_buffer) >= self.pipeline_size:
+      self.flush()
+
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
 
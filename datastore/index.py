@@ -0,0 +1,228 @@
+
+import bisect
+import itertools
+
+from query import Filter, _object_getattr
+
+
+def _is_standard(filter):
+  '''Returns whether `filter` uses the standard Filter semantics.'''
+  cls = type(filter)
+  return cls.__call__.im_func is Filter.__call__.im_func \
+    and cls.valuePasses.im_func is Filter.valuePasses.im_func
+
+
+class Index(object):
+  '''A secondary index over one field of the objects in a collection.
+
+  Indices map field values to the keys of the objects holding them, and are
+  maintained incrementally: `put` (re)indexes an object, `delete` drops it.
+  Field values are extracted once, when objects are put, so objects changed
+  in place must be put again to be reindexed.
+
+  Filters coerce object values to the class of the filter value before
+  comparing them (see :py:class:`datastore.query.Filter`), whereas indices
+  compare raw values. Thus, an index only serves a filter when every indexed
+  value is already an instance of that class, so results never differ from
+  naively applying the query.
+  '''
+
+  operators = []
+  '''Filter operators this index can serve.'''
+
+  def __init__(self, field, object_getattr=None):
+    self.field = field
+    self.object_getattr = object_getattr or _object_getattr
+
+    self._values = {}   # key -> indexed value
+    self._types = {}    # value type -> number of values of that type
+    self._invalid = set()   # keys whose value could not be indexed
+
+  def __len__(self):
+    return len(self._values) + len(self._invalid)
+
+  def __contains__(self, key):
+    return key in self._values or key in self._invalid
+
+  def put(self, key, obj):
+    '''Indexes `obj`, named by `key`, replacing any previous entry.'''
+    self.delete(key)
+
+    try:
+      value = self.object_getattr(obj, self.field)
+      self._insert(key, value)
+    except Exception:
+      self._invalid.add(key)
+      return
+
+    self._values[key] = value
+    self._types[type(value)] = self._types.get(type(value), 0) + 1
+
+  def delete(self, key):
+    '''Removes the entry of the object named by `key`, if any.'''
+    if key in self._invalid:
+      self._invalid.remove(key)
+      return
+
+    if key not in self._values:
+      return
+
+    value = self._values.pop(key)
+    self._remove(key, value)
+
+    self._types[type(value)] -= 1
+    if self._types[type(value)] == 0:
+      del self._types[type(value)]
+
+  def supports(self, filter):
+    '''Returns whether this index can serve `filter` exactly.'''
+    if filter.field != self.field or filter.op not in self.operators:
+      return False
+
+    if filter.object_getattr is not self.object_getattr \
+      or not _is_standard(filter) or self._invalid:
+      return False
+
+    value_class = filter.value.__class__
+    return all(issubclass(t, value_class) for t in self._types)
+
+  def orders(self, order):
+    '''Returns whether this index yields objects sorted by `order`.'''
+    return False
+
+  def estimate(self, filters):
+    '''Returns the number of keys `lookup(filters)` would return.'''
+    raise NotImplementedError
+
+  def lookup(self, filters):
+    '''Returns the keys of the objects passing all `filters` (which must be
+    supported by this index).
+    '''
+    raise NotImplementedError
+
+  def _insert(self, key, value):
+    raise NotImplementedError
+
+  def _remove(self, key, value):
+    raise NotImplementedError
+
+
+class HashIndex(Index):
+  '''An Index mapping each distinct value to the set of keys holding it.
+  Serves equality filters in O(1), and ``!=`` filters by exclusion.
+  '''
+
+  operators = ['=', '!=']
+
+  def __init__(self, field, object_getattr=None):
+    super(HashIndex, self).__init__(field, object_getattr)
+    self._buckets = {}
+
+  def supports(self, filter):
+    if not super(HashIndex, self).supports(filter):
+      return False
+
+    try:
+      hash(filter.value)
+      return True
+    except TypeError:
+      return False
+
+  def estimate(self, filters):
+    rows = len(self._values)
+    for f in filters:
+      bucket = len(self._buckets.get(f.value, ()))
+      rows = min(rows, bucket if f.op == '=' else len(self._values) - bucket)
+    return rows
+
+  def lookup(self, filters):
+    keys = None
+    for f in sorted(filters, key=lambda f: f.op != '='):
+      bucket = self._buckets.get(f.value, set())
+      if f.op == '=':
+        keys = bucket if keys is None else keys & bucket
+      elif keys is None:
+        keys = set(self._values) - bucket
+      else:
+        keys = keys - bucket
+
+    return list(keys if keys is not None else self._values)
+
+  def _insert(self, key, value):
+    self._buckets.setdefault(value, set()).add(key)
+
+  def _remove(self, key, value):
+    bucket = self._buckets[value]
+    bucket.remove(key)
+    if not bucket:
+      del self._buckets[value]
+
+
+class SortedIndex(Index):
+  '''An Index keeping its entries sorted by value. Serves equality and range
+  filters with binary searches, and yields keys in the order of its field,
+  so it can also serve query orders.
+  '''
+
+  operators = ['<', '<=', '=', '>=', '>']
+
+  def __init__(self, field, object_getattr=None):
+    super(SortedIndex, self).__init__(field, object_getattr)
+    self._sorted_values = []
+    self._sorted_keys = []
+
+  def orders(self, order):
+    '''Returns whether this index yields objects sorted by `order`.'''
+    return order.field == self.field and not self._invalid \
+      and order.object_getattr is self.object_getattr
+
+  def _range(self, filters):
+    '''Returns the [start, end) range of entries passing all `filters`.'''
+    values = self._sorted_values
+    start, end = 0, len(values)
+    for f in filters:
+      if f.op in ['>', '>=']:
+        bound = bisect.bisect_right if f.op == '>' else bisect.bisect_left
+        start = max(start, bound(values, f.value))
+      elif f.op in ['<', '<=']:
+        bound = bisect.bisect_left if f.op == '<' else bisect.bisect_right
+        end = min(end, bound(values, f.value))
+      else:
+        start = max(start, bisect.bisect_left(values, f.value))
+        end = min(end, bisect.bisect_right(values, f.value))
+    return start, max(start, end)
+
+  def estimate(self, filters):
+    start, end = self._range(filters)
+    return end - start
+
+  def lookup(self, filters):
+    start, end = self._range(filters)
+    return self._sorted_keys[start:end]
+
+  def entries(self, filters, descending=False):
+    '''Returns the (value, key) entries passing all `filters`, in order.'''
+    start, end = self._range(filters)
+    values, keys = self._sorted_values[start:end], self._sorted_keys[start:end]
+    if descending:
+      values, keys = reversed(values), reversed(keys)
+    return itertools.izip(values, keys)
+
+  def _position(self, key, value):
+    '''Returns the position of the (`value`, `key`) entry. Entries are sorted
+    by value, then key, so it is found by bisection even among many equal
+    values.
+    '''
+    start = bisect.bisect_left(self._sorted_values, value)
+    end = bisect.bisect_right(self._sorted_values, value, start)
+    return bisect.bisect_left(self._sorted_keys, key, start, end)
+
+  def _insert(self, key, value):
+    index = self._position(key, value)
+    self._sorted_values.insert(index, value)
+    self._sorted_keys.insert(index, key)
+
+  def _remove(self, key, value):
+    index = self._position(key, value)
+    del self._sorted_values[index]
+    del self._sorted_keys[index]
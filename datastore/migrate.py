@@ -0,0 +1,237 @@
+
+import threading
+
+from key import Key
+from query import Query
+from basic import Datastore, ShardedDatastore
+
+
+class MigratingShardedDatastore(Datastore):
+  '''Represents a sharded datastore in transition between two placements.
+
+  When the set of shards changes (e.g. growing from N to M shards), objects
+  must move from the shard the `old` ShardedDatastore placed them in to the
+  shard the `new` one places them in. During this transition window:
+
+    * get      : reads from the new placement, falling back to the old
+    * put      : writes to the new placement, removing any old copy
+    * delete   : deletes from both placements
+    * contains : checks the new placement, then the old
+    * query    : queries every shard of either placement
+
+  Meanwhile, `run` (or `start`, in a background thread) copies objects to
+  their new placement, querying each old shard for every collection in
+  `collections` and moving objects in batches of `batch_size`, pausing
+  `interval` seconds between batches. Once finished, the `new` datastore
+  can be used directly.
+
+  Queries return values, not keys, so `keyfn` must recover the Key of each
+  stored value (e.g. ``lambda value: Key(value['key'])``).
+
+  Shards may appear in both placements; objects already in place stay put.
+
+  '''
+
+  def __init__(self, old, new, collections, keyfn, batch_size=100,
+               interval=0, callback=None):
+    '''Initialize the migration from `old` to `new`.
+
+    Args:
+      old: ShardedDatastore with the current placement.
+      new: ShardedDatastore with the target placement.
+      collections: Keys of the collections to migrate (as used in Queries).
+      keyfn: function returning the Key of a stored value.
+      batch_size: number of objects to move per batch.
+      interval: seconds to pause between batches (throttling).
+      callback: optional function, called with `progress()` after each batch.
+    '''
+    for store in [old, new]:
+      if not isinstance(store, ShardedDatastore):
+        errstr = 'datastores must be of type %s. Got %s.'
+        raise TypeError(errstr % (ShardedDatastore, store))
+
+    self.old = old
+    self.new = new
+    self.collections = map(Key, collections)
+    self.keyfn = keyfn
+    self.batch_size = int(batch_size)
+    self.interval = float(interval)
+    self.callback = callback
+
+    self.scanned = 0
+    self.copied = 0
+    self.shards_done = 0
+    self.finished = False
+
+    # serializes moves with client writes, so stale copies never win.
+    self._lock = threading.RLock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _old_shards(self):
+    '''Returns the distinct shards of the old placement.'''
+    return self._distinct(self.old._stores)
+
+  def _all_shards(self):
+    '''Returns the distinct shards of both placements.'''
+    return self._distinct(self.new._stores + self.old._stores)
+
+  @staticmethod
+  def _distinct(stores):
+    '''Returns `stores` without duplicates (by identity), in order.'''
+    distinct = []
+    for store in stores:
+      if not any(store is other for other in distinct):
+        distinct.append(store)
+    return distinct
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key, from the new placement or the old.'''
+    value = self.new.get(key)
+    if value is None and not self.finished:
+      value = self.old.get(key)
+      # the object may have moved between the two reads.
+      if value is None:
+        value = self.new.get(key)
+    return value
+
+  def put(self, key, value):
+    '''Stores the object in its new placement, removing any old copy.'''
+    with self._lock:
+      self.new.put(key, value)
+      old_shard = self.old.shardDatastore(key)
+      if old_shard is not self.new.shardDatastore(key):
+        old_shard.delete(key)
+
+  def delete(self, key):
+    '''Removes the object from both placements.'''
+    with self._lock:
+      self.new.delete(key)
+      self.old.delete(key)
+
+  def contains(self, key):
+    '''Returns whether the object is in either placement.'''
+    if self.new.contains(key):
+      return True
+    if self.finished:
+      return False
+    # the object may have moved between the two reads.
+    return self.old.contains(key) or self.new.contains(key)
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, from the new placement or the old.
+    Both placements are read in batches.
+    '''
+    keys = list(keys)
+    values = self.new.get_many(keys)
+    missing = [i for i, value in enumerate(values) if value is None]
+    if missing and not self.finished:
+      found = self.old.get_many([keys[i] for i in missing])
+      for i, value in zip(missing, found):
+        values[i] = value
+
+      # objects may have moved between the two reads.
+      missing = [i for i in missing if values[i] is None]
+      if missing:
+        found = self.new.get_many([keys[i] for i in missing])
+        for i, value in zip(missing, found):
+          values[i] = value
+    return values
+
+  def query(self, query):
+    '''Returns a sequence of objects matching criteria expressed in `query`.
+    Queries every shard of either placement. Objects being moved at the time
+    may be returned twice.
+    '''
+    return ShardedDatastore(self._all_shards()).query(query)
+
+  def explain(self, query):
+    '''Returns a QueryPlan describing how `query` would run.'''
+    return ShardedDatastore(self._all_shards()).explain(query)
+
+
+  # Migration
+
+  def progress(self):
+    '''Returns a dict describing the progress of the migration.'''
+    return {
+      'scanned': self.scanned,
+      'copied': self.copied,
+      'shards_done': self.shards_done,
+      'shards_total': len(self._old_shards()),
+      'finished': self.finished,
+    }
+
+  def run(self):
+    '''Moves all objects to their new placement. Blocks until finished, or
+    until `stop` is called. Calling `run` again after a `stop` resumes the
+    migration, as objects already moved are no longer in the old shards.
+    '''
+    self._stop.clear()
+    self.shards_done = 0
+
+    for shard in self._old_shards():
+      for collection in self.collections:
+        batch = []
+        for value in shard.query(Query(collection)):
+          batch.append(value)
+          if len(batch) < self.batch_size:
+            continue
+
+          self._migrate_batch(shard, batch)
+          batch = []
+          if self._stop.wait(self.interval) or self._stop.is_set():
+            return
+
+        self._migrate_batch(shard, batch)
+      self.shards_done += 1
+
+    self.finished = True
+    if self.callback:
+      self.callback(self.progress())
+
+  def _migrate_batch(self, shard, values):
+    '''Moves the objects in `values` out of `shard`, if misplaced.'''
+    keys = map(self.keyfn, values)
+    moving = [key for key in keys if self.new.shardDatastore(key) is not shard]
+
+    if moving:
+      with self._lock:
+        # `values` were read without the lock, so objects may have been
+        # written or deleted since. re-read them: objects gone from `shard`
+        # were deleted, and objects already in the new placement were
+        # written during the migration, so the old copies are stale.
+        current = shard.get_many(moving)
+        present = self.new.contains_many(moving)
+        copies = [(key, value) for key, value, p
+                  in zip(moving, current, present)
+                  if value is not None and not p]
+        self.new.put_many(copies)
+        shard.delete_many(moving)
+      self.copied += len(copies)
+
+    self.scanned += len(values)
+    if self.callback and values:
+      self.callback(self.progress())
+
+  def start(self):
+    '''Runs the migration in a background (daemon) thread.'''
+    if self._thread and self._thread.is_alive():
+      raise RuntimeError('migration already running.')
+
+    self._thread = threading.Thread(target=self.run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    '''Stops a background migration, waiting for the current batch.'''
+    self._stop.set()
+    self.join()
+
+  def join(self, timeout=None):
+    '''Waits for a background migration to finish.'''
+    if self._thread:
+      self._thread.join(timeout)
@@ -1,4 +1,8 @@
 
+import heapq
+import operator
+import itertools
+
 from key import Key
 
 
@@ -58,12 +62,15 @@ def limit_gen(limit, iterable):
   '''A generator that applies a count `limit`.'''
   limit = int(limit)
   assert limit >= 0, 'negative limit'
+  if limit == 0:
+    return
 
+  # stop right after the last item, rather than reading one more.
   for item in iterable:
-    if limit <= 0:
-      break
     yield item
     limit -= 1
+    if limit <= 0:
+      break
 
 
 def offset_gen(offset, iterable, skip_signal=None):
@@ -116,12 +123,12 @@ class Filter(object):
   '''Conditional operators that Filters support.'''
 
   _conditional_cmp = {
-    "<"  : lambda a, b: a < b,
-    "<=" : lambda a, b: a <= b,
-    "="  : lambda a, b: a == b,
-    "!=" : lambda a, b: a != b,
-    ">=" : lambda a, b: a >= b,
-    ">"  : lambda a, b: a > b
+    "<"  : operator.lt,
+    "<=" : operator.le,
+    "="  : operator.eq,
+    "!=" : operator.ne,
+    ">=" : operator.ge,
+    ">"  : operator.gt,
   }
 
 
@@ -179,15 +186,61 @@ class Filter(object):
         yield item
 
   @classmethod
-  def filter(cls, filters, iterable):
-    '''Returns the elements in `iterable` that pass given `filters`'''
+  def compile(cls, filters):
+    '''Returns a predicate function testing whether an object passes all
+    given `filters`, with the same semantics as calling each filter.
+
+    Everything that does not depend on the object (operator functions, value
+    classes to coerce to, how to get the field) is resolved once, here. For
+    example, with the default `object_getattr`, fields that cannot be dict
+    attributes are read from dicts with a single lookup.
+    '''
     if isinstance(filters, Filter):
       filters = [filters]
 
-    for filter in filters:
-      iterable = filter.generator(iterable)
+    tests = []
+    for f in filters:
+      if type(f).__call__.im_func is not Filter.__call__.im_func:
+        tests.append((f, None, None, None, None, None))  # custom __call__
+        continue
+
+      if type(f).valuePasses.im_func is Filter.valuePasses.im_func:
+        op, operand = f._conditional_cmp[f.op], f.value
+      else:
+        op, operand = (lambda value, passes: passes(value)), f.valuePasses
+
+      dict_field = f.object_getattr is _object_getattr \
+        and not hasattr(dict, f.field)
+      tests.append((None, f.object_getattr, f.field, dict_field,
+        f.value.__class__, (op, operand)))
+
+    def predicate(obj):
+      for custom, getter, field, dict_field, value_class, test in tests:
+        if custom is not None:
+          if not custom(obj):
+            return False
+          continue
+
+        if dict_field and type(obj) is dict:
+          value = obj.get(field)
+        else:
+          value = getter(obj, field)
+
+        if not isinstance(value, value_class):
+          value = value_class(value)
 
-    return iterable
+        if not test[0](value, test[1]):
+          return False
+      return True
+
+    return predicate
+
+  @classmethod
+  def filter(cls, filters, iterable):
+    '''Returns the elements in `iterable` that pass given `filters`.
+    All filters are applied in a single pass (see :py:meth:`compile`).
+    '''
+    return itertools.ifilter(cls.compile(filters), iterable)
 
 
 
@@ -278,9 +331,118 @@ class Order(object):
     return cmpfn
 
   @classmethod
-  def sorted(cls, items, orders):
-    '''Returns the elements in `items` sorted according to `orders`'''
-    return sorted(items, cmp=cls.multipleOrderComparison(orders))
+  def multipleOrderKey(cls, orders):
+    '''Returns a key function that extracts the sort key of an item according
+    to `orders`: a tuple of its field values, with descending fields wrapped
+    in :py:class:`Descending` to invert their ordering.
+    '''
+    keyfns = [(o.keyfn, o.isDescending()) for o in orders]
+
+    def keyfn(item):
+      return tuple([Descending(getter(item)) if descending else getter(item)
+                    for getter, descending in keyfns])
+
+    return keyfn
+
+  @classmethod
+  def sorted(cls, items, orders, limit=None):
+    '''Returns the elements in `items` sorted according to `orders`.
+
+    Each element's field values are extracted exactly once (decorate, sort,
+    undecorate), and compared natively. Consecutive orders in the same
+    direction are sorted in one pass; mixed directions take one stable pass
+    per run of same-direction orders, least significant first.
+
+    If `limit` is given, returns only the first `limit` sorted elements,
+    selected with a bounded heap: O(limit) memory and O(n log limit) time.
+    '''
+    if limit is not None:
+      # nsmallest is stable, so this equals sorted(items)[:limit]
+      return heapq.nsmallest(limit, items, key=cls.multipleOrderKey(orders))
+
+    keyfns = [o.keyfn for o in orders]
+    decorated = [tuple([keyfn(item) for keyfn in keyfns]) + (item,)
+                 for item in items]
+
+    # runs of consecutive orders in the same direction: (start, end, desc)
+    runs = []
+    for index, order in enumerate(orders):
+      if runs and runs[-1][2] == order.isDescending():
+        runs[-1][1] = index + 1
+      else:
+        runs.append([index, index + 1, order.isDescending()])
+
+    for start, end, descending in reversed(runs):
+      keyfn = operator.itemgetter(*range(start, end))
+      decorated.sort(key=keyfn, reverse=descending)
+
+    return [d[-1] for d in decorated]
+
+  @classmethod
+  def merged(cls, iterables, orders):
+    '''Generator that merges `iterables`, each already sorted according to
+    `orders`, into one sorted sequence. Only the next element of each iterable
+    is held in memory. Ties are broken by the position of the iterable.
+    '''
+    keyfn = cls.multipleOrderKey(orders)
+    iterators = map(iter, iterables)
+
+    try:
+      heap = []
+      for index, iterator in enumerate(iterators):
+        item = next(iterator, StopIteration)
+        if item is not StopIteration:
+          heap.append((keyfn(item), index, item))
+      heapq.heapify(heap)
+
+      while heap:
+        key, index, item = heap[0]
+        yield item
+
+        item = next(iterators[index], StopIteration)
+        if item is not StopIteration:
+          heapq.heapreplace(heap, (keyfn(item), index, item))
+        else:
+          heapq.heappop(heap)
+
+    finally:
+      # stop any iterators left behind (e.g. when limits are reached).
+      for iterator in iterators:
+        if hasattr(iterator, 'close'):
+          iterator.close()
+
+
+
+class Descending(object):
+  '''Wraps a value, inverting its ordering. Used in sort key tuples to sort
+  some fields in descending order and others in ascending order.
+  '''
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __repr__(self):
+    return 'Descending(%s)' % repr(self.value)
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __le__(self, other):
+    return other.value <= self.value
+
+  def __gt__(self, other):
+    return other.value > self.value
+
+  def __ge__(self, other):
+    return other.value >= self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __ne__(self, other):
+    return self.value != other.value
 
 
 
@@ -329,6 +491,7 @@ class Query(object):
 
     self.filters = []
     self.orders = []
+    self.fields = None
 
     if object_getattr:
       self.object_getattr = object_getattr
@@ -348,9 +511,10 @@ class Query(object):
 
     WARNING: When orders are applied, this function operates on the entire set
              of entities directly, not just iterators/generators. That means
-             the entire result set will be in memory. Datastores with large
-             objects and large query results should translate the Query and
-             perform their own optimizations.
+             the entire result set will be in memory, unless the query has a
+             limit (then only offset + limit entities are kept). Datastores
+             with large objects and large query results should translate the
+             Query and perform their own optimizations.
     '''
 
     cursor = Cursor(self, iterable)
@@ -402,6 +566,23 @@ class Query(object):
     return self # for chaining
 
 
+  def project(self, *fields):
+    '''Restricts the fields of the objects to return to `fields`.
+
+    Projections are a hint: datastores that can (e.g. databases storing
+    documents) may return objects with only these fields, saving the cost of
+    reading and transferring the rest. Others return objects whole. Either
+    way, filters and orders may use any field.
+
+    Returns self for JS-like method chaining::
+
+      query.project('name', 'age').filter('age', '>', 18)
+
+    '''
+    self.fields = list(fields)
+    return self # for chaining
+
+
   def __cmp__(self, other):
     return cmp(self.dict(), other.dict())
 
@@ -418,6 +599,7 @@ class Query(object):
     other.offset = self.offset
     other.filters = self.filters
     other.orders = self.orders
+    other.fields = self.fields
     return other
 
   def dict(self):
@@ -433,6 +615,8 @@ class Query(object):
       d['filter'] = [[f.field, f.op, f.value] for f in self.filters]
     if len(self.orders) > 0:
       d['order'] = [str(o) for o in self.orders]
+    if self.fields is not None:
+      d['fields'] = list(self.fields)
 
     return d
 
@@ -453,12 +637,174 @@ class Query(object):
             filter = Filter(*filter)
           query.filter(filter)
 
+      elif key == 'fields':
+        query.project(*value)
+
       elif key in ['limit', 'offset']:
         setattr(query, key, value)
     return query
 
 
 
+
+class QueryPlan(object):
+  '''Describes how a datastore runs a Query.
+
+  A query is split into two parts: the `pushdown` query, run by the storage
+  backend itself (e.g. with an index, or translated to a native query), and
+  the `residual` query, applied naively on the backend's results. Each part
+  holds some of the query's filters and orders, and the offset and limit.
+
+  Args:
+    query: the Query being planned.
+    pushdown: the Query run by the backend (by default, scanning everything).
+    scan: how the backend finds objects. E.g. 'full' (reading every object in
+          the collection), 'index', 'native' (backend query), or 'merge'
+          (combining the results of `children` plans).
+    index: the name of the index used, if any.
+    rows: the estimated number of objects the backend reads, if known.
+    children: plans of the datastores this one combines (e.g. shards).
+
+  The residual query holds everything the pushdown does not: filters not
+  pushed down, all orders unless they all were, and the offset and limit
+  (or what remains of them, when the pushdown only applied part).
+  '''
+
+  def __init__(self, query, pushdown=None, scan='full', index=None, rows=None,
+               children=None):
+    self.query = query
+    self.pushdown = pushdown or Query(query.key)
+    self.scan = scan
+    self.index = index
+    self.rows = rows
+    self.children = children or []
+    self.residual = self._residual()
+
+  def _residual(self):
+    '''Returns the part of the query the pushdown query does not run.'''
+    query, pushdown = self.query, self.pushdown
+    residual = query.copy()
+
+    residual.filters = [f for f in query.filters
+                        if not any(f is g for g in pushdown.filters)]
+
+    if pushdown.orders == query.orders:
+      residual.orders = []
+
+    residual.offset = query.offset - pushdown.offset
+    if pushdown.limit == query.limit and pushdown.offset == query.offset:
+      residual.limit = None
+
+    return residual
+
+  def __call__(self, iterable):
+    '''Applies the residual query on `iterable`, the pushdown's results.
+    Returns a Cursor for the planned query.
+    '''
+    cursor = self.residual(iterable)
+    cursor.query = self.query
+    return cursor
+
+  def __repr__(self):
+    return 'QueryPlan(%s)' % self.explain()
+
+  def explain(self):
+    '''Returns a dictionary describing this plan: the scan type, index used,
+    estimated rows, and which filters, orders, offset and limit ran in the
+    backend ('pushdown') and which were applied naively ('residual').
+    '''
+    def parts(query):
+      d = query.dict()
+      del d['key']
+      return d
+
+    explanation = {
+      'key': str(self.query.key),
+      'scan': self.scan,
+      'index': self.index,
+      'rows': self.rows,
+      'pushdown': parts(self.pushdown),
+      'residual': parts(self.residual),
+    }
+    if self.children:
+      explanation['children'] = [c.explain() for c in self.children]
+    return explanation
+
+
+
+class QueryPlanner(object):
+  '''Splits queries into the part a backend can run, according to its
+  capabilities, and the residual part, to be applied naively.
+
+  Args:
+    operators: the filter operators the backend evaluates.
+    orders: whether the backend sorts.
+    offset: whether the backend skips results.
+    limit: whether the backend limits results.
+    fields: the fields the backend filters on, or None for any.
+
+  Backends evaluate filters and orders on stored objects directly, so filters
+  and orders using a custom `object_getattr`, and custom Filters, are never
+  pushed down. Orders are only pushed down along with all filters, and offset
+  and limit along with all filters and orders.
+
+    >>> planner = QueryPlanner(operators=['=', '<'], orders=True, limit=True)
+    >>> query = Query(Key('/users'), limit=10, offset=5).order('-age')
+    >>> plan = planner.plan(query.filter('age', '<', 30))
+    >>> plan.pushdown.filters, plan.pushdown.orders, plan.pushdown.limit
+    ([Filter('age', '<', 30)], [Order('-age')], 15)
+    >>> plan.residual.offset, plan.residual.limit
+    (5, 10)
+
+  '''
+
+  def __init__(self, operators=Filter.conditional_operators, orders=False,
+               offset=False, limit=False, fields=None):
+    self.operators = list(operators)
+    self.orders = orders
+    self.offset = offset
+    self.limit = limit
+    self.fields = None if fields is None else set(fields)
+
+  def pushesFilter(self, filter):
+    '''Returns whether the backend can evaluate `filter`.'''
+    cls = type(filter)
+    if self.fields is not None and filter.field not in self.fields:
+      return False
+
+    return filter.op in self.operators \
+      and filter.object_getattr is _object_getattr \
+      and cls.__call__.im_func is Filter.__call__.im_func \
+      and cls.valuePasses.im_func is Filter.valuePasses.im_func
+
+  def pushesOrder(self, order):
+    '''Returns whether the backend can sort by `order`.'''
+    return self.orders and order.object_getattr is _object_getattr
+
+  def plan(self, query, **kwargs):
+    '''Returns the QueryPlan running as much of `query` as possible in the
+    backend. Keyword arguments are passed on to the QueryPlan.
+    '''
+    pushdown = Query(query.key, object_getattr=query.object_getattr)
+    pushdown.filters = filter(self.pushesFilter, query.filters)
+    pushdown.orders = []
+
+    filtered = len(pushdown.filters) == len(query.filters)
+    if filtered and all(map(self.pushesOrder, query.orders)):
+      pushdown.orders = list(query.orders)
+
+    if filtered and pushdown.orders == query.orders:
+      if self.offset:
+        pushdown.offset = query.offset
+      if self.limit and query.limit is not None:
+        # without offset, the backend returns the skipped results too.
+        pushdown.limit = query.limit + query.offset - pushdown.offset
+
+    kwargs.setdefault('scan', 'native')
+    return QueryPlan(query, pushdown, **kwargs)
+
+
+
 def is_iterable(obj):
   return hasattr(obj, '__iter__') or hasattr(obj, '__getitem__')
 
@@ -529,11 +875,17 @@ class Cursor(object):
       self._iterable = Filter.filter(self.query.filters, self._iterable)
 
   def apply_order(self):
-    '''Naively apply query orders.'''
+    '''Naively apply query orders. If the query has a limit, only the first
+    offset + limit ordered elements are kept (see :py:meth:`Order.sorted`).
+    '''
     self._ensure_modification_is_safe()
 
     if len(self.query.orders) > 0:
-      self._iterable = Order.sorted(self._iterable, self.query.orders)
+      limit = None
+      if self.query.limit is not None:
+        limit = self.query.offset + self.query.limit
+
+      self._iterable = Order.sorted(self._iterable, self.query.orders, limit)
       # not a generator :(
 
   def apply_offset(self):
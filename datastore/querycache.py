@@ -0,0 +1,176 @@
+
+import time
+import threading
+import collections
+
+from key import Key
+from query import Cursor, Filter, Order, Query
+from basic import ShimDatastore, _item_pairs
+
+
+def canonical_query(query):
+  '''Returns a canonical (hashable) form of `query`, equal for equivalent
+  queries: those with the same key, orders, offset and limit, and the same
+  filters in any order. Returns None for queries that cannot be described by
+  ``query.dict()`` (custom `object_getattr`, Filters or Orders).
+  '''
+  if query.object_getattr is not Query.object_getattr:
+    return None
+
+  if any(type(f) is not Filter for f in query.filters) or \
+     any(type(o) is not Order for o in query.orders):
+    return None
+
+  d = query.dict()
+  if 'filter' in d:
+    d['filter'] = sorted(d['filter'])
+  return repr(sorted(d.items()))
+
+
+class QueryCacheDatastore(ShimDatastore):
+  '''Represents a Datastore that caches the results of queries.
+
+  Query results are read entirely from the child datastore, and kept in a
+  cache keyed by :py:func:`canonical_query`, holding up to `size` queries,
+  least recently used first out. Equivalent queries then return (a fresh
+  Cursor over) the cached results. Note that the cached objects themselves
+  are shared; they should not be modified.
+
+  Cached results are invalidated by writes through this datastore: `put` and
+  `delete` drop the results of queries over any ancestor of the key written.
+  Writes made directly to the child datastore are not seen; a `ttl` (in
+  seconds) bounds how long results may be stale.
+
+  Args:
+    datastore: a child datastore for the ShimDatastore superclass.
+    size: the maximum number of queries to cache results for.
+    ttl: seconds cached results remain valid, or None for no expiration.
+  '''
+
+  clock = staticmethod(time.time)
+  '''The time function ttls are measured with.'''
+
+  def __init__(self, datastore, size=1000, ttl=None):
+    super(QueryCacheDatastore, self).__init__(datastore)
+    self.size = int(size)
+    self.ttl = ttl
+
+    self.hits = 0
+    self.misses = 0
+
+    self._entries = collections.OrderedDict()  # canonical -> entry
+    self._canonicals = {}   # query key -> canonicals of its entries
+    self._writes = 0        # number of invalidations so far
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def put(self, key, value):
+    '''Stores the object, invalidating cached results including `key`.'''
+    self.child_datastore.put(key, value)
+    self.invalidate(key)
+
+  def delete(self, key):
+    '''Removes the object, invalidating cached results including `key`.'''
+    self.child_datastore.delete(key)
+    self.invalidate(key)
+
+  def put_many(self, items):
+    '''Stores the objects, invalidating cached results including their keys.'''
+    items = _item_pairs(items)
+    self.child_datastore.put_many(items)
+    for key, value in items:
+      self.invalidate(key)
+
+  def delete_many(self, keys):
+    '''Removes the objects, invalidating cached results including `keys`.'''
+    keys = list(keys)
+    self.child_datastore.delete_many(keys)
+    for key in keys:
+      self.invalidate(key)
+
+  def query(self, query):
+    '''Returns a Cursor over the objects matching criteria expressed in
+    `query`, from the cache if possible. The Cursor counts returned and
+    skipped objects as the child datastore's would.
+    '''
+    canonical = canonical_query(query)
+    if canonical is None:
+      return self.child_datastore.query(query)
+
+    with self._lock:
+      entry = self._lookup(canonical)
+      writes = self._writes
+
+    if entry is None:
+      self.misses += 1
+      cursor = self.child_datastore.query(query)
+      results = list(cursor)
+      entry = (query.key, self._expiration(), results, cursor.skipped)
+
+      with self._lock:
+        # results read while writes happened may already be stale.
+        if writes == self._writes:
+          self._insert(canonical, entry)
+    else:
+      self.hits += 1
+
+    cursor = Cursor(query, entry[2])
+    cursor.skipped = entry[3]
+    return cursor
+
+  def invalidate(self, key):
+    '''Drops the cached results of queries over any ancestor of `key`, or
+    over its path (e.g. queries over `/Actor` include `/Actor:JohnCleese`).
+    '''
+    key = Key(key)
+    ancestors = set(str(Key(key.list[:i])) for i in range(1, len(key.list)))
+    ancestors.add(str(key.path))
+
+    with self._lock:
+      self._writes += 1
+      for ancestor in ancestors:
+        for canonical in self._canonicals.pop(ancestor, set()):
+          del self._entries[canonical]
+
+  def clear(self):
+    '''Drops all cached results.'''
+    with self._lock:
+      self._writes += 1
+      self._entries.clear()
+      self._canonicals.clear()
+
+  def _expiration(self):
+    '''Returns the time results read now expire, or None.'''
+    return self.clock() + self.ttl if self.ttl is not None else None
+
+  def _lookup(self, canonical):
+    '''Returns the valid cache entry for `canonical`, or None.'''
+    entry = self._entries.pop(canonical, None)
+    if entry is None:
+      return None
+
+    expiration = entry[1]
+    if expiration is not None and expiration <= self.clock():
+      self._forget(canonical, entry)
+      return None
+
+    self._entries[canonical] = entry  # most recently used, last.
+    return entry
+
+  def _insert(self, canonical, entry):
+    '''Caches `entry`, evicting the least recently used entries.'''
+    self._entries.pop(canonical, None)
+    self._entries[canonical] = entry
+    self._canonicals.setdefault(str(entry[0]), set()).add(canonical)
+
+    while len(self._entries) > self.size:
+      self._forget(*self._entries.popitem(last=False))
+
+  def _forget(self, canonical, entry):
+    '''Removes `canonical` from the canonicals of the key of `entry`.'''
+    canonicals = self._canonicals[str(entry[0])]
+    canonicals.discard(canonical)
+    if not canonicals:
+      del self._canonicals[str(entry[0])]
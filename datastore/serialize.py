@@ -1,7 +1,7 @@
 
 
 import json
-from basic import Datastore, ShimDatastore
+from basic import Datastore, ShimDatastore, _item_pairs
 
 default_serializer = json
 
@@ -193,6 +193,30 @@ class SerializerShimDatastore(ShimDatastore):
     value = self.serializedValue(value)
     self.child_datastore.put(key, value)
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, de-serialized on the way out.
+    The whole batch is retrieved from the ``child_datastore`` at once.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve
+
+    Returns:
+      list of objects (or None)
+    '''
+    values = self.child_datastore.get_many(keys)
+    return map(self.deserializedValue, values)
+
+  def put_many(self, items):
+    '''Stores all the `(key, value)` pairs in `items`, serialized on the way
+    in. The whole batch is stored into the ``child_datastore`` at once.
+
+    Args:
+      items: iterable of (key, value) pairs, or a dict of key -> value.
+    '''
+    items = [(key, self.serializedValue(value))
+             for key, value in _item_pairs(items)]
+    self.child_datastore.put_many(items)
+
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
     De-serializes values on the way out, using a :ref:`deserialized_gen` to
@@ -0,0 +1,93 @@
+
+'''
+FileSystemDatastore benchmarks. Run with:
+
+    python -m datastore.test.bench_filesystem [root] [numobjs] [size] [ms]
+
+Page caches are dropped before each run where possible (as root, on linux),
+so files are read from disk. Otherwise, reads are served from memory. On a
+fast local disk, threads cost more than they save; pass `ms` to add that
+much latency to each read, as network filesystems do.
+
+'''
+
+import sys
+import time
+import shutil
+import subprocess
+
+from datastore import Key, Query
+from datastore.impl.filesystem import FileSystemDatastore
+
+
+def drop_caches():
+  '''Drops the OS page cache. Returns whether it could.'''
+  try:
+    subprocess.call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+      f.write('3\n')
+    return True
+  except (IOError, OSError):
+    return False
+
+
+def timed(name, fn, *args):
+  '''Runs `fn(*args)` on a cold cache, printing and returning the elapsed
+  time.
+  '''
+  cold = drop_caches()
+  start = time.time()
+  fn(*args)
+  elapsed = time.time() - start
+  print '  %-28s %8.3fs%s' % (name, elapsed, '' if cold else ' (warm)')
+  return elapsed
+
+
+class SlowFileSystemDatastore(FileSystemDatastore):
+  '''FileSystemDatastore adding `latency` seconds to each read.'''
+
+  latency = 0
+
+  def _read_object(self, path):
+    time.sleep(self.latency)
+    return super(SlowFileSystemDatastore, self)._read_object(path)
+
+
+def query_all(ds):
+  return list(ds.query(Query(Key('/bench'))))
+
+
+def bench_read_ahead(root, numobjs, size):
+  '''Compares serial and read-ahead reads of `numobjs` objects.'''
+  ds = FileSystemDatastore(root)
+  value = 'x' * size
+  for i in xrange(0, numobjs):
+    ds.put(Key('/bench:%d' % i), value)
+
+  keys = [Key('/bench:%d' % i) for i in xrange(0, numobjs)]
+  print 'reading %d objects of %d bytes' % (numobjs, size)
+
+  for read_ahead in [4, 16]:
+    serial = SlowFileSystemDatastore(root)
+    ahead = SlowFileSystemDatastore(root, read_ahead=read_ahead)
+
+    old = timed('query (serial)', query_all, serial)
+    new = timed('query (read_ahead=%d)' % read_ahead, query_all, ahead)
+    print '  speedup: %.1fx' % (old / new)
+
+    old = timed('get_many (serial)', serial.get_many, keys)
+    new = timed('get_many (read_ahead=%d)' % read_ahead, ahead.get_many, keys)
+    print '  speedup: %.1fx' % (old / new)
+
+
+if __name__ == '__main__':
+  root = sys.argv[1] if len(sys.argv) > 1 else '/tmp/datastore.bench.fs'
+  numobjs = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+  size = int(sys.argv[3]) if len(sys.argv) > 3 else 4096
+  if len(sys.argv) > 4:
+    SlowFileSystemDatastore.latency = float(sys.argv[4]) / 1000
+
+  try:
+    bench_read_ahead(root, numobjs, size)
+  finally:
+    shutil.rmtree(root)
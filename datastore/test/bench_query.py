@@ -0,0 +1,79 @@
+
+'''
+Query engine benchmarks. Run with:
+
+    python -m datastore.test.bench_query [numobjs]
+
+'''
+
+import sys
+import time
+import random
+
+from datastore.query import Filter, Order
+
+
+def timed(name, fn, *args):
+  '''Runs `fn(*args)`, printing and returning the elapsed time.'''
+  start = time.time()
+  fn(*args)
+  elapsed = time.time() - start
+  print '  %-28s %8.3fs' % (name, elapsed)
+  return elapsed
+
+
+def cmp_sorted(objs, orders):
+  '''The cmp-based sort Order.sorted used to perform.'''
+  return sorted(objs, cmp=Order.multipleOrderComparison(orders))
+
+
+def bench_sorted(numobjs):
+  '''Compares cmp-based and decorated sorts on `numobjs` dicts.'''
+  rand = random.Random(0)
+  objs = [{'created': rand.randint(0, 1 << 30), 'score': rand.randint(0, 100),
+    'name': 'name%d' % rand.randint(0, 1000)} for i in xrange(0, numobjs)]
+
+  orderings = [['-created'], ['+score', '-created'], ['-score', '+name']]
+  for ordering in orderings:
+    orders = map(Order, ordering)
+    print 'sorting %d objects by %s' % (numobjs, ' '.join(ordering))
+
+    old = timed('cmp function', cmp_sorted, objs, orders)
+    new = timed('decorate-sort-undecorate', Order.sorted, objs, orders)
+    timed('top 20 (bounded heap)', Order.sorted, objs, orders, 20)
+    print '  speedup: %.1fx' % (old / new)
+
+
+def chained_filter(filters, objs):
+  '''The per-filter generator chain Filter.filter used to build.'''
+  for f in filters:
+    objs = f.generator(objs)
+  return list(objs)
+
+
+def compiled_filter(filters, objs):
+  return list(Filter.filter(filters, objs))
+
+
+def bench_filter(numobjs):
+  '''Compares chained and compiled filters on `numobjs` dicts.'''
+  rand = random.Random(0)
+  objs = [{'age': rand.randint(0, 100), 'score': rand.randint(0, 100),
+    'name': 'name%d' % rand.randint(0, 1000)} for i in xrange(0, numobjs)]
+
+  filtersets = [
+    [Filter('age', '>', 18)],
+    [Filter('age', '>=', 18), Filter('age', '<', 65), Filter('score', '>', 50)],
+  ]
+  for filters in filtersets:
+    print 'filtering %d objects by %s' % (numobjs, map(str, filters))
+
+    old = timed('generator chain', chained_filter, filters, objs)
+    new = timed('compiled predicate', compiled_filter, filters, objs)
+    print '  speedup: %.1fx' % (old / new)
+
+
+if __name__ == '__main__':
+  numobjs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  bench_filter(numobjs)
+  bench_sorted(numobjs)
@@ -1,13 +1,77 @@
 
+import time
 import redis
 import unittest
 import logging
+import threading
 
+from datastore import Key, Query
 from datastore import SerializerShimDatastore
 from datastore.impl.aws import S3BucketDatastore
 from boto.s3.connection import S3Connection
+from boto.exception import S3ResponseError
 from test_basic import TestDatastore
 
+
+class FakeS3Key(object):
+  '''Stands in for a boto s3 Key, in a FakeS3Bucket.'''
+
+  def __init__(self, bucket, name):
+    self.bucket = bucket
+    self.name = name
+
+  def get_contents_as_string(self):
+    return self.bucket.get(self.name)
+
+  def set_contents_from_string(self, value):
+    self.bucket.objects[self.name] = value
+
+  def delete(self):
+    self.bucket.objects.pop(self.name, None)
+
+  def exists(self):
+    return self.name in self.bucket.objects
+
+
+class FakeS3Bucket(object):
+  '''Stands in for a boto s3 Bucket, keeping objects in memory. GETs take
+  `latency` seconds, and are counted.
+  '''
+
+  def __init__(self, latency=0):
+    self.latency = latency
+    self.objects = {}
+    self.gets = 0
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.lock = threading.Lock()
+
+  def new_key(self, name):
+    return FakeS3Key(self, name)
+
+  def list(self, prefix=''):
+    for name, value in sorted(self.objects.items()):
+      if name.startswith(prefix):
+        s3key = FakeS3Key(self, name)
+        s3key.size = len(value)
+        yield s3key
+
+  def get(self, name):
+    with self.lock:
+      self.gets += 1
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    try:
+      time.sleep(self.latency)
+      if name not in self.objects:
+        raise S3ResponseError(404, 'Not Found')
+      return self.objects[name]
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+
+
 class TestS3BucketDatastore(TestDatastore):
 
   s3bucketname = '<aws bucket name>'
@@ -37,5 +101,98 @@ class TestS3BucketDatastore(TestDatastore):
     self.subtest_simple([ser], numelems=20)
 
 
+class TestS3BucketDatastoreFake(TestDatastore):
+
+  def test_simple(self):
+    s1 = S3BucketDatastore(FakeS3Bucket())
+    s2 = S3BucketDatastore(FakeS3Bucket(), concurrency=1)
+    s3 = S3BucketDatastore(FakeS3Bucket(), concurrency=3)
+    stores = map(SerializerShimDatastore, [s1, s2, s3])
+    self.subtest_simple(stores, numelems=100)
+
+  def test_query_collection(self):
+    ds = S3BucketDatastore(FakeS3Bucket())
+    ds.put(Key('/User:1'), 'user')
+    ds.put(Key('/User:1/Comment:1'), 'comment')
+    ds.put(Key('/Users:1'), 'users')
+    self.assertEqual(list(ds.query(Query(Key('/User')))), ['user'])
+
+  def test_concurrent_fetch(self):
+    bucket = FakeS3Bucket(latency=0.02)
+    names = ['/User:%03d' % i for i in range(0, 50)]
+    for name in names:
+      bucket.objects[name] = name
+
+    start = time.time()
+    ds = S3BucketDatastore(bucket, concurrency=10)
+    self.assertEqual(list(ds.query(Query(Key('/User')))), names)
+    self.assertTrue(time.time() - start < 50 * 0.02 / 2)
+    self.assertTrue(1 < bucket.max_in_flight <= 10)
+
+    # objects deleted since listed are skipped.
+    class DeletingS3Bucket(FakeS3Bucket):
+      def list(self, prefix=''):
+        for s3key in FakeS3Bucket.list(self, prefix):
+          self.objects.pop('/User:001', None)
+          yield s3key
+
+    bucket = DeletingS3Bucket()
+    bucket.objects.update(zip(names, names))
+    ds = S3BucketDatastore(bucket, concurrency=10)
+    self.assertEqual(len(list(ds.query(Query(Key('/User'))))), 49)
+
+  def test_early_stop(self):
+    threads = threading.active_count()
+    bucket = FakeS3Bucket(latency=0.01)
+    for i in range(0, 100):
+      bucket.objects['/User:%03d' % i] = str(i)
+
+    ds = S3BucketDatastore(bucket, concurrency=4)
+    cursor = ds.query(Query(Key('/User'), limit=5))
+    self.assertEqual(list(cursor), map(str, range(0, 5)))
+    self.assertTrue(bucket.gets <= 5 + 4)
+
+    for i in range(0, 50):
+      if threading.active_count() <= threads:
+        break
+      time.sleep(0.05)
+    self.assertTrue(threading.active_count() <= threads)
+    self.assertTrue(bucket.gets <= 5 + 4)
+
+  def test_listing_pushdown(self):
+    bucket = FakeS3Bucket()
+    for i in range(0, 100):
+      bucket.objects['/User:%03d' % i] = 'x' * (i % 10)
+
+    ds = S3BucketDatastore(bucket, concurrency=4)
+    k = Key('/User')
+
+    # offset and limit apply on the listing: only 5 objects are fetched.
+    query = Query(k, offset=90, limit=5)
+    self.assertEqual(ds.explain(query).explain()['pushdown'],
+      {'offset': 90, 'limit': 5})
+    cursor = ds.query(query)
+    self.assertEqual(list(cursor), ['x' * i for i in range(0, 5)])
+    self.assertEqual((cursor.skipped, cursor.returned), (90, 5))
+    self.assertEqual(bucket.gets, 5)
+
+    # filters and orders on objects need them all.
+    bucket.gets = 0
+    objects = lambda obj, field: obj
+    query = Query(k, offset=90, limit=5, object_getattr=objects).order('-x')
+    self.assertEqual(len(list(ds.query(query))), 5)
+    self.assertEqual(ds.explain(query).explain()['pushdown'], {})
+    self.assertEqual(bucket.gets, 100)
+
+    # unless on metadata fields, evaluated on the listing.
+    bucket.gets = 0
+    ds = S3BucketDatastore(bucket, concurrency=4, metadata_fields=['size'])
+    query = Query(k, offset=2, limit=5).filter('size', '=', 9)
+    cursor = ds.query(query)
+    self.assertEqual(list(cursor), ['x' * 9] * 5)
+    self.assertEqual(cursor.skipped, 2)
+    self.assertEqual(bucket.gets, 5)
+
+
 if __name__ == '__main__':
   unittest.main()
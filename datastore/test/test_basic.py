@@ -106,6 +106,49 @@ class TestDatastore(unittest.TestCase):
 
     checkLength(0)
 
+  def subtest_batch(self, stores, numelems=1000):
+
+    pkey = Key('/dfadasfdsafdas/')
+    keys = [pkey.child(value) for value in range(0, numelems)]
+    items = [(key, value) for key, value in zip(keys, range(0, numelems))]
+    half = numelems / 2
+
+    for sn in stores:
+      self.assertEqual(sn.get_many([]), [])
+      self.assertEqual(sn.contains_many([]), [])
+      self.assertEqual(sn.get_many(keys), [None] * numelems)
+      self.assertEqual(sn.contains_many(keys), [False] * numelems)
+
+      # only put the first half
+      sn.put_many(items[:half])
+      expected = range(0, half) + [None] * (numelems - half)
+      self.assertEqual(sn.get_many(keys), expected)
+      contained = [value is not None for value in expected]
+      self.assertEqual(sn.contains_many(keys), contained)
+
+      # order of results follows order of keys
+      self.assertEqual(sn.get_many(reversed(keys)), list(reversed(expected)))
+
+      # single-key API sees the batch writes.
+      for key, value in items[:half]:
+        self.assertTrue(sn.contains(key))
+        self.assertEqual(sn.get(key), value)
+
+      # dicts are also accepted
+      sn.put_many(dict(items))
+      self.assertEqual(sn.get_many(keys), range(0, numelems))
+      self.assertEqual(sn.contains_many(keys), [True] * numelems)
+
+      sn.delete_many(keys[:half])
+      expected = [None] * half + range(half, numelems)
+      self.assertEqual(sn.get_many(keys), expected)
+      for key in keys[:half]:
+        self.assertFalse(sn.contains(key))
+
+      sn.delete_many(iter(keys))
+      self.assertEqual(sn.get_many(keys), [None] * numelems)
+      self.assertEqual(sn.contains_many(keys), [False] * numelems)
+
 
 class TestDictionaryDatastore(TestDatastore):
 
@@ -117,6 +160,130 @@ class TestDictionaryDatastore(TestDatastore):
     stores = [s1, s2, s3]
 
     self.subtest_simple(stores)
+    self.subtest_batch(stores)
+
+  def test_indexed(self):
+    # indices on values that cannot be indexed (ints have no fields) are
+    # never used, so queries behave exactly as without them.
+    s1 = datastore.DictDatastore()
+    s1.addIndex('/dfadasfdsafdas', 'age', kind='hash')
+    s1.addIndex('/dfadasfdsafdas', 'name')
+    self.subtest_simple([s1])
+
+  def test_sorted_index(self):
+    from datastore.index import SortedIndex
+    from datastore.query import Filter
+
+    # entries are kept sorted by value, then key, through repeated puts of
+    # few distinct values.
+    index = SortedIndex('flag')
+    keys = [Key('/flags/%d' % i) for i in range(0, 300)]
+    for n in range(0, 3):
+      for i, key in enumerate(keys):
+        index.put(key, {'flag': (i + n) % 2})
+    for key in keys[::3]:
+      index.delete(key)
+
+    entries = list(index.entries([]))
+    self.assertEqual(entries, sorted(entries))
+    self.assertEqual(len(entries), 200)
+    expected = sorted(k for i, k in enumerate(keys) if i % 3 and i % 2 == 0)
+    self.assertEqual(index.lookup([Filter('flag', '=', 0)]), expected)
+
+  def test_index_queries(self):
+    import random
+    from datastore.query import Filter, Order
+
+    rand = random.Random(0)
+    pkey = Key('/people')
+    people = [{'key': str(pkey.child(i)), 'age': rand.randint(0, 50),
+      'city': rand.choice(['nyc', 'sf', 'la']), 'score': rand.random()}
+      for i in range(0, 500)]
+
+    plain = datastore.DictDatastore()
+    indexed = datastore.DictDatastore()
+    indexed.addIndex(pkey, 'city', kind='hash')
+    indexed.addIndex(pkey, 'score')
+    for person in people[:250]:
+      plain.put(Key(person['key']), person)
+      indexed.put(Key(person['key']), person)
+    indexed.addIndex(pkey, 'age')  # indexes existing objects
+    for person in people[250:]:
+      plain.put(Key(person['key']), person)
+      indexed.put(Key(person['key']), person)
+
+    # overwrites and deletes are reflected in the indices.
+    for person in people[:100]:
+      person = dict(person, age=person['age'] + 100)
+      plain.put(Key(person['key']), person)
+      indexed.put(Key(person['key']), person)
+    for person in people[400:]:
+      plain.delete(Key(person['key']))
+      indexed.delete(Key(person['key']))
+
+    self.assertRaises(ValueError, indexed.addIndex, pkey, 'age')
+    self.assertRaises(ValueError, indexed.addIndex, pkey, 'foo', 'btree')
+
+    def check(query, index=None, ordered=False):
+      expected = list(plain.query(query.copy()))
+      result = list(indexed.query(query.copy()))
+      self.assertEqual(sorted(result), sorted(expected))
+      if query.orders:
+        keyfn = Order.multipleOrderKey(query.orders)
+        self.assertEqual(map(keyfn, result), map(keyfn, expected))
+
+      plan = indexed.explain(query)
+      self.assertEqual(plan.scan, 'index' if index else 'full')
+      self.assertEqual(plan.index, index)
+      self.assertEqual(bool(plan.pushdown.orders), ordered)
+      # estimates are exact for single filters.
+      if len(plan.pushdown.filters) == len(query.filters) == 1 \
+        and query.limit is None:
+        self.assertEqual(plan.rows, len(result))
+
+    check(Query(pkey))
+    check(Query(pkey).filter('city', '=', 'sf'), 'city')
+    check(Query(pkey).filter('city', '!=', 'sf'), 'city')
+    check(Query(pkey).filter('city', '=', 'sf').filter('city', '!=', 'sf'),
+      'city')
+    check(Query(pkey).filter('age', '>', 30), 'age')
+    check(Query(pkey).filter('age', '>=', 30).filter('age', '<', 110), 'age')
+    check(Query(pkey).filter('age', '=', 20).filter('city', '=', 'la'), 'age')
+    check(Query(pkey).filter('age', '<=', 3).filter('city', '=', 'la'), 'age')
+    check(Query(pkey).filter('age', '>', 10).order('-score'), 'age')
+    check(Query(pkey).filter('age', '>', 10).order('-age').order('+score'),
+      'age', True)
+    check(Query(pkey, limit=10, offset=5).order('+score'), 'score', True)
+    check(Query(pkey, limit=10).order('-score').filter('city', '=', 'sf'),
+      'city')
+    check(Query(pkey, limit=10).order('+age').order('-score')
+      .filter('score', '>', 0.5), 'score')
+
+    # filters needing coercion, or custom filters, are not served by indices.
+    check(Query(pkey).filter('age', '>', 30.5))
+    check(Query(pkey).filter('age', '>', '30'))
+    class NegatedFilter(Filter):
+      def __call__(self, obj):
+        return not super(NegatedFilter, self).__call__(obj)
+    check(Query(pkey).filter(NegatedFilter('age', '>', 30)))
+
+    # nor are filters and orders using a different object_getattr.
+    getattr = lambda obj, field: obj[field]
+    check(Query(pkey, object_getattr=getattr).filter('age', '>', 30))
+    check(Query(pkey, object_getattr=getattr).order('-age'))
+
+    # mixed value types disable the index, until removed again.
+    mixed = Key('/people/mixed')
+    indexed.put(mixed, {'age': '5', 'city': 'sf', 'score': 0.1})
+    plain.put(mixed, {'age': '5', 'city': 'sf', 'score': 0.1})
+    check(Query(pkey).filter('age', '>', 30))
+    check(Query(pkey).filter('age', '>', 30).order('+age'), 'age', True)
+    indexed.delete(mixed)
+    plain.delete(mixed)
+    check(Query(pkey).filter('age', '>', 30), 'age')
+
+    indexed.removeIndex(pkey, 'age')
+    check(Query(pkey).filter('age', '>', 30))
 
 
 class TestKeyTransformDatastore(TestDatastore):
@@ -129,6 +296,26 @@ class TestKeyTransformDatastore(TestDatastore):
     stores = [s1, s2, s3]
 
     self.subtest_simple(stores)
+    self.subtest_batch(stores)
+
+  def test_reverse_transform_batch(self):
+
+    def transform(key):
+      return key.reverse
+
+    ds = datastore.DictDatastore()
+    kt = datastore.KeyTransformDatastore(ds, keytransform=transform)
+
+    k1 = Key('/a/b/c')
+    k2 = Key('/c/b/a')
+
+    kt.put_many([(k1, 'abc')])
+    self.assertEqual(ds.get_many([k1, k2]), [None, 'abc'])
+    self.assertEqual(kt.get_many([k1, k2]), ['abc', None])
+    self.assertEqual(kt.contains_many([k1, k2]), [True, False])
+
+    kt.delete_many([k1])
+    self.assertEqual(ds.contains_many([k1, k2]), [False, False])
 
   def test_reverse_transform(self):
 
@@ -354,6 +541,41 @@ class TestDatastoreCollection(TestDatastore):
     self.assertFalse(ts.contains(k3))
 
     self.subtest_simple([ts])
+    self.subtest_batch([ts])
+
+  def test_tiered_batch(self):
+
+    s1 = datastore.DictDatastore()
+    s2 = datastore.DictDatastore()
+    s3 = datastore.DictDatastore()
+    ts = datastore.TieredDatastore([s1, s2, s3])
+
+    k1 = Key('1')
+    k2 = Key('2')
+    k3 = Key('3')
+    k4 = Key('4')
+    keys = [k1, k2, k3, k4]
+
+    s1.put(k1, '1')
+    s2.put(k2, '2')
+    s3.put(k3, '3')
+
+    self.assertEqual(ts.contains_many(keys), [True, True, True, False])
+    self.assertEqual(s1.contains_many(keys), [True, False, False, False])
+
+    # found values are added to lower stores only
+    self.assertEqual(ts.get_many(keys), ['1', '2', '3', None])
+    self.assertEqual(s1.get_many(keys), ['1', '2', '3', None])
+    self.assertEqual(s2.get_many(keys), [None, '2', '3', None])
+    self.assertEqual(s3.get_many(keys), [None, None, '3', None])
+
+    ts.put_many([(k4, '4')])
+    for store in [s1, s2, s3]:
+      self.assertEqual(store.get(k4), '4')
+
+    ts.delete_many(keys)
+    for store in [s1, s2, s3, ts]:
+      self.assertEqual(store.contains_many(keys), [False] * 4)
 
   def test_sharded(self, numelems=1000):
 
@@ -472,6 +694,144 @@ class TestDatastoreCollection(TestDatastore):
 
     self.subtest_simple([sharded])
 
+    # batches are split across the correct shards.
+    keys = [Key('/fdasfdfdsafdsafdsa/%d' % value) for value in range(numelems)]
+    sharded.put_many(zip(keys, range(numelems)))
+    for value, key in enumerate(keys):
+      shard = stores[hash(key) % len(stores)]
+      checkFor(key, value, sharded, shard)
+    self.assertEqual(sumlens(stores), numelems)
+    sharded.delete_many(keys)
+    self.assertEqual(sumlens(stores), 0)
+
+    self.subtest_batch([sharded])
+
+  def test_sharded_query(self, numelems=1000):
+
+    def subtest_queries(sharded, reference):
+      k = Key('/fdasfdfdsafdsafdsa')
+      queries = [
+        Query(k),
+        Query(k, limit=10),
+        Query(k, offset=990),
+        Query(k).order('+value'),
+        Query(k).order('-value'),
+        Query(k, limit=20).order('-mod').order('+value'),
+        Query(k, offset=95, limit=10).order('+mod').order('-value'),
+        Query(k, offset=2000).order('+value'),
+        Query(k, limit=5).filter('mod', '=', 3).order('-value'),
+      ]
+
+      for query in queries:
+        result = list(sharded.query(query))
+        expected = list(reference.query(query))
+        if query.orders:
+          self.assertEqual(result, expected)
+        else:
+          self.assertEqual(len(result), len(expected))
+          if query.limit is None and query.offset == 0:
+            self.assertEqual(sorted(result), sorted(expected))
+
+      cursor = sharded.query(Query(k, offset=10, limit=20).order('+value'))
+      self.assertEqual(len(list(cursor)), 20)
+      self.assertEqual(cursor.skipped, 10)
+      self.assertEqual(cursor.returned, 20)
+
+    stores = [datastore.DictDatastore() for i in range(0, 5)]
+    sharded = datastore.ShardedDatastore(stores)
+    reference = datastore.DictDatastore()
+    for value in range(0, numelems):
+      key = Key('/fdasfdfdsafdsafdsa/%d' % value)
+      obj = {'value': value, 'mod': value % 7}
+      sharded.put(key, obj)
+      reference.put(key, obj)
+
+    subtest_queries(sharded, reference)
+
+    # shards run filters and orders, offset and limit apply to the merge.
+    stores[0].addIndex('/fdasfdfdsafdsafdsa', 'mod', kind='hash')
+    query = Query(Key('/fdasfdfdsafdsafdsa'), offset=5, limit=10)
+    query.filter('mod', '=', 3).order('-value')
+    plan = sharded.explain(query)
+    self.assertEqual(plan.scan, 'merge')
+    self.assertEqual(plan.rows, sum(c.rows for c in plan.children))
+    self.assertEqual(plan.explain()['pushdown'],
+      {'filter': [['mod', '=', 3]], 'order': ['-value'], 'limit': 15})
+    self.assertEqual(plan.explain()['residual'], {'offset': 5, 'limit': 10})
+    self.assertEqual([c.scan for c in plan.children], ['index'] + ['full'] * 4)
+    self.assertEqual(plan.children[0].rows, len(list(stores[0].query(
+      Query(Key('/fdasfdfdsafdsafdsa')).filter('mod', '=', 3)))))
+    self.assertEqual(list(sharded.query(query)), list(reference.query(query)))
+
+    sharded.parallel_query = False
+    subtest_queries(sharded, reference)
+
+  def test_consistent_sharded(self, numelems=1000):
+
+    stores = [datastore.DictDatastore() for i in range(0, 5)]
+    names = ['shard%d' % i for i in range(0, 5)]
+    sharded = datastore.ConsistentShardedDatastore(stores, names=names)
+    keys = [Key('/fdasfdfdsafdsafdsa/%d' % value) for value in range(numelems)]
+
+    self.assertRaises(ValueError, datastore.ConsistentShardedDatastore,
+      stores, names=names[:2])
+
+    def placement():
+      return [sharded.name(sharded.shard(key)) for key in keys]
+
+    def checkPlaced():
+      for value, key in enumerate(keys):
+        shard = sharded.shardDatastore(key)
+        for store in sharded._stores:
+          self.assertEqual(store.contains(key), store is shard)
+        self.assertEqual(sharded.get(key), value)
+
+    # placement does not depend on the order of the shards.
+    reordered = datastore.ConsistentShardedDatastore(stores[::-1],
+      names=names[::-1])
+    self.assertEqual(placement(),
+      [reordered.name(reordered.shard(key)) for key in keys])
+
+    sharded.put_many(zip(keys, range(numelems)))
+    checkPlaced()
+    before = placement()
+
+    # appending a shard remaps only keys onto the new shard.
+    s6 = datastore.DictDatastore()
+    sharded.appendDatastore(s6, name='shard5')
+    self.assertRaises(ValueError, sharded.appendDatastore,
+      datastore.DictDatastore(), name='shard5')
+    after = placement()
+    moved = [i for i in range(numelems) if before[i] != after[i]]
+    self.assertTrue(all(after[i] == 'shard5' for i in moved))
+    self.assertTrue(0 < len(moved) < numelems / 3)
+
+    # moving exactly those keys makes the datastore consistent again.
+    for i in moved:
+      stores[names.index(before[i])].delete(keys[i])
+      s6.put(keys[i], i)
+    checkPlaced()
+
+    # removing the shard restores the previous placement.
+    sharded.removeDatastore(s6)
+    self.assertEqual(placement(), before)
+
+    sharded.delete_many(keys)
+    self.subtest_simple([sharded])
+    self.subtest_batch([sharded])
+
+  def test_consistent_sharded_names(self):
+    stores = [datastore.DictDatastore() for i in range(0, 4)]
+    sharded = datastore.ConsistentShardedDatastore(stores[:3])
+    self.assertEqual(map(sharded.name, range(0, 3)), ['0', '1', '2'])
+
+    # default names never clash with those left after a removal.
+    sharded.removeDatastore(stores[1])
+    sharded.appendDatastore(stores[3])
+    self.assertEqual(map(sharded.name, range(0, 3)), ['0', '2', '3'])
+    sharded.insertDatastore(0, stores[1])
+    self.assertEqual(map(sharded.name, range(0, 4)), ['4', '0', '2', '3'])
+
 
 if __name__ == '__main__':
   unittest.main()
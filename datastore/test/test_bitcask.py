@@ -0,0 +1,148 @@
+
+import os
+import shutil
+import unittest
+
+from datastore import Key, Query
+from datastore import serialize
+from datastore.impl import bitcask
+from datastore.impl.bitcask import BitcaskDatastore
+from test_basic import TestDatastore
+
+
+class TestBitcaskDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.bitcask')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+    self.stores = []
+
+  def tearDown(self):
+    for store in self.stores:
+      store.close()
+    shutil.rmtree(self.tmp)
+
+  def open(self, name='0', **kwargs):
+    store = BitcaskDatastore(os.path.join(self.tmp, name), **kwargs)
+    self.stores.append(store)
+    return store
+
+  def segments(self, name='0'):
+    path = os.path.join(self.tmp, name)
+    return sorted(f for f in os.listdir(path) if f.endswith('.data'))
+
+  def test_datastore(self):
+    stores = [self.open('0'), self.open('1', segment_size=1024),
+      self.open('2', segment_size=256, auto_compact=False)]
+    self.subtest_simple(map(serialize.shim, stores), numelems=500)
+    self.subtest_batch(map(serialize.shim, stores), numelems=100)
+
+  def test_reopen(self):
+    bc = self.open(segment_size=512)
+    keys = [Key('/User:%d' % i) for i in range(0, 100)]
+    for key in keys:
+      bc.put(key, str(key))
+    for key in keys[::2]:
+      bc.delete(key)
+    bc.put(keys[1], 'updated')
+    bc.close()
+    self.stores.remove(bc)
+
+    # the index is rebuilt from hint files, and the last segment's records.
+    self.assertTrue(len(self.segments()) > 1)
+    bc = self.open(segment_size=512)
+    self.assertEqual(len(bc), 50)
+    self.assertEqual(bc.get(keys[0]), None)
+    self.assertEqual(bc.get(keys[1]), 'updated')
+    self.assertEqual(bc.get(keys[3]), str(keys[3]))
+    self.assertEqual(sorted(bc.query(Query(Key('/User')))),
+      sorted(['updated'] + map(str, keys[3::2])))
+
+  def test_torn_write(self):
+    bc = self.open()
+    bc.put(Key('/a'), 'a')
+    bc.put(Key('/b'), 'b')
+    path = bc._active.path
+    bc.close()
+    self.stores.remove(bc)
+
+    # simulate a crash halfway through writing the last record.
+    os.remove(path.replace('.data', '.hint'))
+    with open(path, 'r+b') as f:
+      f.truncate(os.path.getsize(path) - 1)
+
+    bc = self.open()
+    self.assertEqual(bc.get(Key('/a')), 'a')
+    self.assertFalse(bc.contains(Key('/b')))
+    bc.put(Key('/b'), 'b2')
+    self.assertEqual(bc.get(Key('/b')), 'b2')
+
+  def test_compact(self):
+    bc = self.open(segment_size=1024, auto_compact=False)
+    keys = [Key('/User:%d' % i) for i in range(0, 50)]
+    for i in range(0, 10):
+      for key in keys:
+        bc.put(key, '%s v%d' % (key, i))
+    for key in keys[:25]:
+      bc.delete(key)
+
+    segments = len(self.segments())
+    self.assertTrue(bc.compact() > 0)
+    self.assertTrue(len(self.segments()) < segments)
+    self.assertEqual(len(bc), 25)
+    for key in keys[25:]:
+      self.assertEqual(bc.get(key), '%s v9' % key)
+
+    # compacted segments survive restarts.
+    bc.close()
+    self.stores.remove(bc)
+    bc = self.open(segment_size=1024)
+    self.assertEqual(len(bc), 25)
+    self.assertEqual(bc.get(keys[0]), None)
+    self.assertEqual(bc.get(keys[-1]), '%s v9' % keys[-1])
+    bc.compact()
+    self.assertEqual(bc.compact(), 0)
+    self.assertEqual(bc.get(keys[-1]), '%s v9' % keys[-1])
+
+  def test_compact_syncs(self):
+    bc = self.open(segment_size=1024, auto_compact=False, sync=False)
+    for i in range(0, 200):
+      bc.put(Key('/User:%d' % (i % 100)), 'value %d' % i)
+
+    events = []
+    fsync, fsync_path = os.fsync, bitcask.fsync_path
+    remove = bitcask._Segment.remove
+    os.fsync = lambda fd: events.append('fsync') or fsync(fd)
+    bitcask.fsync_path = lambda path: events.append(path) or fsync_path(path)
+    bitcask._Segment.remove = lambda segment: \
+      events.append('remove') or remove(segment)
+    self.addCleanup(setattr, os, 'fsync', fsync)
+    self.addCleanup(setattr, bitcask, 'fsync_path', fsync_path)
+    self.addCleanup(setattr, bitcask._Segment, 'remove', remove)
+
+    # new segments and hint files, then the directory, are synced before
+    # any old segment is removed, even without `sync`.
+    self.assertTrue(bc.compact() > 0)
+    first = events.index('remove')
+    self.assertEqual(events[first - 2:first], [bc.root_path, 'fsync'])
+    self.assertTrue(events[:first].count('fsync') >= 3)
+    self.assertFalse('fsync' in events[first:])
+
+  def test_auto_compact(self):
+    bc = self.open(segment_size=1024, compaction_ratio=0.5)
+    key = Key('/User:1')
+    for i in range(0, 1000):
+      bc.put(key, 'value %d' % i)
+    if bc._compaction:
+      bc._compaction.join()
+
+    # one live record, so compaction keeps the segment count low.
+    self.assertTrue(len(self.segments()) < 10)
+    self.assertEqual(bc.get(key), 'value 999')
+    self.assertEqual(len(bc), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,10 +1,13 @@
 
 import os
+import time
 import shutil
 import unittest
+import threading
 
 from datastore.impl import filesystem
 from datastore import serialize
+from datastore import Key, Query
 from test_basic import TestDatastore
 
 
@@ -26,6 +29,283 @@ class TestFileSystemDatastore(TestDatastore):
     dses = map(serialize.shim, fses)
     self.subtest_simple(dses, numelems=500)
 
+  def test_durability(self):
+    modes = filesystem.FileSystemDatastore.durability_modes
+    fses = [filesystem.FileSystemDatastore(os.path.join(self.tmp, mode),
+      durability=mode, group_size=10) for mode in modes]
+    self.subtest_simple(map(serialize.shim, fses), numelems=50)
+
+    self.assertRaises(ValueError, filesystem.FileSystemDatastore, self.tmp,
+      durability='sometimes')
+
+  def test_hashed_layout(self):
+    dirs = [os.path.join(self.tmp, str(i)) for i in range(0, 3)]
+    fses = [filesystem.FileSystemDatastore(d, layout='hashed', fanout_levels=l,
+      fanout_width=w) for d, l, w in zip(dirs, [1, 2, 3], [3, 2, 1])]
+    self.subtest_simple(map(serialize.shim, fses), numelems=200)
+
+    fs = filesystem.FileSystemDatastore(self.tmp, layout='hashed')
+    path = fs.object_path(Key('/User:alice'))
+    parts = os.path.relpath(path, self.tmp).split(os.sep)
+    self.assertEqual(parts[0], 'User')
+    self.assertEqual(parts[-1], 'alice.obj')
+    self.assertEqual(parts[1:3], fs.fanout(os.path.join('User', 'alice')))
+    self.assertTrue(all(len(p) == 2 + len('.fan') for p in parts[1:3]))
+
+    # queries enumerate collections, not their children's collections.
+    for i in range(0, 100):
+      fs.put(Key('/User:%d' % i), str(i))
+    fs.put(Key('/User:1/Comment:1'), 'comment')
+    users = list(fs.query(Query(Key('/User'))))
+    self.assertEqual(sorted(users), sorted(map(str, range(0, 100))))
+    self.assertEqual(list(fs.query(Query(Key('/User:1/Comment')))),
+      ['comment'])
+
+    self.assertRaises(ValueError, filesystem.FileSystemDatastore, self.tmp,
+      layout='hashed', fanout_levels=5, fanout_width=4)
+    self.assertRaises(ValueError, filesystem.FileSystemDatastore, self.tmp,
+      layout='tree')
+
+  def test_migrate_layout(self):
+    flat = filesystem.FileSystemDatastore(self.tmp)
+    hashed = filesystem.FileSystemDatastore(self.tmp, layout='hashed')
+    keys = [Key('/User:%d' % i) for i in range(0, 50)]
+    keys += [Key('/User:1/Comment:%d' % i) for i in range(0, 10)]
+    keys += [Key('/hello')]
+    for key in keys:
+      flat.put(key, str(key))
+
+    def check(ds, moved):
+      self.assertEqual(moved, len(keys))
+      for key in keys:
+        self.assertEqual(ds.get(key), str(key))
+      self.assertEqual(len(list(ds.query(Query(Key('/User:1/Comment'))))), 10)
+
+    check(hashed, filesystem.migrate_layout(flat, hashed))
+    self.assertEqual(flat.get(keys[0]), None)
+    self.assertEqual(len(list(hashed.query(Query(Key('/User'))))), 50)
+    self.assertEqual(filesystem.migrate_layout(hashed, hashed), 0)
+
+    check(flat, filesystem.migrate_layout(hashed, flat))
+    self.assertEqual(hashed.get(keys[0]), None)
+    for directory, dirnames, filenames in os.walk(self.tmp):
+      self.assertFalse(directory.endswith(hashed.fanout_extension))
+
+  def test_query_entries(self):
+    fs = filesystem.FileSystemDatastore(self.tmp)
+    fs.put(Key('/User:1'), 'user')
+    fs.put(Key('/User:1/Comment:1'), 'comment')
+    with open(os.path.join(self.tmp, 'User', 'README'), 'w') as f:
+      f.write('not an object')
+
+    # with and without scandir, only object files are read.
+    scandir = filesystem.scandir
+    self.addCleanup(setattr, filesystem, 'scandir', scandir)
+    for scan in set([scandir, None]):
+      filesystem.scandir = scan
+      self.assertEqual(list(fs.query(Query(Key('/User')))), ['user'])
+      self.assertEqual(list(fs.query(Query(Key('/Missing')))), [])
+
+    self.assertTrue(fs.contains(Key('/User:1')))
+    self.assertFalse(fs.contains(Key('/User:2')))
+    self.assertFalse(fs.contains(Key('/User')))
+    self.assertEqual(fs.get(Key('/User:1/Comment:1/Reply:1')), None)
+    fs.delete(Key('/User:2'))
+
+    os.mkdir(fs.object_path(Key('/User:2')))
+    self.assertRaises(RuntimeError, fs.get, Key('/User:2'))
+
+  def test_read_ahead(self):
+    dirs = [os.path.join(self.tmp, str(i)) for i in range(0, 2)]
+    fses = [filesystem.FileSystemDatastore(dirs[0], read_ahead=4),
+      filesystem.FileSystemDatastore(dirs[1], layout='hashed', read_ahead=1)]
+    self.subtest_simple(map(serialize.shim, fses), numelems=200)
+    self.subtest_batch(map(serialize.shim, fses), numelems=50)
+
+    threads = threading.active_count()
+    fs = filesystem.FileSystemDatastore(self.tmp, read_ahead=4)
+    fs._pool.idle_timeout = 0.2
+    keys = [Key('/User:%d' % i) for i in range(0, 100)]
+    fs.put_many((key, str(key)) for key in keys)
+    self.assertEqual(fs.get_many(keys + [Key('/User:x')]),
+      map(str, keys) + [None])
+    self.assertEqual(fs.get_many(keys[:1]), [str(keys[0])])
+
+    # read-ahead threads are reused across calls.
+    cursor = fs.query(Query(Key('/User'), limit=10))
+    self.assertEqual(len(list(cursor)), 10)
+    self.assertEqual(len(list(fs.query(Query(Key('/User'))))), 100)
+    for i in range(0, 10):
+      fs.get_many(keys[:2])
+      self.assertTrue(threading.active_count() <= threads + 4)
+
+    # and stop once idle.
+    for i in range(0, 50):
+      if threading.active_count() <= threads:
+        break
+      time.sleep(0.05)
+    self.assertTrue(threading.active_count() <= threads)
+
+  def test_mmap_reads(self):
+    fs = filesystem.FileSystemDatastore(self.tmp, mmap_threshold=1024)
+    big, small = Key('/blob:big'), Key('/blob:small')
+    fs.put(big, 'x' * 4096)
+    fs.put(small, 'y' * 10)
+
+    value = fs.get(big)
+    self.assertTrue(isinstance(value, buffer))
+    self.assertEqual(str(value), 'x' * 4096)
+    self.assertEqual(value[10:13], 'xxx')
+    self.assertEqual(fs.get(small), 'y' * 10)
+    self.assertEqual(fs.get(Key('/blob:missing')), None)
+    self.assertEqual(sorted(map(len, fs.query(Query(Key('/blob'))))),
+      [10, 4096])
+
+    # buffers outlive later writes, as those replace the file.
+    fs.put(big, 'z' * 4096)
+    self.assertEqual(str(value), 'x' * 4096)
+    self.assertEqual(str(fs.get(big)), 'z' * 4096)
+
+  def test_get_stream(self):
+    fs = filesystem.FileSystemDatastore(self.tmp)
+    key = Key('/blob:big')
+    fs.put(key, 'x' * 4096)
+
+    stream = fs.get_stream(key)
+    with stream:
+      self.assertEqual(stream.read(100), 'x' * 100)
+      self.assertEqual(len(stream.read()), 3996)
+    self.assertEqual(fs.get_stream(Key('/blob:missing')), None)
+
+  def test_directory_cache(self):
+    fs = filesystem.FileSystemDatastore(self.tmp)
+    fs.put(Key('/a/b'), 'b')
+    self.assertTrue(os.path.join(self.tmp, 'a') in fs._directories)
+
+    # known directories are not checked again.
+    exists = filesystem.os.path.exists
+    checked = []
+    def record(path):
+      checked.append(path)
+      return exists(path)
+
+    filesystem.os.path.exists = record
+    try:
+      fs.put(Key('/a/c'), 'c')
+    finally:
+      filesystem.os.path.exists = exists
+    self.assertEqual(checked, [])
+
+    # directories removed by others are made again.
+    shutil.rmtree(os.path.join(self.tmp, 'a'))
+    fs.put(Key('/a/d'), 'd')
+    self.assertEqual(fs.get(Key('/a/d')), 'd')
+
+  def test_negative_cache(self):
+    fs = filesystem.FileSystemDatastore(self.tmp, negative_cache_size=2)
+    other = filesystem.FileSystemDatastore(self.tmp)
+    a, b, c = Key('/a'), Key('/b'), Key('/c')
+
+    self.assertEqual(fs.get(a), None)
+    self.assertFalse(fs.contains(b))
+    self.assertEqual(fs.get_many([a, b]), [None, None])
+
+    # misses are cached: writes by others are not seen.
+    other.put(a, 'a')
+    other.put(b, 'b')
+    self.assertEqual(fs.get(a), None)
+    self.assertFalse(fs.contains(b))
+
+    # until invalidated by puts, or evicted.
+    fs.put(a, 'a2')
+    self.assertEqual(fs.get(a), 'a2')
+    self.assertFalse(fs.contains(b))
+    self.assertEqual(fs.get(c), None)
+    self.assertEqual(fs.get(Key('/d')), None)
+    self.assertTrue(fs.contains(b))
+
+  def test_atomic_writes(self):
+    fs = filesystem.FileSystemDatastore(self.tmp)
+    key = Key('/people/alice')
+    fs.put(key, 'alice')
+    fs.put(key, 'alice v2')
+    self.assertEqual(fs.get(key), 'alice v2')
+
+    # a failed write leaves the previous object in place.
+    self.assertRaises(TypeError, fs.put, key, object())
+    self.assertEqual(fs.get(key), 'alice v2')
+    self.assertEqual(os.listdir(os.path.join(self.tmp, 'people')),
+      ['alice.obj'])
+
+    # writes in progress are not objects.
+    temporary = fs.object_path(key) + '.0123' + fs.temporary_extension
+    with open(temporary, 'w') as f:
+      f.write('alic')
+    self.assertEqual(list(fs.query(Query(Key('/people')))), ['alice v2'])
+    self.assertTrue(os.path.exists(temporary))
+
+    # but those left behind by crashes are removed once stale.
+    stale = time.time() - fs.stale_temporary_age - 1
+    os.utime(temporary, (stale, stale))
+    self.assertEqual(list(fs.query(Query(Key('/people')))), ['alice v2'])
+    self.assertEqual(os.listdir(os.path.join(self.tmp, 'people')),
+      ['alice.obj'])
+
+  def subtest_syncs(self, **kwargs):
+    '''Returns a datastore, and the paths it syncs.'''
+    synced = []
+    fsync_path = filesystem.fsync_path
+    def record(path):
+      synced.append(path)
+      fsync_path(path)
+
+    filesystem.fsync_path = record
+    self.addCleanup(setattr, filesystem, 'fsync_path', fsync_path)
+    return filesystem.FileSystemDatastore(self.tmp, **kwargs), synced
+
+  def test_fsync(self):
+    fs, synced = self.subtest_syncs(durability='fsync')
+    fs.put(Key('/a/b'), 'b')
+    self.assertEqual(synced, [os.path.join(self.tmp, 'a'), self.tmp])
+
+    del synced[:]
+    fs.put(Key('/a/c'), 'c')
+    fs.delete(Key('/a/c'))
+    self.assertEqual(synced, [os.path.join(self.tmp, 'a')] * 2)
+
+  def test_group_commit(self):
+    fs, synced = self.subtest_syncs(durability='group', group_size=3,
+      group_interval=60)
+    fs.put(Key('/a/b'), 'b')
+    fs.put(Key('/a/c'), 'c')
+    self.assertEqual(synced, [])
+
+    # the third write commits the group: files, then directories.
+    fs.put(Key('/a/d'), 'd')
+    a = os.path.join(self.tmp, 'a')
+    self.assertEqual(sorted(synced[:3]), [fs.object_path(Key('/a/b')),
+      fs.object_path(Key('/a/c')), fs.object_path(Key('/a/d'))])
+    self.assertEqual(sorted(synced[3:]), [self.tmp, a])
+
+    del synced[:]
+    fs.put(Key('/a/b'), 'b2')
+    fs.sync()
+    self.assertEqual(synced, [fs.object_path(Key('/a/b')), a])
+    del synced[:]
+    fs.sync()
+    self.assertEqual(synced, [])
+
+  def test_group_commit_interval(self):
+    fs, synced = self.subtest_syncs(durability='group', group_interval=0.01)
+    fs.put(Key('/a/b'), 'b')
+    for i in range(0, 100):
+      if len(synced) == 3:
+        break
+      time.sleep(0.01)
+    self.assertEqual(synced[0], fs.object_path(Key('/a/b')))
+    self.assertEqual(sorted(synced[1:]), [self.tmp,
+      os.path.join(self.tmp, 'a')])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,75 @@
+
+import unittest
+
+from datastore import Key
+from datastore.util.hashring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+  keys = [Key('/hashring/%d' % i) for i in range(0, 2000)]
+
+  def placement(self, ring):
+    return dict((key, ring.node(key)) for key in self.keys)
+
+  def test_basic(self):
+    ring = HashRing()
+    self.assertEqual(len(ring), 0)
+    self.assertRaises(LookupError, ring.node, self.keys[0])
+
+    ring.add('a')
+    self.assertEqual(len(ring), 1)
+    self.assertTrue('a' in ring)
+    self.assertEqual(set(self.placement(ring).values()), set(['a']))
+    self.assertRaises(ValueError, ring.add, 'a')
+    self.assertRaises(ValueError, ring.add, 'b', 0)
+
+    ring.add('b')
+    ring.add('c')
+    self.assertEqual(ring.nodes, ['a', 'b', 'c'])
+    self.assertEqual(set(self.placement(ring).values()), set(['a', 'b', 'c']))
+
+    # deterministic, and independent of insertion order.
+    other = HashRing(['c', 'a', 'b'])
+    self.assertEqual(self.placement(ring), self.placement(other))
+    self.assertEqual(self.placement(ring), self.placement(ring.copy()))
+
+    ring.remove('b')
+    self.assertEqual(ring.nodes, ['a', 'c'])
+    self.assertRaises(KeyError, ring.remove, 'b')
+
+  def test_minimal_remapping(self):
+    nodes = ['node%d' % i for i in range(0, 10)]
+    ring = HashRing(nodes)
+    before = self.placement(ring)
+
+    # adding a node only moves keys onto the new node.
+    ring.add('node10')
+    after = self.placement(ring)
+    moved = [k for k in self.keys if before[k] != after[k]]
+    self.assertTrue(all(after[k] == 'node10' for k in moved))
+    self.assertTrue(0 < len(moved) < len(self.keys) / 5)
+
+    # removing it moves exactly those keys back.
+    ring.remove('node10')
+    self.assertEqual(self.placement(ring), before)
+
+    # removing another node only moves the keys it had.
+    ring.remove('node3')
+    after = self.placement(ring)
+    moved = [k for k in self.keys if before[k] != after[k]]
+    self.assertTrue(all(before[k] == 'node3' for k in moved))
+    self.assertEqual(len(moved), before.values().count('node3'))
+
+  def test_weights(self):
+    ring = HashRing()
+    ring.add('light', weight=1)
+    ring.add('heavy', weight=4)
+    self.assertEqual(ring.weight('heavy'), 4)
+
+    counts = self.placement(ring).values()
+    self.assertTrue(counts.count('heavy') > 2 * counts.count('light'))
+
+
+if __name__ == '__main__':
+  unittest.main()
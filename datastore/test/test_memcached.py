@@ -2,6 +2,7 @@
 import pylibmc
 import unittest
 
+from datastore import Key
 from datastore.impl.memcached import MemcachedDatastore
 from test_basic import TestDatastore
 
@@ -24,6 +25,76 @@ class TestMemcachedDatastore(TestDatastore):
   def test_memcached(self):
     ms = MemcachedDatastore(self.client)
     self.subtest_simple([ms], numelems=500)
+    self.subtest_batch([ms], numelems=500)
+
+
+
+class FakeMemcached(object):
+  '''In-process pylibmc-style client stand-in that counts round trips.'''
+
+  def __init__(self):
+    self.data = {}
+    self.round_trips = 0
+
+  def get(self, key):
+    self.round_trips += 1
+    return self.data.get(key)
+
+  def set(self, key, value):
+    self.round_trips += 1
+    self.data[key] = value
+    return True
+
+  def delete(self, key):
+    self.round_trips += 1
+    return self.data.pop(key, None) is not None
+
+  def get_multi(self, keys):
+    self.round_trips += 1
+    return dict((k, self.data[k]) for k in keys if k in self.data)
+
+  def set_multi(self, mapping):
+    self.round_trips += 1
+    self.data.update(mapping)
+    return []
+
+  def delete_multi(self, keys):
+    self.round_trips += 1
+    for key in keys:
+      self.data.pop(key, None)
+    return True
+
+
+class TestMemcachedDatastoreBatching(TestDatastore):
+
+  def test_simple(self):
+    self.subtest_simple([MemcachedDatastore(FakeMemcached())], numelems=100)
+    self.subtest_batch([MemcachedDatastore(FakeMemcached())], numelems=100)
+
+  def test_round_trips(self):
+    client = FakeMemcached()
+    ms = MemcachedDatastore(client)
+    keys = [Key('/a/%d' % i) for i in range(0, 100)]
+
+    ms.put_many(zip(keys, range(0, 100)))
+    self.assertEqual(client.round_trips, 1)
+    self.assertEqual(client.data['/a/3'], 3)
+
+    self.assertEqual(ms.get_many(keys), range(0, 100))
+    self.assertEqual(client.round_trips, 2)
+
+    self.assertEqual(ms.contains_many(keys), [True] * 100)
+    self.assertEqual(client.round_trips, 3)
+
+    ms.delete_many(keys[:50])
+    self.assertEqual(client.round_trips, 4)
+    self.assertEqual(ms.get_many(keys), [None] * 50 + range(50, 100))
+
+    # empty batches cost nothing
+    ms.put_many([])
+    ms.delete_many([])
+    self.assertEqual(ms.get_many([]), [])
+    self.assertEqual(client.round_trips, 5)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+
+import unittest
+
+import datastore
+from datastore import Key
+from datastore.migrate import MigratingShardedDatastore
+from test_basic import TestDatastore
+
+
+class TestMigratingShardedDatastore(TestDatastore):
+
+  numelems = 500
+  collection = Key('/migrate')
+
+  def setUp(self):
+    self.stores = [datastore.DictDatastore() for i in range(0, 8)]
+    self.old = datastore.ShardedDatastore(self.stores[:3])
+    self.new = datastore.ConsistentShardedDatastore(self.stores[:5])
+
+    self.keys = [self.collection.child(i) for i in range(0, self.numelems)]
+    for i, key in enumerate(self.keys):
+      self.old.put(key, {'key': str(key), 'value': i})
+
+  def migration(self, **kwargs):
+    keyfn = lambda value: Key(value['key'])
+    return MigratingShardedDatastore(self.old, self.new, [self.collection],
+      keyfn, **kwargs)
+
+  def checkPlacement(self, sharded, keys, values):
+    for key, value in zip(keys, values):
+      shard = sharded.shardDatastore(key)
+      for store in self.stores:
+        if store is shard and value is not None:
+          self.assertEqual(store.get(key)['value'], value)
+        else:
+          self.assertFalse(store.contains(key))
+
+  def test_migration(self):
+    progress = []
+    ms = self.migration(batch_size=64, callback=progress.append)
+    self.assertRaises(TypeError, MigratingShardedDatastore,
+      self.stores[0], self.new, [self.collection], None)
+
+    # reads fall back to the old placement.
+    self.assertFalse(all(self.new.contains_many(self.keys)))
+    for i, key in enumerate(self.keys):
+      self.assertTrue(ms.contains(key))
+      self.assertEqual(ms.get(key)['value'], i)
+    values = [value['value'] for value in ms.get_many(self.keys)]
+    self.assertEqual(values, range(0, self.numelems))
+    self.assertEqual(len(list(ms.query(datastore.Query(self.collection)))),
+      self.numelems)
+
+    # writes during the migration win over old copies.
+    ms.put(self.keys[0], {'key': str(self.keys[0]), 'value': 'new'})
+    ms.delete(self.keys[1])
+
+    ms.run()
+    self.assertTrue(ms.finished)
+    values = ['new', None] + range(2, self.numelems)
+    self.checkPlacement(self.new, self.keys, values)
+
+    p = ms.progress()
+    self.assertTrue(p['finished'])
+    self.assertEqual(p['shards_done'], p['shards_total'])
+    self.assertEqual(p['shards_total'], 3)
+    # objects moved into later old shards are scanned again there.
+    self.assertTrue(p['scanned'] >= self.numelems - 1)
+    self.assertTrue(0 < p['copied'] < self.numelems - 1)
+    self.assertEqual(progress[-1], p)
+    self.assertTrue(len(progress) > self.numelems / 64)
+
+    # once finished, everything is in the new placement.
+    self.assertTrue(all(self.new.contains_many(self.keys[2:])))
+    self.assertEqual(ms.get(self.keys[0])['value'], 'new')
+    self.assertEqual(ms.get(self.keys[1]), None)
+
+  def test_concurrent_delete(self):
+    ms = self.migration(batch_size=10)
+    migrate_batch = ms._migrate_batch
+    deleted = []
+
+    # clients delete the first object of each batch after it was read.
+    def deleting_batch(shard, values):
+      if values:
+        deleted.append(Key(values[0]['key']))
+        ms.delete(deleted[-1])
+      migrate_batch(shard, values)
+    ms._migrate_batch = deleting_batch
+
+    ms.run()
+    self.assertTrue(deleted)
+    values = [None if key in deleted else i for i, key in enumerate(self.keys)]
+    self.checkPlacement(self.new, self.keys, values)
+
+  def test_concurrent_reads(self):
+    ms = self.migration()
+    moved = lambda key: \
+      self.old.shardDatastore(key) is not self.new.shardDatastore(key)
+    key = filter(moved, self.keys)[0]
+    shard = self.old.shardDatastore(key)
+    value = shard.get(key)
+
+    # the object moves after the new placement is read, but before the old.
+    def racing(method):
+      def read(*args):
+        if shard.contains(key):
+          ms._migrate_batch(shard, [value])
+        return method(*args)
+      return read
+
+    for name in ['get', 'contains', 'get_many']:
+      setattr(self.old, name, racing(getattr(datastore.ShardedDatastore,
+        name).__get__(self.old)))
+
+    self.assertEqual(ms.get(key), value)
+    self.old.put(key, value)
+    self.new.delete(key)
+    self.assertTrue(ms.contains(key))
+    self.old.put(key, value)
+    self.new.delete(key)
+    self.assertEqual(ms.get_many([key]), [value])
+
+  def test_background(self):
+    ms = self.migration(batch_size=10)
+    ms.start()
+    ms.join()
+    self.assertTrue(ms.finished)
+    self.checkPlacement(self.new, self.keys, range(0, self.numelems))
+
+  def test_stop_and_resume(self):
+    progress = []
+    ms = self.migration(batch_size=10, interval=0.01, callback=progress.append)
+    ms.start()
+    while not progress:
+      pass
+    ms.stop()
+    self.assertFalse(ms.finished)
+
+    # stopped mid-way, but every object is still reachable.
+    values = [value['value'] for value in ms.get_many(self.keys)]
+    self.assertEqual(values, range(0, self.numelems))
+
+    ms.interval = 0
+    ms.run()
+    self.assertTrue(ms.finished)
+    self.checkPlacement(self.new, self.keys, range(0, self.numelems))
+
+  def test_simple(self):
+    ms = self.migration()
+    ms.delete_many(self.keys)
+    ms.run()
+    self.subtest_simple([ms])
+    self.subtest_batch([ms])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,11 +1,175 @@
 
+import copy
 import pymongo
 import unittest
 
-from datastore.impl.mongo import MongoDatastore
+from datastore import Key, Query
+from datastore import ShardedDatastore
+from datastore.impl.mongo import MongoDatastore, MongoBulkWriteError
+from datastore.impl.mongo import MongoIndexAdvisor
 from test_basic import TestDatastore
 
 
+class FakeMongoCursor(object):
+  '''Stands in for a pymongo Cursor. Records the requests it would send.'''
+
+  operators = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+    '$ne': lambda a, b: a != b,
+    '$in': lambda a, b: a in b,
+  }
+
+  def __init__(self, collection, spec, fields=None):
+    self.collection = collection
+    self.spec = spec or {}
+    self.fields = fields
+    self._sort = []
+    self._skip = 0
+    self._limit = 0
+    self._batch_size = 0
+
+  def sort(self, keys):
+    self._sort = list(keys)
+    return self
+
+  def skip(self, skip):
+    self._skip = skip
+    return self
+
+  def limit(self, limit):
+    self._limit = limit
+    return self
+
+  def batch_size(self, batch_size):
+    self._batch_size = batch_size
+    return self
+
+  def _matches(self, doc, spec=None):
+    for field, condition in (spec or self.spec).items():
+      if field == '$and':
+        if not all(self._matches(doc, clause) for clause in condition):
+          return False
+      elif isinstance(condition, dict):
+        for op, value in condition.items():
+          if field not in doc or not self.operators[op](doc[field], value):
+            return False
+      elif doc.get(field) != condition:
+        return False
+    return True
+
+  def _results(self, with_limit_and_skip):
+    docs = filter(self._matches, self.collection.docs)
+    for field, direction in reversed(self._sort):
+      docs.sort(key=lambda doc: doc.get(field), reverse=direction < 0)
+
+    if with_limit_and_skip:
+      docs = docs[self._skip:]
+      if self._limit:
+        docs = docs[:self._limit]
+
+    if self.fields is not None:
+      docs = [dict((f, doc[f]) for f in self.fields + ['_id'] if f in doc)
+              for doc in docs]
+    return docs
+
+  def count(self, with_limit_and_skip=False):
+    self.collection.requests.append('count')
+    return len(self._results(with_limit_and_skip))
+
+  def __iter__(self):
+    # one request per batch.
+    docs = copy.deepcopy(self._results(True))
+    batch_size = self._batch_size or max(len(docs), 1)
+    for i in range(0, max(len(docs), 1), batch_size):
+      self.collection.requests.append('find')
+      for doc in docs[i:i + batch_size]:
+        yield doc
+
+
+class FakeMongoBulk(object):
+  '''Stands in for a pymongo BulkOperationBuilder (unordered).'''
+
+  def __init__(self, collection):
+    self.collection = collection
+    self.operations = []
+
+  def find(self, spec):
+    bulk = self
+
+    class Selector(object):
+      def upsert(self):
+        return self
+      def replace_one(self, doc):
+        bulk.operations.append((spec, doc))
+      def remove(self):
+        bulk.operations.append((spec, None))
+
+    return Selector()
+
+  def execute(self):
+    self.collection.requests.append('bulk')
+    errors = []
+    for index, (spec, doc) in enumerate(self.operations):
+      if spec.get('key') in self.collection.failing:
+        errors.append({'index': index, 'errmsg': 'failed %s' % spec['key']})
+      elif doc is None:
+        self.collection.remove(spec, request=False)
+      else:
+        self.collection.update(spec, doc, request=False)
+
+    if errors:
+      raise pymongo.errors.BulkWriteError({'writeErrors': errors})
+
+
+class FakeMongoCollection(object):
+  '''Stands in for a pymongo Collection, holding documents in a list.'''
+
+  def __init__(self):
+    self.docs = []
+    self.requests = []
+    self.failing = set()  # keys of documents whose writes fail
+    self.indexes = []
+
+  def initialize_unordered_bulk_op(self):
+    return FakeMongoBulk(self)
+
+  def create_index(self, key, **kwargs):
+    if key != 'key':
+      self.indexes.append(key)
+
+  def find(self, spec=None, fields=None):
+    return FakeMongoCursor(self, spec, fields)
+
+  def find_one(self, spec):
+    self.requests.append('find_one')
+    docs = FakeMongoCursor(self, spec)._results(True)
+    return copy.deepcopy(docs[0]) if docs else None
+
+  def update(self, spec, doc, upsert=False, safe=False, request=True):
+    if request:
+      self.requests.append('update')
+    self.remove(spec, request=False)
+    self.docs.append(copy.deepcopy(doc))
+    self.docs[-1]['_id'] = len(self.docs)
+
+  def remove(self, spec, request=True):
+    if request:
+      self.requests.append('remove')
+    matches = FakeMongoCursor(self, spec)._matches
+    self.docs = [doc for doc in self.docs if not matches(doc)]
+
+
+class FakeMongoDatabase(dict):
+  '''Stands in for a pymongo Database, holding FakeMongoCollections.'''
+
+  def __missing__(self, name):
+    self[name] = FakeMongoCollection()
+    return self[name]
+
+
 class TestMongoDatastore(TestDatastore):
 
   def setUp(self):
@@ -21,5 +185,226 @@ class TestMongoDatastore(TestDatastore):
     self.subtest_simple([ms], numelems=500)
 
 
+class TestMongoDatastoreRequests(TestDatastore):
+
+  def setUp(self):
+    self.database = FakeMongoDatabase()
+    self.ms = MongoDatastore(self.database)
+
+    self.key = Key('/people')
+    for i in range(0, 20):
+      doc = {'key': str(self.key.child(i)), 'age': i % 5, 'index': i}
+      self.ms.put(self.key.child(i), doc)
+
+    self.requests = self.ms._collection(self.key.child('_')).requests
+    del self.requests[:]
+
+  def test_fake(self):
+    ms = MongoDatastore(FakeMongoDatabase())
+    self.subtest_simple([ms], numelems=100)
+    self.subtest_batch([ms], numelems=100)
+
+  def test_bulk_writes(self):
+    database = FakeMongoDatabase()
+    ms = MongoDatastore(database, bulk_size=10)
+    people = [(self.key.child(i), {'index': i}) for i in range(0, 25)]
+    animals = [(Key('/animals/%d' % i), i) for i in range(0, 5)]
+
+    ms.put_many(people + animals)
+    self.assertEqual(database['people'].requests, ['bulk'] * 3)
+    self.assertEqual(database['animals'].requests, ['bulk'])
+    self.assertEqual(ms.get_many([key for key, value in people + animals]),
+      [value for key, value in people + animals])
+
+    # the last value of repeated keys is stored.
+    ms.put_many([(self.key.child(1), 'a'), (self.key.child(1), 'b')])
+    self.assertEqual(ms.get(self.key.child(1)), 'b')
+
+    ms.delete_many(key for key, value in people[:15] + animals)
+    self.assertEqual(database['people'].requests.count('bulk'), 6)
+    self.assertEqual(len(database['people'].docs), 10)
+    self.assertEqual(len(database['animals'].docs), 0)
+
+  def test_bulk_write_errors(self):
+    database = FakeMongoDatabase()
+    ms = MongoDatastore(database, bulk_size=10)
+    items = [(self.key.child(i), i) for i in range(0, 25)]
+    failing = [self.key.child(3), self.key.child(17)]
+    database['people'].failing = set(map(str, failing))
+
+    try:
+      ms.put_many(items)
+      self.fail('put_many should have raised MongoBulkWriteError.')
+    except MongoBulkWriteError, e:
+      self.assertEqual([key for key, message in e.errors], failing)
+      self.assertEqual(e.errors[0][1], 'failed /people/3')
+
+    # every other write was performed.
+    expected = [None if key in failing else value for key, value in items]
+    self.assertEqual(ms.get_many([key for key, value in items]), expected)
+
+    self.assertRaises(MongoBulkWriteError, ms.delete_many, failing)
+
+  def test_lazy_skipped(self):
+    query = Query(self.key, offset=2, limit=4).filter('age', '=', 2)
+    cursor = self.ms.query(query)
+    self.assertEqual(self.requests, [])
+
+    results = list(cursor)
+    self.assertEqual(sorted(doc['index'] for doc in results), [12, 17])
+    self.assertEqual(self.requests, ['find'])
+    self.assertEqual(cursor.returned, 2)
+
+    self.assertEqual(cursor.skipped, 2)
+    self.assertEqual(cursor.skipped, 2)
+    self.assertEqual(self.requests, ['find', 'count'])
+
+    # only 4 objects have age 2, so an offset of 5 skips just 4.
+    del self.requests[:]
+    cursor = self.ms.query(Query(self.key, offset=5).filter('age', '=', 2))
+    self.assertEqual(list(cursor), [])
+    self.assertEqual(cursor.skipped, 4)
+    self.assertEqual(self.requests, ['find', 'count'])
+
+    # without offset, nothing is counted.
+    del self.requests[:]
+    cursor = self.ms.query(Query(self.key, limit=4))
+    self.assertEqual(len(list(cursor)), 4)
+    self.assertEqual(cursor.skipped, 0)
+    self.assertEqual(self.requests, ['find'])
+
+  def test_count_skipped_disabled(self):
+    ms = MongoDatastore(self.database, count_skipped=False)
+    cursor = ms.query(Query(self.key, offset=15))
+    self.assertEqual(len(list(cursor)), 5)
+    self.assertEqual(cursor.skipped, 0)
+    self.assertEqual(self.requests, ['find'])
+
+  def test_sharded_offsets(self):
+    # shard_query_generator reads skipped to carry offsets across shards.
+    other = MongoDatastore(FakeMongoDatabase())
+    sharded = ShardedDatastore([self.ms, other])
+    sharded.parallel_query = False
+    for i in range(20, 30):
+      doc = {'key': str(self.key.child(i)), 'age': i % 5, 'index': i}
+      other.put(self.key.child(i), doc)
+
+    results = list(sharded.query(Query(self.key, offset=25, limit=3)))
+    self.assertEqual(len(results), 3)
+    self.assertTrue(all(doc['index'] >= 20 for doc in results))
+    self.assertEqual(self.requests, ['find', 'count'])
+
+  def test_filters(self):
+    k = self.key
+    queries = [
+      Query(k).filter('age', '>', 2),
+      Query(k).filter('age', '>=', 2).filter('age', '<', 4),
+      Query(k).filter('age', '<=', 2).filter('index', '>', 5),
+      Query(k).filter('age', '!=', 2).filter('age', '!=', 3),
+      Query(k).filter('age', '=', 2).filter('age', '!=', 3),
+      Query(k).filter('age', '=', 2).filter('age', '=', 3),
+      Query(k).filter('age', '!=', 1).filter('age', '=', 2),
+      Query(k).filter('age', '>', 0).filter('age', '>', 3),
+      Query(k, limit=3, offset=2).filter('age', '<', 4).order('-index'),
+      Query(k).order('+age').order('-index'),
+    ]
+
+    objs = [self.ms.get(k.child(i)) for i in range(0, 20)]
+    for query in queries:
+      plan = self.ms.explain(query)
+      self.assertEqual(plan.residual.dict(), {'key': '/people'})
+      expected = list(query(objs))
+      result = list(self.ms.query(query))
+      if query.orders:
+        self.assertEqual(result, expected)
+      else:
+        self.assertEqual(sorted(result), sorted(expected))
+
+  def test_projection(self):
+    query = Query(self.key).filter('age', '>', 2).project('index')
+    results = list(self.ms.query(query))
+    self.assertEqual(len(results), 8)
+    self.assertTrue(all(sorted(doc) == ['index', 'key'] for doc in results))
+
+    # residual filters and orders keep the fields they need.
+    getattr = lambda obj, field: obj[field]
+    query = Query(self.key, object_getattr=getattr).project('index')
+    query.filter('age', '>', 2).order('-age')
+    plan = self.ms.explain(query)
+    self.assertEqual(plan.pushdown.fields, ['index', 'age'])
+    results = list(self.ms.query(query))
+    self.assertEqual([doc['age'] for doc in results], [4] * 4 + [3] * 4)
+    self.assertTrue(all(sorted(doc) == ['age', 'index', 'key']
+                        for doc in results))
+
+    # wrapped (non-document) values are returned whole.
+    self.ms.put(Key('/people/wrapped'), 'value')
+    results = list(self.ms.query(Query(self.key).project('age')))
+    self.assertTrue('value' in results)
+
+  def test_batch_size(self):
+    ms = MongoDatastore(self.database, batch_size=6)
+    self.assertEqual(len(list(ms.query(Query(self.key)))), 20)
+    self.assertEqual(self.requests, ['find'] * 4)
+
+  def test_index_advisor(self):
+    pattern = MongoIndexAdvisor.pattern
+    k = self.key
+    self.assertEqual(pattern(Query(k)), None)
+    self.assertEqual(pattern(Query(k).order('key')), None)
+    self.assertEqual(pattern(Query(k).filter('age', '>', 1)), (('age', 1),))
+    self.assertEqual(pattern(Query(k).filter('age', '>', 1).order('-index')
+      .filter('name', '=', 'a').filter('city', '=', 'b')),
+      (('city', 1), ('name', 1), ('index', -1), ('age', 1)))
+    self.assertEqual(pattern(Query(k).filter('age', '=', 1).order('-age')),
+      (('age', 1),))
+
+    advisor = MongoIndexAdvisor(threshold=3)
+    ms = MongoDatastore(self.database, advisor=advisor)
+    for i in range(0, 5):
+      list(ms.query(Query(k).filter('age', '=', 1).order('-index')))
+    for i in range(0, 3):
+      list(ms.query(Query(k).filter('age', '=', 1)))
+      list(ms.query(Query(k).filter('index', '>', 1)))
+    for i in range(0, 2):
+      list(ms.query(Query(k).filter('name', '<', 'b')))
+    list(ms.query(Query(Key('/animals')).filter('legs', '=', 4)))
+
+    # (age) is a prefix of (age, -index), whose index would serve both.
+    self.assertEqual(advisor.recommendations(), [
+      ('people', (('age', 1), ('index', -1)), 5),
+      ('people', (('index', 1),), 3),
+    ])
+    self.assertEqual(len(advisor.recommendations(threshold=1)), 4)
+    self.assertEqual(advisor.report(), '\n'.join([
+      'people: {age: 1, index: -1} (5 queries)',
+      'people: {index: 1} (3 queries)',
+    ]))
+
+    # recommendations only, unless asked to create indexes.
+    self.assertEqual(self.database['people'].indexes, [])
+
+  def test_auto_index(self):
+    ms = MongoDatastore(self.database, auto_index=True,
+      advisor=MongoIndexAdvisor(threshold=2))
+    query = Query(self.key).filter('age', '>', 1).order('-index')
+    list(ms.query(query))
+    self.assertEqual(self.database['people'].indexes, [])
+
+    for i in range(0, 3):
+      list(ms.query(query))
+    self.assertEqual(self.database['people'].indexes,
+      [[('index', -1), ('age', 1)]])
+
+    # with threshold 0, patterns are indexed eagerly; queries without one
+    # (unfiltered and unordered) are not.
+    ms = MongoDatastore(self.database, auto_index=True,
+      advisor=MongoIndexAdvisor(threshold=0))
+    list(ms.query(Query(self.key)))
+    list(ms.query(Query(self.key).filter('age', '=', 3)))
+    self.assertEqual(self.database['people'].indexes,
+      [[('index', -1), ('age', 1)], [('age', 1)]])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,11 +1,13 @@
 import time
+import random
 import datetime
 import unittest
 import hashlib
 import nanotime
 
 from datastore.key import Key
-from datastore.query import Filter, Order, Query, Cursor
+from datastore.query import Filter, Order, Descending, Query, Cursor
+from datastore.query import QueryPlan, QueryPlanner
 
 
 
@@ -219,6 +221,72 @@ class TestFilter(unittest.TestCase):
     self.assertFilter(feqt3, vs, [v3])
 
 
+  def test_compile(self):
+    # compiled predicates must match calling each filter.
+    rand = random.Random(42)
+
+    class Obj(object):
+      def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    dicts = [{'a': rand.randint(0, 10), 'b': str(rand.randint(0, 10)),
+      'values': i} for i in range(0, 200)]
+    objs = [Obj(**d) for d in dicts]
+
+    filtersets = [
+      [Filter('a', '>', 5)],
+      [Filter('a', '>=', 2), Filter('a', '<', 8)],
+      [Filter('a', '!=', 3), Filter('b', '=', '4')],
+      [Filter('b', '>', 5)],     # coerces values to the filter value class
+      [Filter('a', '<=', '5')],
+      [],
+    ]
+
+    for filters in filtersets:
+      for items in [dicts, objs]:
+        expected = [i for i in items if all(f(i) for f in filters)]
+        self.assertEqual(list(Filter.filter(filters, items)), expected)
+        predicate = Filter.compile(filters)
+        self.assertEqual([i for i in items if predicate(i)], expected)
+
+    # dict attributes take precedence over items, in both.
+    f = Filter('values', '<', 100)
+    self.assertRaises(TypeError, f, dicts[0])
+    self.assertRaises(TypeError, list, Filter.filter(f, dicts))
+    self.assertEqual(list(Filter.filter(f, objs)), objs[:100])
+
+    # custom object_getattr
+    f = Filter('a', '>', 5)
+    f.object_getattr = lambda obj, field: obj['b']
+    expected = [d for d in dicts if int(d['b']) > 5]
+    self.assertEqual(list(Filter.filter(f, dicts)), expected)
+
+    # subclasses overriding __call__ or valuePasses are honored.
+    class Even(Filter):
+      def __call__(self, obj):
+        return obj['a'] % 2 == 0
+
+    class Odd(Filter):
+      def valuePasses(self, value):
+        return value % 2 == 1
+
+    expected = [d for d in dicts if d['a'] % 2 == 0 and d['a'] > 2]
+    filters = [Even('a', '=', 0), Filter('a', '>', 2)]
+    self.assertEqual(list(Filter.filter(filters, dicts)), expected)
+
+    expected = [d for d in dicts if d['a'] % 2 == 1]
+    self.assertEqual(list(Filter.filter(Odd('a', '=', 0), dicts)), expected)
+
+    # as are subclasses with their own operators, compiled through Filter.
+    class Divides(Filter):
+      conditional_operators = Filter.conditional_operators + ['%']
+      _conditional_cmp = dict(Filter._conditional_cmp)
+      _conditional_cmp['%'] = lambda value, divisor: value % divisor == 0
+
+    expected = [d for d in dicts if d['a'] % 3 == 0]
+    predicate = Filter.compile([Divides('a', '%', 3)])
+    self.assertEqual([d for d in dicts if predicate(d)], expected)
+
   def test_object(self):
     t1 = nanotime.now()
     t2 = nanotime.now()
@@ -312,6 +380,68 @@ class TestOrder(unittest.TestCase):
     self.assertEqual(Order.sorted([v1, v2, v3], [o3, o2, o1]), [v3, v2, v1])
     self.assertEqual(Order.sorted([v1, v2, v3], [o3, o1, o2]), [v3, v2, v1])
 
+    # test sorted with limit
+    self.assertEqual(Order.sorted([v3, v1, v2], [o2], 2), [v1, v2])
+    self.assertEqual(Order.sorted([v3, v1, v2], [o3], 1), [v3])
+    self.assertEqual(Order.sorted([v3, v1, v2], [o3], 0), [])
+    self.assertEqual(Order.sorted([v3, v1, v2], [o2], 10), [v1, v2, v3])
+    self.assertEqual(Order.sorted([v1, v3, v2], [o1], 2), [v1, v3])
+
+
+  def test_sorted_equivalence(self):
+    # decorated sorts must match the cmp-based sort exactly (incl. stability)
+    rand = random.Random(42)
+    objs = [{'a': rand.randint(0, 5), 'b': rand.choice('xyz'), 'c': i}
+      for i in range(0, 500)]
+    rand.shuffle(objs)
+
+    orderings = [['+a'], ['-a'], ['+a', '+b'], ['-a', '-b'], ['+a', '-b'],
+      ['-a', '+b', '-c'], ['-b', '-a', '+c'], ['+b', '-a']]
+
+    for ordering in orderings:
+      orders = map(Order, ordering)
+      cmpfn = Order.multipleOrderComparison(orders)
+      expected = sorted(objs, cmp=cmpfn)
+      self.assertEqual(Order.sorted(objs, orders), expected)
+      self.assertEqual(Order.sorted(objs, orders, 50), expected[:50])
+      self.assertEqual(sorted(objs, key=Order.multipleOrderKey(orders)),
+        expected)
+
+  def test_descending(self):
+    self.assertTrue(Descending(2) < Descending(1))
+    self.assertTrue(Descending(1) > Descending(2))
+    self.assertTrue(Descending(1) <= Descending(1))
+    self.assertTrue(Descending(1) >= Descending(1))
+    self.assertTrue(Descending(1) == Descending(1))
+    self.assertTrue(Descending(1) != Descending(2))
+    self.assertTrue((1, Descending('b')) < (1, Descending('a')))
+    self.assertTrue((0, Descending('a')) < (1, Descending('b')))
+
+  def test_merged(self):
+    o1 = Order('+a')
+    o2 = Order('-b')
+
+    objs = [{'a': i % 4, 'b': i} for i in range(0, 40)]
+    parts = [Order.sorted(objs[i::3], [o1, o2]) for i in range(0, 3)]
+    merged = Order.merged(parts, [o1, o2])
+    self.assertEqual(list(merged), Order.sorted(objs, [o1, o2]))
+
+    self.assertEqual(list(Order.merged([], [o1])), [])
+    self.assertEqual(list(Order.merged([[], objs[:1], []], [o1])), objs[:1])
+
+    # abandoning the merge closes the merged iterators.
+    closed = []
+    def gen(items):
+      try:
+        for item in items:
+          yield item
+      finally:
+        closed.append(True)
+
+    merged = Order.merged([gen(part) for part in parts], [o1, o2])
+    merged.next()
+    merged.close()
+    self.assertEqual(closed, [True] * 3)
 
   def test_object(self):
     self.assertEqual(Order('key'), eval(repr(Order('key'))))
@@ -355,11 +485,13 @@ class TestQuery(unittest.TestCase):
 
     q2.order('key')
     q2.order('-created')
+    q2.project('key', 'created')
 
     q1d = {'key': '/', 'limit':100, 'offset':300, \
       'filter': [['key', '>', '/ABC'], ['created', '>', now]] }
 
-    q2d = {'key': '/', 'offset':200, 'order': ['+key', '-created'] }
+    q2d = {'key': '/', 'offset':200, 'order': ['+key', '-created'],
+      'fields': ['key', 'created'] }
 
     q3d = {'key': '/', 'limit':1}
 
@@ -379,6 +511,10 @@ class TestQuery(unittest.TestCase):
     self.assertEqual(q2, q2.copy())
     self.assertEqual(q3, q3.copy())
 
+    # projections are hints; naive queries return whole objects.
+    objs = [{'key': i, 'created': i, 'other': i} for i in range(0, 10)]
+    self.assertEqual(list(Query(Key('/')).project('key')(objs)), objs)
+
 
   def test_cursor(self):
 
@@ -431,6 +567,15 @@ class TestQuery(unittest.TestCase):
 
     self.subtest_cursor(Query(k).order('+committed'), vs, [v1, v2, v3])
     self.subtest_cursor(Query(k).order('-created'), vs, [v3, v2, v1])
+    self.subtest_cursor(Query(k, limit=2).order('-created'), vs, [v3, v2])
+    self.subtest_cursor(Query(k, limit=1, offset=1).order('-created'), vs, [v2])
+    self.subtest_cursor(Query(k, limit=5, offset=2).order('+created'), vs, [v3])
+
+    objs = [{'a': i % 10, 'b': i} for i in range(0, 1000)]
+    q = Query(k, offset=15, limit=20).order('-a').order('+b')
+    expected = Order.sorted(objs, q.orders)[15:35]
+    self.subtest_cursor(q, objs, expected)
+    self.subtest_cursor(q, iter(objs), expected)
 
 
   def subtest_cursor(self, query, iterable, expected_results):
@@ -467,5 +612,91 @@ class TestQuery(unittest.TestCase):
       self.assertTrue(cursor.returned <= query.limit)
 
 
+class TestQueryPlan(unittest.TestCase):
+
+  objs = [{'key': '/obj/%d' % i, 'a': i % 7, 'b': i} for i in range(0, 100)]
+
+  def check(self, planner, query, pushdown):
+    plan = planner.plan(query)
+    self.assertEqual(plan.pushdown.dict(), pushdown.dict())
+
+    # running the pushdown (e.g. in a backend), then the residual, is
+    # equivalent to running the whole query.
+    results = list(plan(list(plan.pushdown(self.objs))))
+    self.assertEqual(results, list(query(self.objs)))
+    self.assertTrue(plan(self.objs).query is query)
+    return plan
+
+  def test_plan(self):
+    k = Key('/obj')
+    none = QueryPlanner(operators=[])
+    filters = QueryPlanner(operators=['=', '>'])
+    everything = QueryPlanner(orders=True, offset=True, limit=True)
+    nooffset = QueryPlanner(orders=True, limit=True)
+
+    q = Query(k, limit=5, offset=3).filter('a', '>', 2).order('-b')
+    self.check(none, q, Query(k))
+    self.check(filters, q, Query(k).filter('a', '>', 2))
+    self.check(everything, q, q)
+    self.check(nooffset, q, Query(k, limit=8).filter('a', '>', 2).order('-b'))
+
+    q = Query(k, limit=5, offset=3).filter('a', '>', 2).filter('a', '<', 5)
+    self.check(filters, q, Query(k).filter('a', '>', 2))
+    self.check(everything, q, q)
+    self.check(nooffset, q, Query(k, limit=8).filter('a', '>', 2)
+      .filter('a', '<', 5))
+
+    # orders are not pushed without all filters, nor limits without orders.
+    q = Query(k, limit=5).filter('a', '<', 5).order('-b')
+    self.check(QueryPlanner(operators=['>'], orders=True, limit=True), q,
+      Query(k))
+    self.check(QueryPlanner(limit=True), q, Query(k).filter('a', '<', 5))
+
+    # nor offsets or limits without all filters, even when unordered.
+    q = Query(k, limit=5, offset=3).filter('a', '<', 5)
+    self.check(QueryPlanner(operators=['>'], offset=True, limit=True), q,
+      Query(k))
+
+    # filters on other fields than the backend's are not pushed.
+    q = Query(k, limit=5).filter('a', '>', 2).filter('b', '>', 10)
+    self.check(QueryPlanner(limit=True, fields=['b']), q,
+      Query(k).filter('b', '>', 10))
+    self.check(QueryPlanner(limit=True, fields=['a', 'b']), q, q)
+
+    # custom filters and getters are never pushed.
+    class OddFilter(Filter):
+      def valuePasses(self, value):
+        return value % 2 == 1
+    q = Query(k).filter(OddFilter('b', '=', 0)).order('+a')
+    self.check(everything, q, Query(k))
+    q = Query(k, object_getattr=lambda obj, field: obj[field])
+    q.filter('a', '=', 1).order('-b')
+    self.check(everything, q, Query(k))
+
+  def test_explain(self):
+    k = Key('/obj')
+    q = Query(k, limit=5).filter('a', '>', 2).filter('b', '>', 10).order('-b')
+    plan = QueryPlanner(operators=['>']).plan(q, rows=20, index='a')
+    self.assertEqual(plan.explain(), {
+      'key': '/obj',
+      'scan': 'native',
+      'index': 'a',
+      'rows': 20,
+      'pushdown': {'filter': [['a', '>', 2], ['b', '>', 10]]},
+      'residual': {'order': ['-b'], 'limit': 5},
+    })
+
+    full = QueryPlan(q)
+    self.assertEqual(full.explain()['scan'], 'full')
+    residual = q.dict()
+    del residual['key']
+    self.assertEqual(full.explain()['residual'], residual)
+
+    merged = QueryPlan(q, q, 'merge', children=[plan, full])
+    self.assertEqual(merged.explain()['residual'], {})
+    self.assertEqual(merged.explain()['children'],
+      [plan.explain(), full.explain()])
+
+
 if __name__ == '__main__':
   unittest.main()
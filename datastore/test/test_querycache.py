@@ -0,0 +1,139 @@
+
+import unittest
+
+import datastore
+from datastore import Key
+from datastore import Query
+from datastore.query import Filter
+from datastore.querycache import QueryCacheDatastore, canonical_query
+from test_basic import TestDatastore
+
+
+class CountingDatastore(datastore.DictDatastore):
+  '''DictDatastore counting the queries it runs.'''
+
+  def __init__(self):
+    super(CountingDatastore, self).__init__()
+    self.queries = 0
+
+  def query(self, query):
+    self.queries += 1
+    return super(CountingDatastore, self).query(query)
+
+
+class TestQueryCacheDatastore(TestDatastore):
+
+  def test_simple(self):
+    s1 = QueryCacheDatastore(datastore.DictDatastore())
+    s2 = QueryCacheDatastore(datastore.DictDatastore(), size=2)
+    s3 = QueryCacheDatastore(datastore.DictDatastore(), ttl=0)
+    self.subtest_simple([s1, s2, s3])
+    self.subtest_batch([s1, s2, s3])
+
+  def test_canonical(self):
+    k = Key('/people')
+    q1 = Query(k, limit=10).filter('age', '>', 18).filter('name', '=', 'a')
+    q2 = Query(k, limit=10).filter('name', '=', 'a').filter('age', '>', 18)
+    self.assertEqual(canonical_query(q1), canonical_query(q2))
+    self.assertNotEqual(canonical_query(q1), canonical_query(q2.order('+a')))
+    self.assertNotEqual(canonical_query(q1),
+      canonical_query(Query(k, limit=10).filter('age', '>', 18)))
+
+    class CustomFilter(Filter):
+      pass
+    self.assertEqual(canonical_query(
+      Query(k).filter(CustomFilter('age', '>', 18))), None)
+    self.assertEqual(canonical_query(
+      Query(k, object_getattr=lambda obj, field: obj[field])), None)
+
+  def test_cache(self):
+    child = CountingDatastore()
+    ds = QueryCacheDatastore(child, size=3)
+    people = Key('/people')
+    for i in range(0, 20):
+      ds.put(people.child(i), {'age': i})
+
+    def query(offset=0, limit=None):
+      return Query(people, offset=offset, limit=limit).order('-age')
+
+    def check(query, expected, queries):
+      cursor = ds.query(query)
+      self.assertEqual([o['age'] for o in cursor], expected)
+      self.assertEqual(cursor.skipped, query.offset)
+      self.assertEqual(cursor.returned, len(expected))
+      self.assertTrue(cursor.query is query)
+      self.assertEqual(child.queries, queries)
+
+    check(query(5, 3), [14, 13, 12], 1)
+    check(query(5, 3), [14, 13, 12], 1)
+    self.assertEqual((ds.hits, ds.misses), (1, 1))
+
+    # writes to other collections do not invalidate.
+    ds.put(Key('/animals/cat'), {'age': 3})
+    ds.delete(Key('/animals/dog'))
+    check(query(5, 3), [14, 13, 12], 1)
+
+    # writes within the collection do.
+    ds.put(people.child(20), {'age': 20})
+    check(query(5, 3), [15, 14, 13], 2)
+    ds.delete(people.child(20))
+    check(query(5, 3), [14, 13, 12], 3)
+    ds.put_many([(people.child(20), {'age': 20})])
+    check(query(5, 3), [15, 14, 13], 4)
+    ds.delete_many([people.child(20)])
+    check(query(5, 3), [14, 13, 12], 5)
+
+    # least recently used results are evicted first.
+    check(query(0, 1), [19], 6)
+    check(query(0, 2), [19, 18], 7)
+    check(query(5, 3), [14, 13, 12], 7)
+    check(query(0, 3), [19, 18, 17], 8)
+    self.assertEqual(len(ds), 3)
+    check(query(5, 3), [14, 13, 12], 8)
+    check(query(0, 1), [19], 9)
+
+    ds.clear()
+    self.assertEqual(len(ds), 0)
+    check(query(0, 1), [19], 10)
+
+    # uncacheable queries always hit the child datastore.
+    q = Query(people, object_getattr=lambda obj, field: obj[field])
+    self.assertEqual(len(list(ds.query(q))), 20)
+    self.assertEqual(len(list(ds.query(q))), 20)
+    self.assertEqual(child.queries, 12)
+
+  def test_typed_keys(self):
+    child = CountingDatastore()
+    ds = QueryCacheDatastore(child)
+    query = Query(Key('/Comedy/Actor'))
+
+    ds.put(Key('/Comedy/Actor:JohnCleese'), 'John Cleese')
+    self.assertEqual(list(ds.query(query)), ['John Cleese'])
+    ds.put(Key('/Comedy/Actor:EricIdle'), 'Eric Idle')
+    self.assertEqual(len(list(ds.query(query))), 2)
+    self.assertEqual(child.queries, 2)
+
+  def test_ttl(self):
+    now = [1000.0]
+    child = CountingDatastore()
+    ds = QueryCacheDatastore(child, ttl=10)
+    ds.clock = lambda: now[0]
+
+    ds.put(Key('/people/a'), 'a')
+    child.put(Key('/people/b'), 'b')  # not seen by the cache.
+
+    query = Query(Key('/people'))
+    self.assertEqual(len(list(ds.query(query))), 2)
+    child.delete(Key('/people/b'))
+    now[0] += 9
+    self.assertEqual(len(list(ds.query(query))), 2)
+    self.assertEqual(child.queries, 1)
+
+    now[0] += 1
+    self.assertEqual(len(list(ds.query(query))), 1)
+    self.assertEqual(child.queries, 2)
+    self.assertEqual(len(ds), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
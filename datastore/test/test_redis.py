@@ -2,6 +2,7 @@
 import redis
 import unittest
 
+from datastore import Key
 from datastore.impl.redis import RedisDatastore
 from test_basic import TestDatastore
 
@@ -21,6 +22,143 @@ class TestRedisDatastore(TestDatastore):
   def test_redis(self):
     rds = RedisDatastore(self.client)
     self.subtest_simple([rds], numelems=500)
+    self.subtest_batch([rds], numelems=500)
+
+
+
+class FakeRedis(object):
+  '''In-process redis client stand-in that counts round trips.'''
+
+  def __init__(self):
+    self.data = {}
+    self.round_trips = 0
+
+  def get(self, key):
+    self.round_trips += 1
+    return self.data.get(key)
+
+  def set(self, key, value):
+    self.round_trips += 1
+    self.data[key] = value
+
+  def delete(self, *keys):
+    self.round_trips += 1
+    for key in keys:
+      self.data.pop(key, None)
+
+  def exists(self, key):
+    self.round_trips += 1
+    return key in self.data
+
+  def mget(self, keys):
+    self.round_trips += 1
+    return [self.data.get(key) for key in keys]
+
+  def mset(self, mapping):
+    self.round_trips += 1
+    self.data.update(mapping)
+
+  def pipeline(self, transaction=True):
+    return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline(object):
+  '''Buffers commands for a FakeRedis, executing them in one round trip.'''
+
+  def __init__(self, client):
+    self.client = client
+    self.commands = []
+
+  def __getattr__(self, name):
+    return lambda *args: self.commands.append((name, args))
+
+  def execute(self):
+    # like redis-py, empty pipelines are not sent.
+    results = []
+    for name, args in self.commands:
+      results.append(getattr(self.client, name)(*args))
+    self.client.round_trips -= max(len(self.commands) - 1, 0)
+    self.commands = []
+    return results
+
+
+class TestRedisDatastoreBatching(TestDatastore):
+
+  def test_simple(self):
+    self.subtest_simple([RedisDatastore(FakeRedis())], numelems=100)
+    self.subtest_batch([RedisDatastore(FakeRedis())], numelems=100)
+
+  def test_round_trips(self):
+    client = FakeRedis()
+    rds = RedisDatastore(client)
+    keys = [Key('/a/%d' % i) for i in range(0, 100)]
+
+    rds.put_many(zip(keys, range(0, 100)))
+    self.assertEqual(client.round_trips, 1)
+
+    self.assertEqual(rds.get_many(keys), range(0, 100))
+    self.assertEqual(client.round_trips, 2)
+
+    self.assertEqual(rds.contains_many(keys), [True] * 100)
+    self.assertEqual(client.round_trips, 3)
+
+    rds.delete_many(keys)
+    self.assertEqual(client.round_trips, 4)
+    self.assertEqual(client.data, {})
+
+    # empty batches cost nothing
+    rds.put_many([])
+    rds.delete_many([])
+    self.assertEqual(rds.get_many([]), [])
+    self.assertEqual(rds.contains_many([]), [])
+    self.assertEqual(client.round_trips, 4)
+
+  def test_pipelined(self):
+    client = FakeRedis()
+    rds = RedisDatastore(client, pipeline_size=50)
+    keys = [Key('/a/%d' % i) for i in range(0, 100)]
+
+    with rds.pipelined():
+      for value, key in enumerate(keys[:40]):
+        rds.put(key, value)
+      rds.delete(keys[0])
+      self.assertEqual(client.round_trips, 0)
+
+      with rds.pipelined():
+        rds.put_many(zip(keys[40:], range(40, 100)))
+      # 101 buffered writes: reached pipeline_size twice, nested exit does
+      # not flush the remaining one.
+      self.assertEqual(client.round_trips, 2)
+    self.assertEqual(client.round_trips, 3)
+
+    self.assertEqual(rds.get_many(keys), [None] + range(1, 100))
+
+    # reads flush buffered writes first.
+    with rds.pipelined():
+      rds.put(keys[0], 'a')
+      self.assertEqual(rds.get(keys[0]), 'a')
+      rds.delete(keys[0])
+      self.assertFalse(rds.contains(keys[0]))
+
+  def test_unbatched_client(self):
+
+    class BasicRedis(object):
+      def __init__(self):
+        self.data = {}
+      def get(self, key):
+        return self.data.get(key)
+      def set(self, key, value):
+        self.data[key] = value
+      def delete(self, key):
+        self.data.pop(key, None)
+
+    rds = RedisDatastore(BasicRedis())
+    self.assertFalse(rds.batched)
+    self.subtest_batch([rds], numelems=100)
+
+    with rds.pipelined():
+      rds.put(Key('/a'), 'a')
+    self.assertEqual(rds.get(Key('/a')), 'a')
 
 
 if __name__ == '__main__':
@@ -84,8 +84,17 @@ class TestSerialize(TestDatastore):
       self.assertFalse(shim.contains(key))
       self.assertEqual(shim.get(key), None)
 
+    # batch operations serialize and deserialize every value.
+    keys = [datastore.Key(value['value']) for value in values_raw]
+    shim.put_many(zip(keys, values_raw))
+    self.assertEqual(shim.get_many(keys), values_raw)
+    self.assertEqual(shim.child_datastore.get_many(keys), values_serial)
+    shim.delete_many(keys)
+    self.assertEqual(shim.get_many(keys), [None] * numelems)
+
     if serializer is not bson: # bson can't handle non mapping types
       self.subtest_simple([shim], numelems)
+      self.subtest_batch([shim], numelems)
 
   def test_serializer_shim(self):
 
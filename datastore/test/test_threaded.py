@@ -0,0 +1,150 @@
+
+import time
+import unittest
+import threading
+
+from datastore.util.threaded import parallel_gen, map_gen, WorkerPool
+
+
+class TestThreaded(unittest.TestCase):
+
+  def assertThreadsStop(self, count):
+    for i in range(0, 50):
+      if threading.active_count() <= count:
+        return
+      time.sleep(0.05)
+    self.assertEqual(threading.active_count(), count)
+
+  def test_parallel(self):
+    threads = threading.active_count()
+
+    def slow(values):
+      for value in values:
+        time.sleep(0.001)
+        yield value
+
+    fns = [lambda i=i: slow(range(i * 100, (i + 1) * 100)) for i in range(5)]
+    self.assertEqual(list(parallel_gen(fns, buffer_size=10)), range(0, 500))
+    self.assertEqual(list(parallel_gen([])), [])
+    self.assertThreadsStop(threads)
+
+    # combine controls how the iterators are consumed.
+    def interleave(iterators):
+      for n in range(0, 5):
+        for iterator in iterators:
+          yield iterator.next()
+
+    result = list(parallel_gen(fns, interleave))
+    self.assertEqual(result[:5], [0, 100, 200, 300, 400])
+    self.assertThreadsStop(threads)
+
+    # abandoning the generator stops the producers.
+    gen = parallel_gen(fns, buffer_size=10)
+    self.assertEqual(gen.next(), 0)
+    self.assertEqual(threading.active_count(), threads + 5)
+    del gen
+    self.assertThreadsStop(threads)
+
+  def test_errors(self):
+    threads = threading.active_count()
+
+    def failing():
+      yield 1
+      raise ValueError('oops')
+
+    gen = parallel_gen([failing])
+    self.assertEqual(gen.next(), 1)
+    self.assertRaises(ValueError, gen.next)
+    self.assertThreadsStop(threads)
+
+  def test_concurrency(self):
+    # iterables run concurrently: total time is close to the slowest one.
+    def sleepy():
+      time.sleep(0.2)
+      return [1]
+
+    start = time.time()
+    self.assertEqual(list(parallel_gen([sleepy] * 5)), [1] * 5)
+    self.assertTrue(time.time() - start < 0.6)
+
+  def test_map(self):
+    threads = threading.active_count()
+
+    def slow(value):
+      time.sleep(0.001 * (value % 3))
+      return value * 2
+
+    doubled = map(lambda v: v * 2, range(0, 100))
+    self.assertEqual(list(map_gen(slow, range(0, 100))), doubled)
+    self.assertEqual(list(map_gen(slow, range(0, 100), 1, 10)), doubled)
+    self.assertEqual(list(map_gen(slow, [])), [])
+    self.assertThreadsStop(threads)
+
+    # items are consumed up to `buffer_size` ahead, and abandoning the
+    # generator stops calling `function`.
+    called = []
+    def record(value):
+      called.append(value)
+      return value
+
+    gen = map_gen(record, xrange(0, 1000), workers=2, buffer_size=5)
+    self.assertEqual(gen.next(), 0)
+    self.assertEqual(threading.active_count(), threads + 2)
+    del gen
+    self.assertThreadsStop(threads)
+    self.assertTrue(len(called) <= 6)
+
+    # errors are raised in order.
+    def failing(value):
+      if value == 3:
+        raise ValueError('oops')
+      return value
+
+    gen = map_gen(failing, range(0, 10))
+    self.assertEqual([gen.next() for i in range(0, 3)], [0, 1, 2])
+    self.assertRaises(ValueError, gen.next)
+    self.assertThreadsStop(threads)
+
+  def test_map_concurrency(self):
+    def sleepy(value):
+      time.sleep(0.2)
+      return value
+
+    start = time.time()
+    self.assertEqual(list(map_gen(sleepy, range(0, 5), workers=5)), range(5))
+    self.assertTrue(time.time() - start < 0.6)
+
+  def test_worker_pool(self):
+    threads = threading.active_count()
+    pool = WorkerPool(workers=3, idle_timeout=0.2)
+    self.assertEqual(threading.active_count(), threads)
+
+    # threads start as needed, and are reused across calls.
+    self.assertEqual(list(pool.map_gen(str, range(0, 1))), ['0'])
+    self.assertEqual(threading.active_count(), threads + 1)
+    for i in range(0, 10):
+      values = list(pool.map_gen(str, range(0, 10)))
+      self.assertEqual(values, map(str, range(0, 10)))
+      self.assertTrue(threading.active_count() <= threads + 3)
+
+    # abandoned generators stop calling `function`, leaving the pool usable.
+    called = []
+    def record(value):
+      called.append(value)
+      return value
+
+    gen = pool.map_gen(record, xrange(0, 1000), buffer_size=5)
+    self.assertEqual(gen.next(), 0)
+    del gen
+    self.assertEqual(list(pool.map_gen(str, range(0, 3))), ['0', '1', '2'])
+    self.assertTrue(len(called) <= 6)
+
+    # idle threads exit, and start again when needed.
+    self.assertThreadsStop(threads)
+    self.assertEqual(list(pool.map_gen(str, range(0, 3))), ['0', '1', '2'])
+    pool.close()
+    self.assertThreadsStop(threads)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,106 @@
+
+import bisect
+
+from . import fasthash
+
+
+class HashRing(object):
+  '''A consistent hash ring, mapping objects onto a set of nodes.
+
+  Each node is placed on the ring at `replicas * weight` pseudo-random points
+  (virtual nodes). An object belongs to the node owning the first point at or
+  after the object's hash, wrapping around. Thus, adding or removing a node
+  only moves the objects in the ring ranges that node gains or loses (about
+  1/N of them), instead of nearly all of them as with ``hash % N``.
+
+  Nodes must be strings (or stringify deterministically), as their points are
+  derived from their string values. Lookups are O(log n) in the number of
+  points, using bisect on a sorted list.
+
+      >>> ring = HashRing(['a', 'b'])
+      >>> ring.add('c', weight=2)
+      >>> ring.node(Key('/hello')) in ['a', 'b', 'c']
+      True
+
+  '''
+
+  def __init__(self, nodes=[], replicas=100, hashfn=fasthash.hash):
+    '''Initialize the ring with given `nodes`.
+
+    Args:
+      nodes: initial nodes, each with weight 1.
+      replicas: number of virtual nodes per unit of weight.
+      hashfn: deterministic hash function for both nodes and objects.
+    '''
+    self.replicas = int(replicas)
+    self.hashfn = hashfn
+
+    self._weights = {}
+    self._hashes = []
+    self._nodes = []
+
+    for node in nodes:
+      self._weights[node] = 1
+    self._build()
+
+  def __len__(self):
+    return len(self._weights)
+
+  def __contains__(self, node):
+    return node in self._weights
+
+  @property
+  def nodes(self):
+    '''Returns the nodes in this ring (sorted).'''
+    return sorted(self._weights.keys())
+
+  def weight(self, node):
+    '''Returns the weight of `node`.'''
+    return self._weights[node]
+
+  def add(self, node, weight=1):
+    '''Adds `node` to this ring, with given `weight`.'''
+    if node in self._weights:
+      raise ValueError('node %s already in ring.' % node)
+
+    if weight <= 0:
+      raise ValueError('node weight must be positive. Got %s.' % weight)
+
+    self._weights[node] = weight
+    self._build()
+
+  def remove(self, node):
+    '''Removes `node` from this ring.'''
+    del self._weights[node]
+    self._build()
+
+  def copy(self):
+    '''Returns a copy of this ring.'''
+    other = HashRing(replicas=self.replicas, hashfn=self.hashfn)
+    other._weights = dict(self._weights)
+    other._hashes = list(self._hashes)
+    other._nodes = list(self._nodes)
+    return other
+
+  def node(self, obj):
+    '''Returns the node responsible for `obj`.'''
+    if not self._hashes:
+      raise LookupError('hash ring is empty.')
+
+    index = bisect.bisect_left(self._hashes, self.hashfn(obj))
+    return self._nodes[index % len(self._nodes)]
+
+  def _points(self, node):
+    '''Returns the ring points of `node`.'''
+    count = max(int(round(self.replicas * self._weights[node])), 1)
+    return [self.hashfn('%s#%d' % (node, i)) for i in range(0, count)]
+
+  def _build(self):
+    '''Rebuilds the sorted ring of points.'''
+    points = []
+    for node in self._weights:
+      points.extend((point, node) for point in self._points(node))
+
+    points.sort()
+    self._hashes = [point for point, node in points]
+    self._nodes = [node for point, node in points]
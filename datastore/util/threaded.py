@@ -0,0 +1,202 @@
+
+import sys
+import Queue
+import itertools
+import threading
+import collections
+
+
+# kinds of messages producer threads send to consumers.
+_ITEM = 'item'
+_DONE = 'done'
+_ERROR = 'error'
+
+_poll_interval = 0.1
+
+
+def _put(queue, message, stop):
+  '''Puts `message` into `queue`, giving up if `stop` is set.
+  Returns whether `message` was put.
+  '''
+  while not stop.is_set():
+    try:
+      queue.put(message, timeout=_poll_interval)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+
+def _produce(iterable_fn, queue, stop):
+  '''Iterates over `iterable_fn()`, putting its items into `queue`.'''
+  try:
+    for item in iterable_fn():
+      if not _put(queue, (_ITEM, item), stop):
+        return
+    _put(queue, (_DONE, None), stop)
+  except Exception:
+    _put(queue, (_ERROR, sys.exc_info()), stop)
+
+
+def _consume(queue):
+  '''Generator that yields the items a producer puts into `queue`.'''
+  while True:
+    kind, value = queue.get()
+    if kind is _ITEM:
+      yield value
+    elif kind is _DONE:
+      return
+    else:
+      raise value[0], value[1], value[2]
+
+
+def parallel_gen(iterable_fns, combine=itertools.chain.from_iterable,
+                 buffer_size=100):
+  '''A generator that calls and iterates each of `iterable_fns` concurrently,
+  each in its own background thread, reading up to `buffer_size` items ahead
+  of the consumer.
+
+  Yields the items of ``combine(iterators)``, where `iterators` yield the
+  items of each of `iterable_fns`, in order. By default, the iterators are
+  chained. Exceptions raised by producers are re-raised in the consumer.
+
+  Threads start on the first `next`, and stop once this generator is
+  exhausted or closed (e.g. when abandoned after a limit is reached).
+  '''
+  stop = threading.Event()
+  queues = [Queue.Queue(maxsize=buffer_size) for fn in iterable_fns]
+
+  for iterable_fn, queue in zip(iterable_fns, queues):
+    thread = threading.Thread(target=_produce, args=(iterable_fn, queue, stop))
+    thread.daemon = True
+    thread.start()
+
+  try:
+    for item in combine(map(_consume, queues)):
+      yield item
+  finally:
+    stop.set()
+
+
+def _call(task):
+  '''Runs a map task: puts `function(item)` into its result queue, unless
+  the generator that submitted it was stopped.
+  '''
+  function, item, result, stop = task
+  if stop.is_set():
+    return
+
+  try:
+    result.put((_ITEM, function(item)))
+  except Exception:
+    result.put((_ERROR, sys.exc_info()))
+
+
+def _map_gen(submit, function, iterable, buffer_size):
+  '''Generator behind `map_gen`, passing its tasks to `submit`.'''
+  stop = threading.Event()
+  results = collections.deque()
+  iterator = iter(iterable)
+  end = object()
+
+  def fill(count):
+    # next, not islice: iterators like Cursors may not be iter'ed twice.
+    for i in range(0, count):
+      item = next(iterator, end)
+      if item is end:
+        return
+      result = Queue.Queue(maxsize=1)
+      submit((function, item, result, stop))
+      results.append(result)
+
+  try:
+    fill(buffer_size)
+    while results:
+      kind, value = results.popleft().get()
+      fill(1)
+      if kind is _ERROR:
+        raise value[0], value[1], value[2]
+      yield value
+  finally:
+    stop.set()
+
+
+class WorkerPool(object):
+  '''A pool of up to `workers` daemon threads, reused across calls to its
+  `map_gen`, so that short batches do not pay for starting threads. Threads
+  start as tasks come in, and exit once idle for `idle_timeout` seconds (if
+  not None), or when the pool is closed.
+  '''
+
+  def __init__(self, workers=4, idle_timeout=10):
+    self.workers = int(workers)
+    self.idle_timeout = idle_timeout
+    self._tasks = Queue.Queue()
+    self._threads = 0
+    self._lock = threading.Lock()
+
+  def _submit(self, task):
+    '''Queues `task`, starting a thread if the pool is not full.'''
+    # under the lock, so idle threads never exit with tasks left queued.
+    with self._lock:
+      self._tasks.put(task)
+      if self._threads < self.workers:
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+        self._threads += 1
+
+  def _work(self):
+    '''Runs queued tasks until idle for too long, or told to exit.'''
+    while True:
+      try:
+        task = self._tasks.get(timeout=self.idle_timeout)
+      except Queue.Empty:
+        with self._lock:
+          if self._tasks.empty():
+            self._threads -= 1
+            return
+        continue
+
+      if task is None:
+        with self._lock:
+          self._threads -= 1
+        return
+      _call(task)
+
+  def map_gen(self, function, iterable, buffer_size=None):
+    '''A generator that yields ``function(item)`` for each item in
+    `iterable`, in order, calling `function` in this pool on up to
+    `buffer_size` items (by default, `workers`) ahead of the consumer.
+    See `map_gen`.
+    '''
+    buffer_size = int(buffer_size or self.workers)
+    return _map_gen(self._submit, function, iterable, buffer_size)
+
+  def close(self):
+    '''Tells the threads of this pool to exit, once done with the tasks
+    queued so far.
+    '''
+    with self._lock:
+      for i in range(0, self._threads):
+        self._tasks.put(None)
+
+
+def map_gen(function, iterable, workers=4, buffer_size=None):
+  '''A generator that yields ``function(item)`` for each item in `iterable`,
+  in order, calling `function` concurrently in `workers` background threads
+  on up to `buffer_size` items (by default, `workers`) ahead of the consumer.
+
+  Exceptions raised by `function` are re-raised in the consumer, in order.
+  Threads start on the first `next`, and stop once this generator is
+  exhausted or closed, without calling `function` on the items left. To
+  reuse threads across calls, use a WorkerPool.
+  '''
+  pool = WorkerPool(workers, idle_timeout=None)
+  values = pool.map_gen(function, iterable, buffer_size)
+  try:
+    for value in values:
+      yield value
+  finally:
+    values.close()  # skips the tasks left, before the threads exit.
+    pool.close()